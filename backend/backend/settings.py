@@ -112,16 +112,22 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 
 ASGI_APPLICATION = "backend.asgi.application"
 
+# the spotify import worker (`manage.py run_spotify_imports`, the Procfile's worker) pushes
+# to websockets held by the web process, so as soon as both run the channel layer has to
+# be shared between them: set REDIS_URL. in memory is only good for a single dev process
 CHANNEL_LAYERS = {
     "default": {
         # For single-process dev:
         "BACKEND": "channels.layers.InMemoryChannelLayer",
-        # Use this in prod (requires Redis running):
-        # "BACKEND": "channels_redis.core.RedisChannelLayer",
-        # "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
     }
 }
 
+if os.environ.get('REDIS_URL'):
+    CHANNEL_LAYERS['default'] = {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [os.environ['REDIS_URL']]},
+    }
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -181,6 +187,27 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# the spotify app token, search results and the preference version live here. locmem is
+# per process, so a shared cache (REDIS_URL) is required as soon as more than one process
+# runs: the import worker writes preferences and bumps the version the web process checks
+# its candidate index against, and each web worker would otherwise refresh its own token.
+# the background workers (see the Procfile) refuse to start without it and
+# `manage.py check --deploy` warns.
+# the shared cache evicts search results least recently used first (locmem MAX_ENTRIES,
+# redis maxmemory-policy allkeys-lru)
+CACHES = {
+    "default": {
+        # For single-process dev:
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+if os.environ.get('REDIS_URL'):
+    CACHES['default'] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ['REDIS_URL'],
+    }
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
@@ -194,3 +221,29 @@ REST_FRAMEWORK = {
 # User model change for non-default users
 AUTH_USER_MODEL = 'harmony.User'
 
+# Matching
+# 'exact' scores every user sharing a genre/artist/song, 'approximate' only scores the
+# candidates returned by the minhash/lsh index (see `manage.py lsh_report` for the tradeoff)
+HARMONY_MATCHING_MODE = os.environ.get('HARMONY_MATCHING_MODE', 'exact')
+HARMONY_MATCH_TOP_K = 100
+HARMONY_LSH_BANDS = 64
+HARMONY_LSH_ROWS = 1
+# directory of the memory-mapped preference matrix snapshots (`manage.py write_matching_snapshot`),
+# read by `manage.py recompute_matches --from-snapshot` only, requests always use the database
+HARMONY_MATCHING_SNAPSHOT_DIR = os.environ.get('HARMONY_MATCHING_SNAPSHOT_DIR')
+# candidates queued per user for /api/matches/next/, `manage.py refill_discovery_queues`
+# (the Procfile's discovery process) tops a queue back up once it holds fewer than the
+# low-water mark
+HARMONY_DISCOVERY_QUEUE_SIZE = 50
+HARMONY_DISCOVERY_QUEUE_LOW_WATER = 10
+# every spotify call (harmony/spotify.py) times out and is retried at most this often
+HARMONY_SPOTIFY_CONNECT_TIMEOUT = 3.05
+HARMONY_SPOTIFY_READ_TIMEOUT = 10
+HARMONY_SPOTIFY_RETRIES = 2
+# `manage.py run_spotify_imports` picks a running import up again after this long
+HARMONY_SPOTIFY_IMPORT_STALE_SECONDS = 600
+# /api/search/ results are shared for this many seconds; each worker also keeps this
+# many of the most recently used in process
+HARMONY_SPOTIFY_SEARCH_TTL = 600
+HARMONY_SPOTIFY_SEARCH_LOCAL_SIZE = 1000
+
@@ -0,0 +1,6 @@
+# benchmarks for the matching endpoints, run from the backend directory:
+#
+#   python -m benchmarks.run --users 1000 10000 100000 --output bench.json
+#   python -m benchmarks.compare old.json bench.json
+#
+# the run uses its own sqlite database (--db), never the one in DATABASE_URL
@@ -0,0 +1,49 @@
+# benchmarks/compare.py
+import argparse
+import json
+import sys
+
+# lower is better for all of them
+METRICS = ('p50_ms', 'p95_ms', 'queries_per_run', 'peak_memory_kb')
+
+
+def compare(old, new, threshold):
+    """
+    yields (size, scenario, metric, old value, new value, change, regressed) for every
+    metric both reports have
+    """
+    for size, scenarios in new['results'].items():
+        for name, metrics in scenarios.items():
+            before = old['results'].get(size, {}).get(name)
+            if not isinstance(metrics, dict) or not isinstance(before, dict):
+                continue
+            for metric in METRICS:
+                if metric not in metrics or metric not in before:
+                    continue
+                change = (metrics[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+                yield size, name, metric, before[metric], metrics[metric], change, change > threshold
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='compare two benchmark reports')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative increase counted as a regression')
+    args = parser.parse_args(argv)
+
+    with open(args.old) as old, open(args.new) as new:
+        old, new = json.load(old), json.load(new)
+
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    regressions = 0
+    for size, name, metric, before, after, change, regressed in compare(old, new, args.threshold):
+        regressions += regressed
+        print(
+            f"{size:>7} {name:<28} {metric:<16} {before:>12} -> {after:<12} "
+            f"{change:+8.1%}{'  REGRESSION' if regressed else ''}"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# benchmarks/generator.py
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from rest_framework.authtoken.models import Token
+
+from harmony.models import (
+    User, Genre, Artist, Song, UserGenrePreference, UserArtistPreference,
+    UserSongPreference, UserPreferenceTotals, Match, MatchRejection
+)
+
+BATCH_SIZE = 5000
+
+
+def zipf_sampler(generator, size, exponent=1.1):
+    """
+    draws item indexes in [0, size) where the item of rank r is picked with probability
+    proportional to 1 / r^exponent, the long tail music catalogs have
+    """
+    cumulative = np.cumsum(1.0 / np.arange(1, size + 1) ** exponent)
+    cumulative /= cumulative[-1]
+
+    def sample(count):
+        return np.minimum(np.searchsorted(cumulative, generator.random(count)), size - 1)
+    return sample
+
+
+class Dataset:
+    """
+    what a benchmark run needs to know about the generated data
+    """
+
+    def __init__(self, user_ids, tokens, seed):
+        self.user_ids = user_ids
+        self.tokens = tokens  # user_id -> token key, for the users requests are made as
+        self.seed = seed
+
+
+def generate(users, seed=1, songs_per_user=12, artists_per_user=6, genres_per_user=3,
+             request_users=50):
+    """
+    creates `users` users with zipf distributed song/artist/genre preferences through the
+    real models. the same arguments always give the same data
+    """
+    generator = np.random.default_rng(seed)
+    catalog = {
+        'genre': max(200, users // 50),
+        'artist': max(1000, users // 2),
+        'song': max(5000, users * 2),
+    }
+
+    Genre.objects.bulk_create(
+        [Genre(name=f'bench genre {i}') for i in range(catalog['genre'])], batch_size=BATCH_SIZE
+    )
+    Artist.objects.bulk_create(
+        [Artist(name=f'Bench Artist {i}', spotify_id=f'bench_a{i}') for i in range(catalog['artist'])],
+        batch_size=BATCH_SIZE
+    )
+    Song.objects.bulk_create(
+        [Song(name=f'Bench Song {i}', spotify_id=f'bench_s{i}') for i in range(catalog['song'])],
+        batch_size=BATCH_SIZE
+    )
+    item_ids = {
+        'genre': list(Genre.objects.filter(name__startswith='bench genre ').order_by('id').values_list('id', flat=True)),
+        'artist': list(Artist.objects.filter(spotify_id__startswith='bench_a').order_by('id').values_list('id', flat=True)),
+        'song': list(Song.objects.filter(spotify_id__startswith='bench_s').order_by('id').values_list('id', flat=True)),
+    }
+
+    password = make_password(None)  # unusable, hashing one per user would dominate the run
+    User.objects.bulk_create(
+        [User(username=f'bench{i}', password=password) for i in range(users)], batch_size=BATCH_SIZE
+    )
+    user_ids = list(User.objects.filter(username__startswith='bench').order_by('id').values_list('id', flat=True))
+
+    # bulk_create skips the signals, so the totals rows are written alongside
+    totals = {user_id: UserPreferenceTotals(user_id=user_id) for user_id in user_ids}
+    dimensions = (
+        ('genre', UserGenrePreference, genres_per_user),
+        ('artist', UserArtistPreference, artists_per_user),
+        ('song', UserSongPreference, songs_per_user),
+    )
+    for name, model, per_user in dimensions:
+        sample = zipf_sampler(generator, catalog[name])
+        ids = item_ids[name]
+        rows = []
+        for user_id in user_ids:
+            picked = np.unique(sample(1 + generator.poisson(per_user - 1)))
+            weights = generator.integers(1, 11, size=len(picked))
+            for index, weight in zip(picked, weights):
+                rows.append(model(user_id=user_id, weight=int(weight), **{f'{name}_id': ids[index]}))
+            user_totals = totals[user_id]
+            setattr(user_totals, f'{name}_total', int(weights.sum()))
+            setattr(user_totals, f'{name}_count', len(picked))
+            if len(rows) >= BATCH_SIZE:
+                model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+                rows = []
+        model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    UserPreferenceTotals.objects.bulk_create(totals.values(), batch_size=BATCH_SIZE)
+
+    # a few accepted and rejected pairs so the discovery deck has something to exclude
+    pairs = generator.choice(len(user_ids), size=(users // 10, 2))
+    # bulk_create skips Match.save(), so the pairs are put in canonical order here
+    matched = {Match.ordered_pair(user_ids[a], user_ids[b]) for a, b in pairs[: len(pairs) // 2] if a != b}
+    Match.objects.bulk_create(
+        [Match(user1_id=user1_id, user2_id=user2_id) for user1_id, user2_id in sorted(matched)],
+        batch_size=BATCH_SIZE
+    )
+    MatchRejection.objects.bulk_create(
+        [MatchRejection(user1_id=user_ids[a], user2_id=user_ids[b]) for a, b in pairs[len(pairs) // 2:] if a != b],
+        batch_size=BATCH_SIZE
+    )
+
+    requesters = generator.choice(user_ids, size=min(request_users, len(user_ids)), replace=False)
+    tokens = {
+        int(user_id): Token.objects.get_or_create(user_id=int(user_id))[0].key
+        for user_id in requesters
+    }
+    return Dataset(user_ids, tokens, seed)
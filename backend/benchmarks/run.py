@@ -0,0 +1,98 @@
+# benchmarks/run.py
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='matching benchmarks on generated data')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--scenarios', nargs='+', help='default: all of them')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--db', default=os.path.join('benchmarks', 'bench.sqlite3'),
+                        help='sqlite file the run creates from scratch for every size')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, help='override the runs per scenario')
+    parser.add_argument('--time-budget', type=float, default=60.0,
+                        help='stop a scenario after this many seconds, whatever ran is reported')
+    return parser.parse_args(argv)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fresh_database(path):
+    from django.core.management import call_command
+    from django.db import connections
+
+    connections.close_all()
+    if os.path.exists(path):
+        os.remove(path)
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # point django at the benchmark database before anything loads the settings
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+    django.setup()
+    from django.test.utils import setup_test_environment
+    setup_test_environment()  # lets the test client talk to the app
+
+    from harmony.candidate_index import bump_preference_version
+    from .generator import generate
+    from .scenarios import SCENARIOS, measure
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+    for users in args.users:
+        fresh_database(args.db)
+        start = time.perf_counter()
+        dataset = generate(users, seed=args.seed)
+        # in-process indexes still describe the previous database
+        bump_preference_version()
+        results = {'generate_s': round(time.perf_counter() - start, 2)}
+        print(f'{users} users generated in {results["generate_s"]}s', flush=True)
+
+        for name in names:
+            results[name] = measure(SCENARIOS[name], dataset, repeat=args.repeat, time_budget=args.time_budget)
+            print(
+                f'  {name:<28} p50 {results[name]["p50_ms"]:>10.2f} ms  p95 {results[name]["p95_ms"]:>10.2f} ms  '
+                f'{results[name]["queries_per_run"]:>7} queries  {results[name]["peak_memory_kb"]:>10.1f} KiB',
+                flush=True
+            )
+        report['results'][str(users)] = results
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# benchmarks/scenarios.py
+import itertools
+import time
+import tracemalloc
+
+import numpy as np
+from django.db import connection
+from rest_framework.test import APIClient
+
+from harmony.models import MatchScoreStatus
+from harmony.matching_utils import compute_final_match_score
+from harmony.match_table import ensure_match_table
+
+SCENARIOS = {}
+
+
+def scenario(name, repeat):
+    def register(cls):
+        cls.name = name
+        cls.repeat = repeat
+        SCENARIOS[name] = cls
+        return cls
+    return register
+
+
+class Scenario:
+    """
+    one timed operation. prepare() runs untimed before every run(), both get the
+    iteration number so every iteration can pick a different user
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.requesters = itertools.cycle(sorted(dataset.tokens))
+
+    def client_for(self, user_id):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.dataset.tokens[user_id]}')
+        return client
+
+    def prepare(self, iteration):
+        self.user_id = next(self.requesters)
+
+    def run(self, iteration):
+        raise NotImplementedError
+
+
+@scenario('full_matches_cold', repeat=20)
+class FullMatchesCold(Scenario):
+    # the first read of a user's table, which scores it against every candidate
+    def prepare(self, iteration):
+        super().prepare(iteration)
+        MatchScoreStatus.objects.filter(user_id=self.user_id).delete()
+
+    def run(self, iteration):
+        return self.client_for(self.user_id).get('/api/matches/full/')
+
+
+@scenario('full_matches_warm', repeat=50)
+class FullMatchesWarm(Scenario):
+    def prepare(self, iteration):
+        super().prepare(iteration)
+        ensure_match_table(self.user_id)
+
+    def run(self, iteration):
+        return self.client_for(self.user_id).get('/api/matches/full/')
+
+
+@scenario('matches', repeat=5)
+class Matches(Scenario):
+    def run(self, iteration):
+        return self.client_for(self.user_id).get('/api/matches/')
+
+
+@scenario('compute_final_match_score', repeat=200)
+class ComputeFinalMatchScore(Scenario):
+    def __init__(self, dataset):
+        super().__init__(dataset)
+        self.generator = np.random.default_rng(dataset.seed)
+
+    def prepare(self, iteration):
+        self.pair = [int(user_id) for user_id in self.generator.choice(self.dataset.user_ids, size=2, replace=False)]
+
+    def run(self, iteration):
+        return compute_final_match_score(*self.pair)
+
+
+class QueryCounter:
+    # counts without keeping the sql around, the matches deck runs far more queries
+    # than django's query log holds
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def measure(cls, dataset, repeat=None, time_budget=None, memory_runs=3):
+    """
+    runs one scenario and returns its latency percentiles (ms), queries per run and peak
+    python memory (tracemalloc, measured in separate runs so it doesn't skew the timings)
+    """
+    bench = cls(dataset)
+    repeat = repeat or cls.repeat
+    latencies, queries = [], []
+    started = time.perf_counter()
+    for iteration in range(repeat):
+        bench.prepare(iteration)
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            start = time.perf_counter()
+            response = bench.run(iteration)
+            latencies.append(time.perf_counter() - start)
+        queries.append(counter.count)
+        status_code = getattr(response, 'status_code', 200)
+        if status_code >= 400:
+            raise RuntimeError(f'{cls.name} answered {status_code}')
+        if time_budget is not None and time.perf_counter() - started > time_budget:
+            break
+
+    peak = 0
+    tracemalloc.start()
+    try:
+        for iteration in range(min(memory_runs, len(latencies))):
+            bench.prepare(iteration)
+            tracemalloc.reset_peak()
+            bench.run(iteration)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'samples': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': round(float(np.mean(latencies)) * 1000, 3),
+        'queries_per_run': int(np.median(queries)),
+        'max_queries': max(queries),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
@@ -41,4 +41,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Send the JSON payload directly to the client
         await self.send(text_data=json.dumps({
             'message': event['message'] # event['message'] contains the serialized message data
-        }))
\ No newline at end of file
+        }))
+
+    async def spotify_import(self, event):
+        """
+        Status updates of the user's Spotify import (harmony/spotify_import.py), sent to
+        the same group as the chat messages.
+        """
+        await self.send(text_data=json.dumps({
+            'spotify_import': event['job']
+        }))
@@ -23,6 +23,8 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['sent_at'] 
+        # a conversation's history is read in sent order
+        indexes = [models.Index(fields=['conversation', 'sent_at'], name='message_conversation_sent_idx')]
 
     def __str__(self):
         return f"Msg from {self.sender.username} in Match {self.conversation.pk}"
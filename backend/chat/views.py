@@ -28,7 +28,7 @@ class MessageListView(APIView):
         
         # 2. Permission Check: Ensure the user is one of the two people in the Match.
         match = conversation.match
-        if request.user not in [match.user1, match.user2]:
+        if not match.includes(request.user):
             return Response({"detail": "Permission denied. User is not part of this match."}, status=status.HTTP_403_FORBIDDEN)
 
         # 3. Retrieve and serialize messages
@@ -48,8 +48,8 @@ class MessageCreateView(APIView):
         match = get_object_or_404(Match, id=match_id)
         conversation, created = Conversation.objects.get_or_create(match=match)
 
-        # 2. Permission Check
-        if request.user not in [match.user1, match.user2]:
+        # 2. Permission Check (compares ids, doesn't load either user)
+        if not match.includes(request.user):
             return Response({"detail": "Permission denied. User is not part of this match."}, status=status.HTTP_403_FORBIDDEN)
 
         # 3. Prepare data and Validate
@@ -65,14 +65,8 @@ class MessageCreateView(APIView):
             serialized_message = MessageSerializer(message).data
 
             # 6. BROADCAST via Channel Layer (The Real-Time Part!) 
-            self_group_name = ''
-            other_group_name = ''
-            if request.user not in [match.user1]:
-                self_group_name = f'chat_{match.user1.id}'
-                other_group_name = f'chat_{match.user2.id}'
-            else:
-                self_group_name = f'chat_{match.user2.id}'
-                other_group_name = f'chat_{match.user1.id}'
+            self_group_name = f'chat_{request.user.id}'
+            other_group_name = f'chat_{match.other_user_id(request.user)}'
 
 
             async_to_sync(channel_layer.group_send)(
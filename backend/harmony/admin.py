@@ -3,7 +3,7 @@ from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 from .models import (
     User, Song, Artist, Genre, 
     UserSongPreference, UserArtistPreference, UserGenrePreference, 
-    SpotifyCredentials, Swipe, Match, Message
+    SpotifyCredentials, Swipe, Match, Message, MatchScore, DiscoveryQueue, SpotifyImportJob
 )
 
 # === CUSTOM USER ADMIN ===
@@ -172,6 +172,15 @@ class SpotifyCredentialsAdmin(admin.ModelAdmin):
     scope_display.short_description = 'Scope'
 
 
+# === SPOTIFY IMPORT JOB ADMIN ===
+@admin.register(SpotifyImportJob)
+class SpotifyImportJobAdmin(admin.ModelAdmin):
+    list_display = ('user', 'status', 'attempts', 'created_at', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('user__username',)
+    readonly_fields = ('created_at', 'started_at', 'finished_at')
+
+
 # === SWIPE ADMIN ===
 @admin.register(Swipe)
 class SwipeAdmin(admin.ModelAdmin):
@@ -191,6 +200,24 @@ class MatchAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at',)
 
 
+# === MATCH SCORE ADMIN ===
+@admin.register(MatchScore)
+class MatchScoreAdmin(admin.ModelAdmin):
+    list_display = ('user', 'candidate', 'final_score', 'genre_match', 'artist_match', 'song_match', 'updated_at')
+    search_fields = ('user__username', 'candidate__username')
+    ordering = ('user', '-final_score')
+    readonly_fields = ('updated_at',)
+
+
+# === DISCOVERY QUEUE ADMIN ===
+@admin.register(DiscoveryQueue)
+class DiscoveryQueueAdmin(admin.ModelAdmin):
+    list_display = ('user', 'size', 'needs_refill', 'refilled_at')
+    list_filter = ('needs_refill',)
+    search_fields = ('user__username',)
+    readonly_fields = ('refilled_at',)
+
+
 # === MESSAGE ADMIN ===
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -6,4 +6,5 @@ class HarmonyConfig(AppConfig):
     name = 'harmony'
 
     def ready(self):
+        import harmony.checks
         import harmony.signals
\ No newline at end of file
@@ -0,0 +1,133 @@
+# harmony/candidate_index.py
+from collections import defaultdict
+import threading
+
+from django.core.cache import cache
+
+from .matching_engine import DIMENSIONS, preference_rows
+
+# bumped by every committed preference change so other processes know their index is stale.
+# that only works across processes when CACHES is shared (redis, see settings.py): with the
+# default locmem cache each process has its own version and never sees the others' changes
+PREFERENCE_VERSION_KEY = 'harmony:preference_version'
+
+
+def get_preference_version():
+    return cache.get(PREFERENCE_VERSION_KEY, 0)
+
+
+def bump_preference_version():
+    cache.add(PREFERENCE_VERSION_KEY, 0, timeout=None)
+    try:
+        return cache.incr(PREFERENCE_VERSION_KEY)
+    except ValueError:  # evicted between add and incr
+        cache.set(PREFERENCE_VERSION_KEY, 1, timeout=None)
+        return 1
+
+
+class InvertedPreferenceIndex:
+    """
+    maps every genre, artist and song id to the users who weigh it, so matching only
+    has to score users that share at least one item with the current user
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.item_users = {name: defaultdict(set) for name, _, _ in DIMENSIONS}
+        self.user_items = {name: defaultdict(set) for name, _, _ in DIMENSIONS}
+        # running totals of the pruning work, per process
+        self.candidates_scored = 0
+        self.candidates_pruned = 0
+
+    def build(self):
+        """
+        (re)loads the index from the preference tables, one query per table
+        """
+        version = get_preference_version()
+        item_users = {name: defaultdict(set) for name, _, _ in DIMENSIONS}
+        user_items = {name: defaultdict(set) for name, _, _ in DIMENSIONS}
+        for name, model, field_name in DIMENSIONS:
+            for user_id, item_id, _ in preference_rows(model, field_name):
+                item_users[name][item_id].add(user_id)
+                user_items[name][user_id].add(item_id)
+
+        with self.lock:
+            self.item_users = item_users
+            self.user_items = user_items
+            self.version = version
+
+    def ensure_fresh(self):
+        # another process changed preferences since we last looked
+        if self.version is None or self.version != get_preference_version():
+            self.build()
+
+    def add(self, dimension, user_id, item_id):
+        with self.lock:
+            self.item_users[dimension][item_id].add(user_id)
+            self.user_items[dimension][user_id].add(item_id)
+
+    def remove(self, dimension, user_id, item_id):
+        with self.lock:
+            users = self.item_users[dimension].get(item_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.item_users[dimension][item_id]
+            items = self.user_items[dimension].get(user_id)
+            if items is not None:
+                items.discard(item_id)
+                if not items:
+                    del self.user_items[dimension][user_id]
+
+    def apply_change(self, dimension, user_id, item_id, version, removed=False):
+        """
+        applies one committed preference change that moved the shared version to `version`.
+        if some other process changed preferences in between we rebuild on next use instead
+        """
+        self.apply_changes(user_id, [(dimension, item_id, removed)], version)
+
+    def apply_changes(self, user_id, changes, version):
+        """
+        apply_change for a batch of (dimension, item_id, removed) of one user committed
+        under a single version bump, e.g. a bulk import
+        """
+        with self.lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None
+                return
+            self.version = version
+
+        for dimension, item_id, removed in changes:
+            if removed:
+                self.remove(dimension, user_id, item_id)
+            else:
+                self.add(dimension, user_id, item_id)
+
+    def candidates(self, user_id):
+        """
+        ids of every other user sharing at least one genre, artist or song with user_id
+        """
+        self.ensure_fresh()
+        found = set()
+        with self.lock:
+            for name, _, _ in DIMENSIONS:
+                for item_id in self.user_items[name].get(user_id, ()):
+                    found |= self.item_users[name][item_id]
+        found.discard(user_id)
+        return found
+
+    def record_pruning(self, scored, pruned):
+        with self.lock:
+            self.candidates_scored += scored
+            self.candidates_pruned += pruned
+
+    def stats(self):
+        return {
+            'candidates_scored': self.candidates_scored,
+            'candidates_pruned': self.candidates_pruned,
+        }
+
+
+# one index per process, filled lazily on first use
+candidate_index = InvertedPreferenceIndex()
@@ -0,0 +1,37 @@
+# harmony/checks.py
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# backends that live inside one process, nothing written to them reaches another
+PER_PROCESS_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+PER_PROCESS_CHANNEL_LAYERS = {'channels.layers.InMemoryChannelLayer'}
+
+
+def per_process_backends():
+    """
+    names of the settings (CACHES, CHANNEL_LAYERS) whose default backend is per process.
+    with either, the background workers' preference version bumps or websocket pushes
+    never reach the web process, and the web process' never reach them
+    """
+    found = []
+    if settings.CACHES.get('default', {}).get('BACKEND') in PER_PROCESS_CACHES:
+        found.append('CACHES')
+    if getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {}).get('BACKEND') in PER_PROCESS_CHANNEL_LAYERS:
+        found.append('CHANNEL_LAYERS')
+    return found
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_backends(app_configs, **kwargs):
+    return [
+        Warning(
+            f'{name} uses a per-process backend, the background workers and the web '
+            f'process won\'t see each other\'s changes.',
+            hint='Set REDIS_URL to share it between processes.',
+            id='harmony.W001',
+        )
+        for name in per_process_backends()
+    ]
@@ -0,0 +1,69 @@
+# harmony/discovery_queue.py
+from django.conf import settings
+from django.db.models import Case, F, Max, Value, When
+from django.utils import timezone
+
+from .models import DiscoveryQueue, DiscoveryQueueEntry
+from .match_table import ensure_match_table, discovery_page
+
+# how many candidates are queued per user, and below how many a refill is requested
+QUEUE_SIZE = getattr(settings, 'HARMONY_DISCOVERY_QUEUE_SIZE', 50)
+LOW_WATER = getattr(settings, 'HARMONY_DISCOVERY_QUEUE_LOW_WATER', 10)
+
+
+def refill_queue(user_id):
+    """
+    tops user_id's queue up to QUEUE_SIZE with the best ranked candidates not queued yet.
+    new entries go behind the existing ones so the card being shown doesn't move
+    """
+    queue, _ = DiscoveryQueue.objects.get_or_create(user_id=user_id)
+    ensure_match_table(user_id)
+
+    queued = DiscoveryQueueEntry.objects.filter(user_id=user_id)
+    missing = QUEUE_SIZE - queued.count()
+    if missing > 0:
+        page, _ = discovery_page(user_id, missing, also_excluded=queued.values('candidate_id'))
+        start = (queued.aggregate(last=Max('position'))['last'] or 0) + 1
+        DiscoveryQueueEntry.objects.bulk_create(
+            [
+                DiscoveryQueueEntry(user_id=user_id, candidate=candidate, position=start + offset, final_score=score)
+                for offset, (candidate, score) in enumerate(page)
+            ],
+            ignore_conflicts=True,
+        )
+
+    queue.size = queued.count()
+    queue.needs_refill = False
+    queue.refilled_at = timezone.now()
+    queue.save(update_fields=['size', 'needs_refill', 'refilled_at'])
+    return queue
+
+
+def next_entry(user_id):
+    """
+    the head of user_id's queue, one index seek. only an empty queue is filled inline
+    """
+    head = DiscoveryQueueEntry.objects.filter(user_id=user_id).select_related('candidate').order_by('position')
+    entry = head.first()
+    if entry is None:
+        refill_queue(user_id)
+        entry = head.first()
+    return entry
+
+
+def pop_candidate(user_id, candidate_id):
+    """
+    takes candidate_id out of user_id's queue after a swipe and asks the worker for a
+    refill once the queue runs low
+    """
+    deleted, _ = DiscoveryQueueEntry.objects.filter(user_id=user_id, candidate_id=candidate_id).delete()
+    if deleted:
+        # size is still the old value inside the update
+        DiscoveryQueue.objects.filter(user_id=user_id).update(
+            size=F('size') - deleted,
+            needs_refill=Case(
+                When(size__lt=LOW_WATER + deleted, then=Value(True)),
+                default=F('needs_refill'),
+            ),
+        )
+    return bool(deleted)
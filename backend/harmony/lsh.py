@@ -0,0 +1,148 @@
+# harmony/lsh.py
+from collections import defaultdict
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .matching_engine import DIMENSIONS, preference_rows
+from .candidate_index import get_preference_version
+
+# hashes are computed modulo a mersenne prime so a * x + b fits in 64 bits
+PRIME = (1 << 31) - 1
+
+DIMENSION_CODES = {name: code for code, (name, _, _) in enumerate(DIMENSIONS, start=1)}
+
+
+def preference_tokens(prefs):
+    """
+    turns {dimension: {item_id: weight}} into the integer tokens of a weighted set.
+    an item of weight w becomes w tokens, so the jaccard similarity of two token sets is
+    sum(min) / sum(max) of their weights, the same overlap compute_weighted_similarity rewards
+    """
+    tokens = []
+    for name, items in prefs.items():
+        code = DIMENSION_CODES[name]
+        for item_id, weight in items.items():
+            base = (code * 1_000_003 + item_id) * 16
+            tokens.extend(base + copy for copy in range(1, int(weight) + 1))
+    return np.asarray(tokens, dtype=np.int64) % PRIME
+
+
+class MinHashLSH:
+    """
+    weighted minhash signatures split into bands. two users land in the same bucket of a band
+    when all rows of that band agree, so similar users collide in at least one band with high
+    probability while unrelated ones almost never do
+    """
+
+    def __init__(self, bands=64, rows=1, seed=1):
+        self.bands = bands
+        self.rows = rows
+        generator = np.random.default_rng(seed)
+        self.a = generator.integers(1, PRIME, size=bands * rows, dtype=np.int64)
+        self.b = generator.integers(0, PRIME, size=bands * rows, dtype=np.int64)
+        self.lock = threading.Lock()
+        self.buckets = defaultdict(set)
+        self.signatures = {}
+        self.version = None
+        self.pending = set()  # users whose preferences changed since their signature was made
+
+    def signature(self, tokens):
+        if len(tokens) == 0:
+            return None
+        hashed = (self.a[:, None] * tokens[None, :] + self.b[:, None]) % PRIME
+        return hashed.min(axis=1)
+
+    def band_keys(self, signature):
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def add(self, user_id, prefs):
+        signature = self.signature(preference_tokens(prefs))
+        with self.lock:
+            self.remove(user_id)
+            if signature is None:
+                return
+            self.signatures[user_id] = signature
+            for key in self.band_keys(signature):
+                self.buckets[key].add(user_id)
+
+    def remove(self, user_id):
+        signature = self.signatures.pop(user_id, None)
+        if signature is None:
+            return
+        for key in self.band_keys(signature):
+            self.buckets[key].discard(user_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+
+    def query(self, user_id):
+        """
+        ids of the users sharing at least one band bucket with user_id
+        """
+        signature = self.signatures.get(user_id)
+        if signature is None:
+            return set()
+        found = set()
+        with self.lock:
+            for key in self.band_keys(signature):
+                found |= self.buckets.get(key, set())
+        found.discard(user_id)
+        return found
+
+    def load_prefs(self, user_ids=None):
+        # {user_id: {dimension: {item_id: weight}}}, one query per preference table
+        prefs = defaultdict(lambda: defaultdict(dict))
+        for name, model, field_name in DIMENSIONS:
+            for user_id, item_id, weight in preference_rows(model, field_name, user_ids):
+                prefs[user_id][name][item_id] = weight
+        return prefs
+
+    def build(self):
+        """
+        (re)computes every user's signature
+        """
+        version = get_preference_version()
+        prefs = self.load_prefs()
+        with self.lock:
+            self.buckets = defaultdict(set)
+            self.signatures = {}
+            self.pending = set()
+        for user_id, user_prefs in prefs.items():
+            self.add(user_id, user_prefs)
+        self.version = version
+
+    def apply_change(self, user_id, version):
+        """
+        notes a committed preference change of user_id that moved the shared version to
+        `version`. the signature is recomputed lazily, once for any number of changes
+        """
+        with self.lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None
+                return
+            self.version = version
+            self.pending.add(user_id)
+
+    def candidates(self, user_id):
+        if self.version is None or self.version != get_preference_version():
+            self.build()
+
+        with self.lock:
+            changed, self.pending = self.pending, set()
+        if changed:
+            prefs = self.load_prefs(changed)
+            for changed_id in changed:
+                self.add(changed_id, prefs.get(changed_id, {}))
+        return self.query(user_id)
+
+
+# one index per process, only built when the approximate matching mode is selected.
+# more bands raise recall, more rows per band cut the candidates (see lsh_report)
+lsh_index = MinHashLSH(
+    bands=getattr(settings, 'HARMONY_LSH_BANDS', 64),
+    rows=getattr(settings, 'HARMONY_LSH_ROWS', 1),
+)
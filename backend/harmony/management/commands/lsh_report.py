@@ -0,0 +1,138 @@
+# harmony/management/commands/lsh_report.py
+from collections import defaultdict
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from harmony.lsh import MinHashLSH
+from harmony.matching_engine import DIMENSIONS, MatchingEngine, PreferenceMatrix
+
+# same cut-off get_full_matches uses for what counts as a match
+MATCH_THRESHOLD = 0.3
+
+
+def synthetic_preferences(users, items, prefs, clusters, seed):
+    """
+    {user_id: {dimension: {item_id: weight}}} with zipf distributed item popularity.
+    every user mostly picks from its taste cluster so there are real matches to find
+    """
+    generator = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, items + 1)
+    popularity /= popularity.sum()
+
+    cluster_items = [
+        generator.choice(items, size=min(4 * prefs, items), replace=False, p=popularity)
+        for _ in range(clusters)
+    ]
+    data = {}
+    for user_id in range(1, users + 1):
+        pool = cluster_items[generator.integers(clusters)]
+        user_prefs = defaultdict(dict)
+        for name, _, _ in DIMENSIONS:
+            own = generator.choice(pool, size=prefs, replace=False)
+            random = generator.choice(items, size=prefs // 4, p=popularity)
+            for item_id in np.concatenate([own, random]):
+                user_prefs[name][int(item_id) + 1] = int(generator.integers(1, 11))
+        data[user_id] = user_prefs
+    return data
+
+
+class Command(BaseCommand):
+    help = 'recall vs latency of the minhash/lsh matching mode against exact matching, on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--items', type=int, default=5000, help='items per dimension')
+        parser.add_argument('--prefs', type=int, default=20, help='preferences per user and dimension')
+        parser.add_argument('--clusters', type=int, default=20, help='taste clusters users are drawn from')
+        parser.add_argument('--queries', type=int, default=100, help='users to look up per configuration')
+        parser.add_argument('--configs', default='32x1,64x1,128x1,64x2,128x2', help='comma separated BANDSxROWS')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        try:
+            configs = [tuple(int(part) for part in config.split('x')) for config in options['configs'].split(',')]
+        except ValueError:
+            raise CommandError('--configs must look like 32x4,16x2')
+
+        data = synthetic_preferences(
+            options['users'], options['items'], options['prefs'], options['clusters'], options['seed']
+        )
+        self.stdout.write(
+            f"{options['users']} users, {options['items']} items and "
+            f"{options['prefs']} preferences per dimension, {options['queries']} queries"
+        )
+
+        # inverted index, the candidate source of the exact mode
+        item_users = defaultdict(set)
+        for user_id, user_prefs in data.items():
+            for name, items in user_prefs.items():
+                for item_id in items:
+                    item_users[name, item_id].add(user_id)
+
+        generator = np.random.default_rng(options['seed'])
+        queries = generator.choice(sorted(data), size=min(options['queries'], len(data)), replace=False)
+
+        def sharing(user_id):
+            found = set()
+            for name, items in data[user_id].items():
+                for item_id in items:
+                    found |= item_users[name, item_id]
+            found.discard(user_id)
+            return found
+
+        def rescore(user_id, candidates):
+            # the exact engine over the candidates only, as match_table.score_candidates does
+            engine = MatchingEngine({
+                name: PreferenceMatrix.from_rows(
+                    (other_id, item_id, weight)
+                    for other_id in candidates | {user_id}
+                    for item_id, weight in data[other_id][name].items()
+                )
+                for name, _, _ in DIMENSIONS
+            })
+            return {
+                other_id
+                for other_id, parts in engine.component_scores(user_id).items()
+                if parts.combine() > MATCH_THRESHOLD
+            }
+
+        expected, exact_seconds, exact_candidates = {}, 0.0, 0
+        for user_id in queries:
+            start = time.perf_counter()
+            candidates = sharing(user_id)
+            expected[user_id] = rescore(user_id, candidates)
+            exact_seconds += time.perf_counter() - start
+            exact_candidates += len(candidates)
+
+        self.stdout.write(
+            f"{'mode':<14}{'recall':>8}{'candidates':>12}{'ms/query':>10}{'build s':>9}"
+        )
+        self.stdout.write(
+            f"{'exact':<14}{1.0:>8.3f}{exact_candidates / len(queries):>12.1f}"
+            f"{1000 * exact_seconds / len(queries):>10.2f}{'-':>9}"
+        )
+
+        for bands, rows in configs:
+            index = MinHashLSH(bands=bands, rows=rows, seed=options['seed'])
+            start = time.perf_counter()
+            for user_id, user_prefs in data.items():
+                index.add(user_id, user_prefs)
+            build_seconds = time.perf_counter() - start
+
+            found, wanted, seconds, candidate_count = 0, 0, 0.0, 0
+            for user_id in queries:
+                start = time.perf_counter()
+                candidates = index.query(user_id)
+                matches = rescore(user_id, candidates)
+                seconds += time.perf_counter() - start
+                candidate_count += len(candidates)
+                found += len(matches & expected[user_id])
+                wanted += len(expected[user_id])
+
+            recall = found / wanted if wanted else 1.0
+            self.stdout.write(
+                f"{f'lsh {bands}x{rows}':<14}{recall:>8.3f}{candidate_count / len(queries):>12.1f}"
+                f"{1000 * seconds / len(queries):>10.2f}{build_seconds:>9.2f}"
+            )
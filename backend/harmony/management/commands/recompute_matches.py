@@ -0,0 +1,192 @@
+# harmony/management/commands/recompute_matches.py
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from harmony.models import User, Match, MatchScore, MatchScoreStatus, PairSimilarity
+from harmony.matching_engine import MatchingEngine
+from harmony.candidate_index import get_preference_version
+from harmony.match_table import weights_for, top_k, score_row
+from harmony.snapshot import snapshot_dir, current_snapshot_name, load_snapshot
+
+# set once per worker process by init_worker
+_engine = None
+
+
+def init_worker(matrices=None, snapshot=None):
+    """
+    gets the matrices pickled, or the (directory, name) of a snapshot to memory-map so
+    all workers share one copy
+    """
+    global _engine
+    import django
+    django.setup()  # already set up when the pool forks, needed when it spawns
+    if snapshot is not None:
+        _engine = load_snapshot(*snapshot).engine
+    else:
+        _engine = MatchingEngine(matrices)
+
+
+def score_chunk(chunk):
+    """
+    scores every user of the chunk against everyone. returns
+    [(user_id, candidates scored, top-K rows, {higher_user_id: components})],
+    each unordered pair being returned once, by its lower user id
+    """
+    results = []
+    for user_id, weights in chunk:
+        components = _engine.component_scores(user_id)
+        pairs = {other_id: parts for other_id, parts in components.items() if other_id > user_id}
+        results.append((user_id, len(components), top_k(components, weights), pairs))
+    return results
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise CommandError('--shard must look like i/n, e.g. 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise CommandError('--shard needs 0 <= i < n')
+    return index, count
+
+
+class Command(BaseCommand):
+    help = 'recomputes the persisted match scores of every user, or of one shard of the users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', default='0/1', help='i/n, only recompute users whose id % n == i')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='0 scores in this process')
+        parser.add_argument('--chunk-size', type=int, default=200, help='users per worker task')
+        parser.add_argument(
+            '--from-snapshot', action='store_true',
+            help='score from the current preference matrix snapshot instead of the database'
+        )
+
+    def handle(self, *args, **options):
+        shard, shard_count = parse_shard(options['shard'])
+        chunk_size = max(options['chunk_size'], 1)
+
+        # everyone is scored against everyone, only the users of this shard get written
+        if options['from_snapshot']:
+            directory = snapshot_dir()
+            name = current_snapshot_name(directory) if directory else None
+            if name is None:
+                raise CommandError('no snapshot, run write_matching_snapshot first')
+            worker_args = {'snapshot': (directory, name)}
+            self.stdout.write(f'scoring from snapshot {name}')
+            if load_snapshot(directory, name).preference_version != get_preference_version():
+                self.stdout.write(self.style.WARNING('preferences changed since the snapshot was written'))
+        else:
+            worker_args = {'matrices': MatchingEngine.from_db().matrices}
+        total_users = User.objects.count()
+        user_ids = [
+            user_id for user_id in User.objects.order_by('id').values_list('id', flat=True)
+            if user_id % shard_count == shard
+        ]
+        weights = weights_for(user_ids)
+        chunks = [
+            [(user_id, weights[user_id]) for user_id in user_ids[start:start + chunk_size]]
+            for start in range(0, len(user_ids), chunk_size)
+        ]
+        self.stdout.write(
+            f'recomputing {len(user_ids)} of {total_users} users (shard {shard}/{shard_count}) '
+            f'in {len(chunks)} chunks'
+        )
+
+        self.started = time.perf_counter()
+        self.users_done = self.pairs_done = 0
+        if options['workers'] == 0:
+            init_worker(**worker_args)
+            for chunk in chunks:
+                self.write_results(score_chunk(chunk), total_users, len(user_ids))
+        else:
+            # workers never touch the database, don't hand them our connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                initializer=init_worker,
+                initargs=(worker_args.get('matrices'), worker_args.get('snapshot')),
+            ) as pool:
+                futures = [pool.submit(score_chunk, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    self.write_results(future.result(), total_users, len(user_ids))
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f'done: {self.users_done} users, {self.pairs_done} pairs in {elapsed:.1f}s '
+            f'({self.pairs_done / elapsed if elapsed else 0:.0f} pairs/s)'
+        ))
+
+    def write_results(self, results, total_users, shard_users):
+        """
+        bulk writes one chunk: top-K tables, statuses, pair similarities and the
+        breakdown of existing matches whose lower user id is in the chunk
+        """
+        user_ids = [user_id for user_id, _, _, _ in results]
+        pairs = {user_id: user_pairs for user_id, _, _, user_pairs in results}
+        now = timezone.now()
+
+        # matches are stored lower id first, so the chunk owns the ones whose user1 is in it
+        matches = list(Match.objects.filter(user1_id__in=user_ids))
+        updated_matches = []
+        for match in matches:
+            parts = pairs.get(match.user1_id, {}).get(match.user2_id)
+            if parts is None:
+                continue
+            match.genre_match, match.artist_match, match.song_match = parts
+            # a match is shared by both users, so its percentage ignores either one's weights
+            match.compatibilty_score = round(100 * sum(parts) / 3, 1)
+            updated_matches.append(match)
+
+        with transaction.atomic():
+            MatchScore.objects.filter(user_id__in=user_ids).delete()
+            MatchScore.objects.bulk_create([
+                score_row(user_id, other_id, final_score, parts)
+                for user_id, _, best, _ in results
+                for final_score, other_id, parts in best
+            ], batch_size=1000)
+
+            PairSimilarity.objects.filter(user_low_id__in=user_ids).delete()
+            PairSimilarity.objects.bulk_create([
+                PairSimilarity(
+                    user_low_id=user_id, user_high_id=other_id,
+                    genre_sim=parts.genre, artist_sim=parts.artist, song_sim=parts.song,
+                )
+                for user_id, user_pairs in pairs.items()
+                for other_id, parts in user_pairs.items()
+            ], batch_size=1000)
+
+            MatchScoreStatus.objects.bulk_create(
+                [
+                    MatchScoreStatus(
+                        user_id=user_id,
+                        dirty=False,
+                        pairs_cached=True,
+                        computed_at=now,
+                        candidates_scored=scored,
+                        candidates_pruned=max(total_users - 1 - scored, 0),
+                    )
+                    for user_id, scored, _, _ in results
+                ],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['dirty', 'pairs_cached', 'computed_at', 'candidates_scored', 'candidates_pruned'],
+            )
+
+            if updated_matches:
+                Match.objects.bulk_update(
+                    updated_matches, ['compatibilty_score', 'genre_match', 'artist_match', 'song_match']
+                )
+
+        self.users_done += len(results)
+        self.pairs_done += sum(len(user_pairs) for user_pairs in pairs.values())
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f'{self.users_done}/{shard_users} users, {self.pairs_done} pairs, '
+            f'{self.pairs_done / elapsed if elapsed else 0:.0f} pairs/s'
+        )
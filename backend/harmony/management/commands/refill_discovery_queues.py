@@ -0,0 +1,41 @@
+# harmony/management/commands/refill_discovery_queues.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from harmony.checks import per_process_backends
+from harmony.models import DiscoveryQueue
+from harmony.discovery_queue import refill_queue
+
+
+class Command(BaseCommand):
+    help = 'background worker that refills the discovery queues that ran below their low-water mark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='refill what is pending and exit')
+        parser.add_argument('--interval', type=float, default=5.0, help='seconds to sleep when nothing is pending')
+        parser.add_argument('--batch', type=int, default=100, help='queues refilled per pass')
+
+    def refill_pending(self, batch):
+        user_ids = list(
+            DiscoveryQueue.objects.filter(needs_refill=True)
+            .order_by('refilled_at', 'user_id')
+            .values_list('user_id', flat=True)[:batch]
+        )
+        for user_id in user_ids:
+            refill_queue(user_id)
+        return len(user_ids)
+
+    def handle(self, *args, **options):
+        # its candidate index would never learn about preference changes made by the web process
+        if 'CACHES' in per_process_backends():
+            raise CommandError('CACHES must be shared with the web process, set REDIS_URL')
+
+        while True:
+            refilled = self.refill_pending(options['batch'])
+            if refilled:
+                self.stdout.write(f'refilled {refilled} discovery queues')
+            if options['once']:
+                break
+            if refilled < options['batch']:
+                time.sleep(options['interval'])
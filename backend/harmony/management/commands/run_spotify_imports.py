@@ -0,0 +1,33 @@
+# harmony/management/commands/run_spotify_imports.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from harmony.checks import per_process_backends
+from harmony.spotify_import import claim_next_job, run_import
+
+
+class Command(BaseCommand):
+    help = 'background worker that imports new users\' spotify top tracks and artists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='run what is pending and exit')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when nothing is pending')
+
+    def handle(self, *args, **options):
+        # the web process would never see the imported preferences or push the job's status
+        per_process = per_process_backends()
+        if per_process:
+            raise CommandError(
+                f'{" and ".join(per_process)} must be shared with the web process, set REDIS_URL'
+            )
+
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+            run_import(job)
+            self.stdout.write(f'{job}')
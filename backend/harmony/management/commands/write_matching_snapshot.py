@@ -0,0 +1,20 @@
+# harmony/management/commands/write_matching_snapshot.py
+from django.core.management.base import BaseCommand, CommandError
+
+from harmony.snapshot import snapshot_dir, write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'writes a new memory-mapped snapshot of the preference matrices for recompute_matches --from-snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='defaults to settings.HARMONY_MATCHING_SNAPSHOT_DIR')
+        parser.add_argument('--keep', type=int, default=3, help='snapshots to keep, the newest first')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or snapshot_dir()
+        if not directory:
+            raise CommandError('set HARMONY_MATCHING_SNAPSHOT_DIR or pass --dir')
+
+        name = write_snapshot(directory, keep=options['keep'])
+        self.stdout.write(self.style.SUCCESS(f'wrote snapshot {name} to {directory}'))
@@ -0,0 +1,418 @@
+# harmony/match_table.py
+import base64
+import heapq
+import itertools
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import User, Match, MatchRejection, MatchScore, MatchScoreStatus, MatchWeightSettings, PairSimilarity
+from .matching_engine import MatchingEngine, MatchComponents
+from .candidate_index import candidate_index
+from .lsh import lsh_index
+
+# how many compatibility results are persisted per user
+TOP_K = getattr(settings, 'HARMONY_MATCH_TOP_K', 100)
+
+# 'exact' scores everyone sharing an item, 'approximate' only the minhash/lsh candidates
+MATCHING_MODE = getattr(settings, 'HARMONY_MATCHING_MODE', 'exact')
+
+DEFAULT_WEIGHTS = (1.0, 1.0, 1.0)
+
+# page size of the full matches endpoint, and the most a client may ask for
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def weights_for(user_ids):
+    """
+    returns {user_id: (genre_weight, artist_weight, song_weight)}, defaults for users without settings
+    """
+    weights = {user_id: DEFAULT_WEIGHTS for user_id in user_ids}
+    rows = MatchWeightSettings.objects.filter(user_id__in=user_ids).values_list(
+        'user_id', 'genre_weight', 'artist_weight', 'song_weight'
+    )
+    for user_id, genre_weight, artist_weight, song_weight in rows:
+        weights[user_id] = (genre_weight, artist_weight, song_weight)
+    return weights
+
+
+def candidate_ids(user_id):
+    if MATCHING_MODE == 'approximate':
+        return lsh_index.candidates(user_id)
+    return candidate_index.candidates(user_id)
+
+
+def score_candidates(user_id):
+    """
+    component similarities of user_id against its candidates, scored exactly.
+    returns (components, candidates scored, candidates pruned)
+    """
+    candidates = candidate_ids(user_id)
+    pruned = max(User.objects.count() - 1 - len(candidates), 0)
+    candidate_index.record_pruning(len(candidates), pruned)
+
+    # only the rows of these users, from the database
+    components = MatchingEngine.from_db(user_ids=candidates | {user_id}).component_scores(user_id)
+    return components, len(candidates), pruned
+
+
+def top_k(components, weights, k=None):
+    """
+    best k (final_score, other_id, components) by score, ties going to the lower user id
+    """
+    if k is None:
+        k = TOP_K
+    scored = (
+        (parts.combine(*weights), other_id, parts)
+        for other_id, parts in components.items()
+    )
+    return heapq.nsmallest(
+        k,
+        (entry for entry in scored if entry[0] > 0),
+        key=lambda entry: (-entry[0], entry[1]),
+    )
+
+
+def score_row(user_id, other_id, final_score, parts):
+    return MatchScore(
+        user_id=user_id,
+        candidate_id=other_id,
+        final_score=final_score,
+        genre_match=parts.genre,
+        artist_match=parts.artist,
+        song_match=parts.song,
+    )
+
+
+def upsert_rows(rows):
+    MatchScore.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['user', 'candidate'],
+        update_fields=['final_score', 'genre_match', 'artist_match', 'song_match', 'updated_at'],
+    )
+
+
+def store_components(user_id, components):
+    """
+    replaces every cached PairSimilarity row involving user_id
+    """
+    rows = [
+        PairSimilarity(
+            user_low_id=min(user_id, other_id),
+            user_high_id=max(user_id, other_id),
+            genre_sim=parts.genre,
+            artist_sim=parts.artist,
+            song_sim=parts.song,
+        )
+        for other_id, parts in components.items()
+    ]
+    with transaction.atomic():
+        PairSimilarity.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).delete()
+        PairSimilarity.objects.bulk_create(rows)
+
+
+def cached_components(user_id):
+    """
+    returns {other_user_id: MatchComponents} from the cached pair similarities
+    """
+    rows = PairSimilarity.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).values_list(
+        'user_low_id', 'user_high_id', 'genre_sim', 'artist_sim', 'song_sim'
+    )
+    return {
+        (user_high if user_low == user_id else user_low): MatchComponents(genre_sim, artist_sim, song_sim)
+        for user_low, user_high, genre_sim, artist_sim, song_sim in rows
+    }
+
+
+def write_table(user_id, components, weights, scored=0, pruned=0):
+    best = top_k(components, weights)
+    with transaction.atomic():
+        MatchScore.objects.filter(user_id=user_id).delete()
+        MatchScore.objects.bulk_create([
+            score_row(user_id, other_id, final_score, parts)
+            for final_score, other_id, parts in best
+        ])
+        MatchScoreStatus.objects.update_or_create(
+            user_id=user_id,
+            defaults={
+                'dirty': False,
+                'pairs_cached': True,
+                'computed_at': timezone.now(),
+                'candidates_scored': scored,
+                'candidates_pruned': pruned,
+            }
+        )
+
+
+def refresh_match_table(user_id):
+    """
+    recomputes user_id's own top-K table from scratch
+    """
+    components, scored, pruned = score_candidates(user_id)
+    with transaction.atomic():
+        store_components(user_id, components)
+        write_table(user_id, components, weights_for([user_id])[user_id], scored, pruned)
+
+
+def rerank_match_table(user_id):
+    """
+    rebuilds user_id's table by recombining the cached pair similarities with its current
+    weights. no preference is read and nothing is rescored. returns False when the pairs
+    aren't cached yet and the table has to be refreshed instead
+    """
+    score_status = MatchScoreStatus.objects.filter(user_id=user_id, pairs_cached=True).first()
+    if score_status is None:
+        return False
+
+    write_table(
+        user_id,
+        cached_components(user_id),
+        weights_for([user_id])[user_id],
+        score_status.candidates_scored,
+        score_status.candidates_pruned,
+    )
+    return True
+
+
+def ensure_match_table(user_id):
+    """
+    makes user_id's table servable: computed on first use, re-ranked when dirty.
+    returns its MatchScoreStatus
+    """
+    score_status = MatchScoreStatus.objects.filter(user_id=user_id).first()
+    if score_status is not None and not score_status.dirty:
+        return score_status
+
+    if score_status is None or not rerank_match_table(user_id):
+        refresh_match_table(user_id)
+    return MatchScoreStatus.objects.get(user_id=user_id)
+
+
+def outranks(score, user_id, row):
+    # table order is score descending, then candidate id ascending
+    return (score, -user_id) > (row.final_score, -row.candidate_id)
+
+
+def update_reverse_entries(user_id, components, weights, owners):
+    """
+    patches user_id's row inside the tables of every other user it now scores against,
+    or used to. tables that can't be patched exactly are marked dirty and re-ranked on read
+    """
+    live = set(
+        MatchScoreStatus.objects.filter(user_id__in=owners, dirty=False).values_list('user_id', flat=True)
+    )
+    if not live:
+        return
+
+    current = dict(
+        MatchScore.objects.filter(user_id__in=live, candidate_id=user_id).values_list('user_id', 'final_score')
+    )
+    sizes = {
+        row['user_id']: row['size']
+        for row in MatchScore.objects.filter(user_id__in=live).values('user_id').annotate(size=Count('id'))
+    }
+
+    to_write, to_delete, now_dirty = [], [], []
+    contenders = {}  # owner: (new score, parts) for full tables user_id may push into
+    for owner in live:
+        parts = components.get(owner)
+        new_score = parts.combine(*weights[owner]) if parts else 0.0
+        old_score = current.get(owner)
+        full = sizes.get(owner, 0) >= TOP_K
+
+        if old_score is not None:
+            if new_score <= 0:
+                to_delete.append(owner)
+            else:
+                to_write.append(score_row(owner, user_id, new_score, parts))
+            # someone just outside the table may now rank above this entry
+            if full and new_score < old_score:
+                now_dirty.append(owner)
+        elif new_score > 0:
+            if not full:
+                to_write.append(score_row(owner, user_id, new_score, parts))
+            else:
+                contenders[owner] = (new_score, parts)
+
+    # the lowest row of every full table user_id may enter, in one query
+    evicted = []
+    for lowest in lowest_rows(contenders):
+        new_score, parts = contenders[lowest.user_id]
+        if outranks(new_score, user_id, lowest):
+            evicted.append(lowest.id)
+            to_write.append(score_row(lowest.user_id, user_id, new_score, parts))
+
+    with transaction.atomic():
+        if to_delete:
+            MatchScore.objects.filter(user_id__in=to_delete, candidate_id=user_id).delete()
+        if evicted:
+            MatchScore.objects.filter(id__in=evicted).delete()
+        if to_write:
+            upsert_rows(to_write)
+        if now_dirty:
+            MatchScoreStatus.objects.filter(user_id__in=now_dirty).update(dirty=True)
+
+
+def lowest_rows(owners):
+    """
+    the last row in table order of every owner's table, ranked with
+    ROW_NUMBER() OVER (PARTITION BY user ORDER BY score, candidate id DESC)
+    """
+    if not owners:
+        return []
+    return list(MatchScore.objects.filter(user_id__in=owners).annotate(
+        rank=Window(
+            expression=RowNumber(),
+            partition_by=[F('user_id')],
+            order_by=[F('final_score').asc(), F('candidate_id').desc()],
+        )
+    ).filter(rank=1))
+
+
+def rescore_user(user_id):
+    """
+    called after user_id's preferences changed: recomputes user_id's table and user_id's
+    entry in everyone else's table. no other pair is rescored
+    """
+    if not User.objects.filter(id=user_id).exists():
+        return  # deleted, its rows went with it
+
+    components, scored, pruned = score_candidates(user_id)
+    owners = set(components) | set(
+        MatchScore.objects.filter(candidate_id=user_id).values_list('user_id', flat=True)
+    )
+    weights = weights_for(owners | {user_id})
+
+    with transaction.atomic():
+        store_components(user_id, components)
+        write_table(user_id, components, weights[user_id], scored, pruned)
+    update_reverse_entries(user_id, components, weights, owners)
+
+
+def mark_dirty(user_id):
+    MatchScoreStatus.objects.filter(user_id=user_id).update(dirty=True)
+
+
+# latest pending rescore per user for this thread, so a transaction touching many
+# preferences of one user (e.g. the spotify import) only rescores it once
+_pending = threading.local()
+_tokens = itertools.count()
+
+
+def schedule_rescore(user_id):
+    """
+    rescores user_id once the current transaction commits
+    """
+    if not hasattr(_pending, 'latest'):
+        _pending.latest = {}
+    token = next(_tokens)
+    _pending.latest[user_id] = token
+
+    def run():
+        if _pending.latest.get(user_id) != token:
+            return  # a later change in the same transaction will do it
+        del _pending.latest[user_id]
+        rescore_user(user_id)
+
+    transaction.on_commit(run)
+
+
+def encode_cursor(final_score, candidate_id):
+    # opaque to clients, points just past the last row of a page
+    return base64.urlsafe_b64encode(f'{final_score!r}:{candidate_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    returns (final_score, candidate_id), raises ValueError for anything we didn't hand out
+    """
+    try:
+        final_score, candidate_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return float(final_score), int(candidate_id)
+    except (ValueError, UnicodeError) as exc:
+        raise ValueError('invalid cursor') from exc
+
+
+def page_of_scores(user_id, min_score, limit, cursor=None):
+    """
+    one page of user_id's table in table order (score descending, candidate id ascending),
+    seeking past `cursor` instead of using an offset so pages stay stable and every page
+    costs the same. returns (rows, next cursor or None)
+    """
+    scores = MatchScore.objects.filter(user_id=user_id, final_score__gt=min_score)
+    if cursor is not None:
+        final_score, candidate_id = decode_cursor(cursor)
+        scores = scores.filter(
+            Q(final_score__lt=final_score) | Q(final_score=final_score, candidate_id__gt=candidate_id)
+        )
+    rows = list(
+        scores.select_related('candidate').order_by('-final_score', 'candidate_id')[:limit + 1]
+    )
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].final_score, rows[-1].candidate_id)
+    return rows, next_cursor
+
+
+def unseen_by(queryset, user_id, field):
+    """
+    drops the rows whose `field` is user_id itself, a user it matched with or one it
+    rejected. the checks are NOT EXISTS subqueries answered from the match pair indexes
+    and the rejection index, so the query doesn't grow with the users already swiped
+    """
+    other = OuterRef(field)
+    # a match is stored once, lower id first, but which side user_id is on depends on the other id
+    return queryset.exclude(**{field: user_id}).filter(
+        ~Exists(Match.objects.filter(user1_id=user_id, user2_id=other)),
+        ~Exists(Match.objects.filter(user1_id=other, user2_id=user_id)),
+        ~Exists(MatchRejection.objects.filter(user1_id=user_id, user2_id=other)),
+    )
+
+
+def discovery_page(user_id, limit, cursor=None, also_excluded=None):
+    """
+    one page of user_id's discovery deck: everyone it hasn't matched or rejected yet,
+    best match score first, then everyone else by id. only the top TOP_K scores are
+    persisted, so that tail is unranked: it mixes users who share nothing with user_id
+    and users just below the table, and their score is None rather than a made up 0.
+    also_excluded is an optional subquery (or small list) of more ids to leave out.
+    returns ([(user, score or None)], next cursor)
+    """
+    last_score, last_id = decode_cursor(cursor) if cursor is not None else (None, None)
+    scored = MatchScore.objects.filter(user_id=user_id)
+
+    page = []
+    if last_score is None or last_score > 0:
+        rows = unseen_by(scored, user_id, 'candidate_id')
+        if also_excluded is not None:
+            rows = rows.exclude(candidate_id__in=also_excluded)
+        if last_score is not None:
+            rows = rows.filter(Q(final_score__lt=last_score) | Q(final_score=last_score, candidate_id__gt=last_id))
+        rows = rows.select_related('candidate').order_by('-final_score', 'candidate_id')[:limit + 1]
+        page = [(row.candidate, row.final_score) for row in rows]
+        last_id = None  # the unscored users start from the lowest id
+
+    if len(page) <= limit:
+        unscored = unseen_by(User.objects.all(), user_id, 'id') \
+            .exclude(id__in=scored.values('candidate_id'))
+        if also_excluded is not None:
+            unscored = unscored.exclude(id__in=also_excluded)
+        if last_id is not None:
+            unscored = unscored.filter(id__gt=last_id)
+        page += [(user, None) for user in unscored.order_by('id')[:limit + 1 - len(page)]]
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        user, score = page[-1]
+        # table scores are all above 0, so 0 marks a cursor inside the unranked tail
+        next_cursor = encode_cursor(score if score is not None else 0.0, user.id)
+    return page, next_cursor
@@ -0,0 +1,183 @@
+# harmony/matching_engine.py
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+from .models import (
+    UserGenrePreference,
+    UserArtistPreference,
+    UserSongPreference
+)
+
+# every preference table that takes part in matching: (dimension, model, item field)
+DIMENSIONS = (
+    ('genre', UserGenrePreference, 'genre'),
+    ('artist', UserArtistPreference, 'artist'),
+    ('song', UserSongPreference, 'song'),
+)
+
+
+def preference_rows(model, field_name, user_ids=None):
+    """
+    (user_id, item_id, weight) of one preference table in a single query, for the whole
+    table or only the given users
+    """
+    prefs = model.objects.order_by()  # no default ordering, it joins the item table
+    if user_ids is not None:
+        prefs = prefs.filter(user_id__in=user_ids)
+    return prefs.values_list('user_id', f'{field_name}_id', 'weight')
+
+
+class MatchComponents(namedtuple('MatchComponents', ['genre', 'artist', 'song'])):
+    """
+    the three per-dimension similarities of a pair, independent of anyone's weight settings
+    """
+    __slots__ = ()
+
+    def combine(self, genre_weight=1.0, artist_weight=1.0, song_weight=1.0):
+        # same formula and rounding as matching_utils.compute_final_match_score
+        score = (
+            self.genre * genre_weight +
+            self.artist * artist_weight +
+            self.song * song_weight
+        )
+        return round(score, 3)
+
+
+class PreferenceMatrix:
+    """
+    sparse user x item weight matrix for one preference table.
+    rows follow user_ids and columns follow item_ids, both sorted ascending
+    """
+
+    def __init__(self, user_ids, item_ids, matrix):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        self.csr = sparse.csr_matrix(matrix)
+        # column slices (the items one user weighs) are cheap on the csc form
+        self.csc = self.csr.tocsc()
+        # per-user weight totals, the denominator of the similarity
+        self.totals = np.asarray(self.csr.sum(axis=1), dtype=np.int64).ravel()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        builds the matrix from (user_id, item_id, weight) rows
+        """
+        rows = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+        user_ids, user_pos = np.unique(rows[:, 0], return_inverse=True)
+        item_ids, item_pos = np.unique(rows[:, 1], return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (rows[:, 2], (user_pos, item_pos)),
+            shape=(len(user_ids), len(item_ids)),
+            dtype=np.int64,
+        )
+        return cls(user_ids, item_ids, matrix)
+
+    @classmethod
+    def from_arrays(cls, user_ids, item_ids, totals, csr, csc):
+        """
+        wraps arrays that are already built, e.g. memory-mapped from a snapshot, without
+        copying them. csr and csc are (data, indices, indptr) triples
+        """
+        shape = (len(user_ids), len(item_ids))
+        matrix = cls.__new__(cls)
+        matrix.user_ids = user_ids
+        matrix.item_ids = item_ids
+        matrix.totals = totals
+        matrix.csr = sparse.csr_matrix(csr, shape=shape, copy=False)
+        matrix.csc = sparse.csc_matrix(csc, shape=shape, copy=False)
+        return matrix
+
+    @classmethod
+    def from_model(cls, model, field_name, user_ids=None):
+        return cls.from_rows(preference_rows(model, field_name, user_ids))
+
+    def row_of(self, user_id):
+        pos = np.searchsorted(self.user_ids, user_id)
+        if pos < len(self.user_ids) and self.user_ids[pos] == user_id:
+            return pos
+        return None
+
+    def similarity(self, user_id):
+        """
+        min-overlap similarity of user_id against every row of the matrix in one pass.
+        returns (user_ids, similarities) for the rows that share at least one item
+        """
+        row = self.row_of(user_id)
+        if row is None:
+            return self.user_ids[:0], np.zeros(0)
+
+        start, end = self.csr.indptr[row], self.csr.indptr[row + 1]
+        items = self.csr.indices[start:end]
+        weights = self.csr.data[start:end]
+
+        # every other user's weights for the items this user has
+        shared = self.csc[:, items]
+        column_of_entry = np.repeat(np.arange(len(items)), np.diff(shared.indptr))
+        lowest = np.minimum(shared.data, weights[column_of_entry])
+
+        rows = np.unique(shared.indices)
+        numerator = np.bincount(shared.indices, weights=lowest, minlength=len(self.user_ids))[rows]
+        denominator = self.totals[row] + self.totals[rows]
+
+        similarity = np.divide(
+            2 * numerator, denominator,
+            out=np.zeros(len(rows)), where=denominator > 0,
+        )
+        return self.user_ids[rows], similarity
+
+
+class MatchingEngine:
+    """
+    scores one user against every other user from the three preference matrices,
+    giving the same numbers as compute_final_match_score without per-pair queries
+    """
+
+    def __init__(self, matrices):
+        self.matrices = matrices  # dimension name -> PreferenceMatrix
+
+    @classmethod
+    def from_db(cls, user_ids=None):
+        """
+        loads the preference matrices, restricted to user_ids when given
+        """
+        return cls({
+            name: PreferenceMatrix.from_model(model, field_name, user_ids=user_ids)
+            for name, model, field_name in DIMENSIONS
+        })
+
+    def component_scores(self, user_id):
+        """
+        returns {other_user_id: MatchComponents} for every user sharing at least one
+        genre, artist or song with user_id
+        """
+        per_dimension = {}
+        for name, _, _ in DIMENSIONS:
+            other_ids, similarity = self.matrices[name].similarity(user_id)
+            # python round keeps the result identical to compute_weighted_similarity
+            per_dimension[name] = {
+                int(other_id): round(float(value), 3)
+                for other_id, value in zip(other_ids, similarity)
+            }
+
+        other_ids = set().union(*per_dimension.values())
+        other_ids.discard(user_id)
+        return {
+            other_id: MatchComponents(
+                genre=per_dimension['genre'].get(other_id, 0.0),
+                artist=per_dimension['artist'].get(other_id, 0.0),
+                song=per_dimension['song'].get(other_id, 0.0),
+            )
+            for other_id in other_ids
+        }
+
+    def score_user(self, user_id, genre_weight=1.0, artist_weight=1.0, song_weight=1.0):
+        """
+        returns {other_user_id: final score} using the given weight settings
+        """
+        return {
+            other_id: components.combine(genre_weight, artist_weight, song_weight)
+            for other_id, components in self.component_scores(user_id).items()
+        }
@@ -1,49 +1,58 @@
+from django.db.models import F, Sum
+from django.db.models.functions import Least
+
 from .models import (
     UserGenrePreference,
     UserArtistPreference,
-    UserSongPreference
+    UserSongPreference,
+    UserPreferenceTotals
 )
+from .preference_totals import totals_for
 # calculates a similarity score btwn 0 and 1 for song, genre, artist and compute final similarity score taking weigts into account
-def compute_weighted_similarity(model, field_name, user_a, user_b):
-
-    a_prefs = model.objects.filter(user=user_a)
-    b_prefs = model.objects.filter(user=user_b)
+def compute_weighted_similarity(model, field_name, user_a, user_b, sets=None):
+    a_id = getattr(user_a, 'pk', user_a)
+    b_id = getattr(user_b, 'pk', user_b)
 
-    a_dict = {getattr(pref, f"{field_name}_id"): pref.weight for pref in a_prefs}
-    b_dict = {getattr(pref, f"{field_name}_id"): pref.weight for pref in b_prefs}
+    # preloaded compact preference sets (see preference_sets.PreferenceSets), no queries
+    if sets is not None:
+        return sets[field_name].similarity(a_id, b_id)
 
-    # things in common
-    shared_items = set(a_dict.keys()) & set(b_dict.keys())
-    if not shared_items:
+    # things in common: join a's preferences to b's on the item and pick the lowest
+    # preference for each matching thing, without loading either full list
+    other = f"{field_name}__{model._meta.model_name}"
+    numerator = model.objects.filter(user_id=a_id, **{f"{other}__user_id": b_id}) \
+        .aggregate(numerator=Sum(Least('weight', f"{other}__weight")))['numerator']
+    if not numerator:
         return 0.0
 
-    # pick the lowest preference for each matching thing
-    numerator = sum(min(a_dict[item], b_dict[item]) for item in shared_items)
-    denominator = sum(a_dict.values()) + sum(b_dict.values())
+    # both users' full weight totals come from the denormalized totals table
+    totals = totals_for(field_name, [a_id, b_id])
+    denominator = totals[a_id] + totals[b_id]
 
     similarity = (2 * numerator) / denominator
     return round(similarity, 3)
 
-def compute_genre_similarity(user_a, user_b):
-    return compute_weighted_similarity(UserGenrePreference, "genre", user_a, user_b)
+def compute_genre_similarity(user_a, user_b, sets=None):
+    return compute_weighted_similarity(UserGenrePreference, "genre", user_a, user_b, sets=sets)
 
-def compute_artist_similarity(user_a, user_b):
-    return compute_weighted_similarity(UserArtistPreference, "artist", user_a, user_b)
+def compute_artist_similarity(user_a, user_b, sets=None):
+    return compute_weighted_similarity(UserArtistPreference, "artist", user_a, user_b, sets=sets)
 
-def compute_song_similarity(user_a, user_b):
-    return compute_weighted_similarity(UserSongPreference, "song", user_a, user_b)
+def compute_song_similarity(user_a, user_b, sets=None):
+    return compute_weighted_similarity(UserSongPreference, "song", user_a, user_b, sets=sets)
 
 def compute_final_match_score(
     user_a, 
     user_b, 
     genre_weight=1.0, 
     artist_weight=1.0, 
-    song_weight=1.0
+    song_weight=1.0,
+    sets=None
 ):
 
-    genre_sim = compute_genre_similarity(user_a, user_b)
-    artist_sim = compute_artist_similarity(user_a, user_b)
-    song_sim = compute_song_similarity(user_a, user_b)
+    genre_sim = compute_genre_similarity(user_a, user_b, sets=sets)
+    artist_sim = compute_artist_similarity(user_a, user_b, sets=sets)
+    song_sim = compute_song_similarity(user_a, user_b, sets=sets)
 
     score = (
         genre_sim * genre_weight +
@@ -52,3 +61,64 @@ def compute_final_match_score(
     )
 
     return round(score, 3)
+
+
+# database-side alternative to the loops above: one user against every other user with
+# grouped queries instead of two preference queries per pair
+def compute_weighted_similarity_sql(model, field_name, user):
+    """
+    returns {other_user_id: similarity} for every user sharing at least one item with user,
+    using one aggregated self-join for the numerators and one lookup for the totals
+    """
+    user_id = getattr(user, 'pk', user)
+
+    # the same preference table joined back onto itself through the shared item
+    other = f"{field_name}__{model._meta.model_name}"
+
+    numerators = (
+        model.objects.filter(user_id=user_id)
+        .values(other_user=F(f"{other}__user_id"))
+        .annotate(numerator=Sum(Least('weight', f"{other}__weight")))
+        .order_by()
+        .values_list('other_user', 'numerator')
+    )
+    numerators = {other_id: numerator for other_id, numerator in numerators if other_id != user_id}
+    if not numerators:
+        return {}
+
+    # full weight totals of this user and of everyone sharing an item with them,
+    # read from the denormalized totals table in one indexed lookup
+    own_items = model.objects.filter(user_id=user_id).values(field_name)
+    sharing_users = model.objects.filter(**{f"{field_name}__in": own_items}).values('user_id')
+    totals = dict(
+        UserPreferenceTotals.objects.filter(user_id__in=sharing_users)
+        .values_list('user_id', f"{field_name}_total")
+    )
+    missing = ({user_id} | set(numerators)) - set(totals)
+    if missing:
+        totals.update(totals_for(field_name, missing))
+
+    return {
+        other_id: round((2 * numerator) / (totals[user_id] + totals[other_id]), 3)
+        for other_id, numerator in numerators.items()
+    }
+
+
+def compute_final_match_scores_sql(user, genre_weight=1.0, artist_weight=1.0, song_weight=1.0):
+    """
+    returns {other_user_id: final score} for user against everyone, same numbers as
+    compute_final_match_score
+    """
+    genre_sims = compute_weighted_similarity_sql(UserGenrePreference, "genre", user)
+    artist_sims = compute_weighted_similarity_sql(UserArtistPreference, "artist", user)
+    song_sims = compute_weighted_similarity_sql(UserSongPreference, "song", user)
+
+    scores = {}
+    for other_id in set(genre_sims) | set(artist_sims) | set(song_sims):
+        score = (
+            genre_sims.get(other_id, 0.0) * genre_weight +
+            artist_sims.get(other_id, 0.0) * artist_weight +
+            song_sims.get(other_id, 0.0) * song_weight
+        )
+        scores[other_id] = round(score, 3)
+    return scores
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0003_alter_spotifycredentials_expires_in'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchScoreStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dirty', models.BooleanField(default=False)),
+                ('computed_at', models.DateTimeField(blank=True, null=True)),
+                ('candidates_scored', models.IntegerField(default=0)),
+                ('candidates_pruned', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='match_score_status', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MatchScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('final_score', models.FloatField(default=0)),
+                ('genre_match', models.FloatField(default=0)),
+                ('artist_match', models.FloatField(default=0)),
+                ('song_match', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_scores', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-final_score', 'candidate'],
+                'indexes': [models.Index(fields=['user', '-final_score', 'candidate'], name='matchscore_user_rank_idx')],
+                'unique_together': {('user', 'candidate')},
+            },
+        ),
+    ]
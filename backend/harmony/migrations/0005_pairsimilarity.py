@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0004_matchscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchscorestatus',
+            name='pairs_cached',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='PairSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('genre_sim', models.FloatField(default=0)),
+                ('artist_sim', models.FloatField(default=0)),
+                ('song_sim', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.CheckConstraint(condition=models.Q(('user_low__lt', models.F('user_high'))), name='pairsimilarity_ordered_pair')],
+                'unique_together': {('user_low', 'user_high')},
+            },
+        ),
+    ]
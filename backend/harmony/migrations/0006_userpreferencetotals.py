@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_totals(apps, schema_editor):
+    User = apps.get_model('harmony', 'User')
+    UserPreferenceTotals = apps.get_model('harmony', 'UserPreferenceTotals')
+
+    totals = {user_id: {} for user_id in User.objects.values_list('id', flat=True)}
+    for name, model_name in [('genre', 'UserGenrePreference'), ('artist', 'UserArtistPreference'), ('song', 'UserSongPreference')]:
+        rows = apps.get_model('harmony', model_name).objects.values('user_id') \
+            .annotate(total=Sum('weight'), count=Count('id')).order_by()
+        for row in rows:
+            totals[row['user_id']][f'{name}_total'] = row['total']
+            totals[row['user_id']][f'{name}_count'] = row['count']
+
+    UserPreferenceTotals.objects.bulk_create(
+        [UserPreferenceTotals(user_id=user_id, **values) for user_id, values in totals.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0005_pairsimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPreferenceTotals',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('genre_total', models.IntegerField(default=0)),
+                ('genre_count', models.IntegerField(default=0)),
+                ('artist_total', models.IntegerField(default=0)),
+                ('artist_count', models.IntegerField(default=0)),
+                ('song_total', models.IntegerField(default=0)),
+                ('song_count', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='preference_totals', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
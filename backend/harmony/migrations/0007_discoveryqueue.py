@@ -0,0 +1,40 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0006_userpreferencetotals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscoveryQueue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.IntegerField(default=0)),
+                ('needs_refill', models.BooleanField(default=True)),
+                ('refilled_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='discovery_queue', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DiscoveryQueueEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.BigIntegerField()),
+                ('final_score', models.FloatField(default=0)),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', 'position'],
+                'indexes': [models.Index(fields=['user', 'position'], name='discoveryqueue_head_idx')],
+                'unique_together': {('user', 'candidate')},
+            },
+        ),
+    ]
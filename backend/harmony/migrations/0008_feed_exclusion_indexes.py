@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0007_discoveryqueue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['user1', 'user2'], name='match_user1_user2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['user2', 'user1'], name='match_user2_user1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='matchrejection',
+            index=models.Index(fields=['user1', 'user2'], name='matchrejection_pair_idx'),
+        ),
+    ]
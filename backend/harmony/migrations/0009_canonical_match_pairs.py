@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+def canonicalize_matches(apps, schema_editor):
+    """
+    keeps the oldest match of every pair, moves the messages of its duplicates into its
+    conversation and stores it lower user id first
+    """
+    Match = apps.get_model('harmony', 'Match')
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    # a user can't match with themselves, and the check constraint won't allow it
+    Match.objects.filter(user1_id=models.F('user2_id')).delete()
+
+    kept = {}
+    for match in Match.objects.order_by('created_at', 'id'):
+        pair = tuple(sorted((match.user1_id, match.user2_id)))
+        keeper = kept.setdefault(pair, match)
+        if keeper is match:
+            continue
+        if Conversation.objects.filter(match_id=match.id).exists():
+            conversation, _ = Conversation.objects.get_or_create(match_id=keeper.id)
+            Message.objects.filter(conversation_id=match.id).update(conversation_id=conversation.pk)
+        match.delete()
+
+    for (user1_id, user2_id), match in kept.items():
+        if match.user1_id != user1_id:
+            Match.objects.filter(id=match.id).update(user1_id=user1_id, user2_id=user2_id)
+
+
+# the constraints are added by 0009a, in a transaction of their own: on postgres the updates
+# above leave deferred foreign key checks pending, and the table can't be altered until they
+# are committed
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0008_feed_exclusion_indexes'),
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonicalize_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0009a_match_pair_constraints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userartistpreference',
+            index=models.Index(fields=['user', '-weight'], name='artistpref_user_weight_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usergenrepreference',
+            index=models.Index(fields=['user', '-weight'], name='genrepref_user_weight_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usersongpreference',
+            index=models.Index(fields=['user', '-weight'], name='songpref_user_weight_idx'),
+        ),
+    ]
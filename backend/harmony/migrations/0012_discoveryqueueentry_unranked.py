@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 14:33
+
+from django.db import migrations, models
+
+
+def unrank_tail(apps, schema_editor):
+    # table scores are above 0, a queued 0 was a candidate past the top-K
+    DiscoveryQueueEntry = apps.get_model('harmony', 'DiscoveryQueueEntry')
+    DiscoveryQueueEntry.objects.filter(final_score=0).update(final_score=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('harmony', '0011_spotifyimportjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='discoveryqueueentry',
+            name='final_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(unrank_tail, migrations.RunPython.noop),
+    ]
@@ -79,6 +79,8 @@ class UserSongPreference(models.Model):
     
     class Meta:
         unique_together = ['user', 'song']
+        # a user's preferences heaviest first (profile, top songs/artists of the deck cards)
+        indexes = [models.Index(fields=['user', '-weight'], name='songpref_user_weight_idx')]
     
     def __str__(self):
         return f"{self.user.username} - {self.song.name} (weight: {self.weight})"
@@ -96,6 +98,8 @@ class UserArtistPreference(models.Model):
     
     class Meta:
         unique_together = ['user', 'artist']
+        # a user's preferences heaviest first (profile, top songs/artists of the deck cards)
+        indexes = [models.Index(fields=['user', '-weight'], name='artistpref_user_weight_idx')]
     
     def __str__(self):
         return f"{self.user.username} - {self.artist.name} (weight: {self.weight})"
@@ -113,11 +117,27 @@ class UserGenrePreference(models.Model):
     class Meta:
         unique_together = ['user', 'genre']
         ordering = ['-weight', 'genre__name']
+        indexes = [models.Index(fields=['user', '-weight'], name='genrepref_user_weight_idx')]
     
     def __str__(self):
         return f"{self.user.username} - {self.genre.name} (weight: {self.weight})"
 
 
+# running weight totals and item counts of each user's preferences, kept in step with the
+# three preference tables so scoring never has to reload a full list for the denominator
+class UserPreferenceTotals(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='preference_totals')
+    genre_total = models.IntegerField(default=0)
+    genre_count = models.IntegerField(default=0)
+    artist_total = models.IntegerField(default=0)
+    artist_count = models.IntegerField(default=0)
+    song_total = models.IntegerField(default=0)
+    song_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Preference totals for {self.user.username}"
+
+
 class SpotifyCredentials(models.Model):
     user = models.OneToOneField(  # Changed from ForeignKey!
         User, 
@@ -131,6 +151,32 @@ class SpotifyCredentials(models.Model):
     refresh_token = models.TextField(blank=True, null=True)
 
 
+# a new user's top tracks/artists import, run by `manage.py run_spotify_imports` so the
+# oauth callback can redirect right away
+class SpotifyImportJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='spotify_imports')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    time_frame = models.CharField(max_length=20, default='medium_term')
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # the worker picks the oldest pending job
+        indexes = [models.Index(fields=['status', 'created_at'], name='spotifyimport_queue_idx')]
+
+    def __str__(self):
+        return f"Spotify import for {self.user.username} ({self.status})"
+
+
 class Swipe(models.Model):
     swiper_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='swipes_made')
     target_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='swipes_received')
@@ -141,7 +187,22 @@ class Swipe(models.Model):
         return f"{self.swiper_user} {self.type.lower()} {self.target_user}"
 
 
+class MatchQuerySet(models.QuerySet):
+    def between(self, user_a, user_b):
+        # a pair is stored once, lower id first, so this is one probe of the unique index
+        user1_id, user2_id = Match.ordered_pair(user_a, user_b)
+        return self.filter(user1_id=user1_id, user2_id=user2_id)
+
+    def involving(self, user):
+        user_id = getattr(user, 'pk', user)
+        return self.filter(models.Q(user1_id=user_id) | models.Q(user2_id=user_id))
+
+    def are_matched(self, user_a, user_b):
+        return self.between(user_a, user_b).exists()
+
+
 class Match(models.Model):
+    # symmetric: user1 is always the lower id, save() puts the pair in that order
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matches_initiated')
     user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matches_received')
     created_at = models.DateTimeField(auto_now_add=True)
@@ -155,7 +216,38 @@ class Match(models.Model):
     genre_match = models.FloatField(default = 0 )
     artist_match = models.FloatField(default = 0 )
     song_match= models.FloatField(default = 0 )
+
+    objects = MatchQuerySet.as_manager()
     
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user1', 'user2'], name='match_unique_pair'),
+            models.CheckConstraint(condition=models.Q(user1__lt=models.F('user2')), name='match_canonical_order'),
+        ]
+        # the unique pair covers lookups from user1, this one the feed's checks from user2
+        indexes = [
+            models.Index(fields=['user2', 'user1'], name='match_user2_user1_idx'),
+        ]
+
+    @staticmethod
+    def ordered_pair(user_a, user_b):
+        """
+        (user1_id, user2_id) of the match between two users or user ids
+        """
+        a, b = getattr(user_a, 'pk', user_a), getattr(user_b, 'pk', user_b)
+        return (a, b) if a < b else (b, a)
+
+    def save(self, *args, **kwargs):
+        if self.user1_id is not None and self.user2_id is not None and self.user1_id > self.user2_id:
+            self.user1, self.user2 = self.user2, self.user1
+        super().save(*args, **kwargs)
+
+    def includes(self, user):
+        return getattr(user, 'pk', user) in (self.user1_id, self.user2_id)
+
+    def other_user_id(self, user):
+        return self.user2_id if getattr(user, 'pk', user) == self.user1_id else self.user1_id
+
     def __str__(self):
         return f"Match: {self.user1} and {self.user2}: {self.compatibilty_score:.1f}%"
 
@@ -163,6 +255,10 @@ class MatchRejection(models.Model):
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='rejects')
     user2= models.ForeignKey(User, on_delete=models.CASCADE, related_name='was_rejected_by')
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user1', 'user2'], name='matchrejection_pair_idx')]
+
     def __str__(self):
         return f"{self.user1} rejected {self.user2}"
 
@@ -176,6 +272,94 @@ class Message(models.Model):
     def __str__(self):
         return f"Message from {self.sender} to {self.receiver}: {self.content}"
 
+# persisted top-K of compatibility results for each user, kept current as preferences change
+class MatchScore(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='match_scores')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    final_score = models.FloatField(default=0)
+
+    #category breakdown
+    genre_match = models.FloatField(default=0)
+    artist_match = models.FloatField(default=0)
+    song_match = models.FloatField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['user', 'candidate']
+        ordering = ['-final_score', 'candidate']
+        indexes = [
+            models.Index(fields=['user', '-final_score', 'candidate'], name='matchscore_user_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} -> {self.candidate}: {self.final_score:.3f}"
+
+
+# the three component similarities of a pair, independent of anyone's weights.
+# stored once per pair with user_low < user_high
+class PairSimilarity(models.Model):
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    genre_sim = models.FloatField(default=0)
+    artist_sim = models.FloatField(default=0)
+    song_sim = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['user_low', 'user_high']
+        constraints = [
+            models.CheckConstraint(condition=models.Q(user_low__lt=models.F('user_high')), name='pairsimilarity_ordered_pair'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_low} / {self.user_high}: {self.genre_sim}, {self.artist_sim}, {self.song_sim}"
+
+
+# whether a user's MatchScore rows have been computed and can be served as they are
+class MatchScoreStatus(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='match_score_status')
+    dirty = models.BooleanField(default=False)
+    # every PairSimilarity row involving the user is stored, so the table can be re-ranked from them
+    pairs_cached = models.BooleanField(default=False)
+    computed_at = models.DateTimeField(null=True, blank=True)
+    candidates_scored = models.IntegerField(default=0)
+    candidates_pruned = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Match scores for {self.user.username}"
+
+
+# the next candidates a user swipes through, ranked and filtered ahead of time.
+# refill_discovery_queues tops it up once it drops below the low-water mark
+class DiscoveryQueue(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='discovery_queue')
+    size = models.IntegerField(default=0)
+    needs_refill = models.BooleanField(default=True)
+    refilled_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Discovery queue for {self.user.username} ({self.size})"
+
+
+class DiscoveryQueueEntry(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    position = models.BigIntegerField()
+    final_score = models.FloatField(null=True, blank=True)  # None past the persisted top-K
+
+    class Meta:
+        unique_together = ['user', 'candidate']
+        ordering = ['user', 'position']
+        indexes = [
+            # the head of a queue is one index seek
+            models.Index(fields=['user', 'position'], name='discoveryqueue_head_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} #{self.position}: {self.candidate}"
+
+
 class MatchWeightSettings(models.Model):
     user = models.OneToOneField(
         User, 
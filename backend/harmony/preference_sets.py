@@ -0,0 +1,112 @@
+# harmony/preference_sets.py
+import numpy as np
+
+from .matching_engine import DIMENSIONS, preference_rows
+
+
+class PreferenceSet:
+    """
+    one user's preferences for a dimension: sorted int32 item ids with parallel uint8
+    weights (weights are 1-10). usually a view into a PreferenceSetStore, not a copy
+    """
+    __slots__ = ('items', 'weights', 'total')
+
+    def __init__(self, items, weights, total=None):
+        self.items = items
+        self.weights = weights
+        self.total = int(weights.sum(dtype=np.int64)) if total is None else int(total)
+
+    def __len__(self):
+        return len(self.items)
+
+    def overlap(self, other):
+        """
+        sum of the lower weight of every item both sets contain. walks the smaller set
+        through a binary search of the larger one, so it is O(m log n) without any dict
+        """
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        if not len(small) or not len(large):
+            return 0
+        pos = np.searchsorted(large.items, small.items)
+        pos[pos == len(large.items)] = 0
+        shared = large.items[pos] == small.items
+        return int(np.minimum(small.weights[shared], large.weights[pos[shared]]).sum(dtype=np.int64))
+
+    def similarity(self, other):
+        # same formula and rounding as compute_weighted_similarity
+        numerator = self.overlap(other)
+        if not numerator:
+            return 0.0
+        return round((2 * numerator) / (self.total + other.total), 3)
+
+
+EMPTY = PreferenceSet(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8), 0)
+
+
+class PreferenceSetStore:
+    """
+    every user's PreferenceSet for one dimension in four contiguous arrays, about 5 bytes
+    per preference plus 16 per user instead of a dict entry and an int object per item
+    """
+    __slots__ = ('user_ids', 'offsets', 'items', 'weights', 'totals')
+
+    def __init__(self, user_ids, offsets, items, weights):
+        self.user_ids = user_ids  # sorted, int32
+        self.offsets = offsets    # user i owns items[offsets[i]:offsets[i + 1]]
+        self.items = items
+        self.weights = weights
+        self.totals = np.zeros(len(user_ids), dtype=np.int64)
+        if len(items):
+            self.totals = np.add.reduceat(weights.astype(np.int64), offsets[:-1])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        builds the store from (user_id, item_id, weight) rows in any order
+        """
+        rows = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+        user_ids, starts = np.unique(rows[:, 0], return_index=True)
+        offsets = np.append(starts, len(rows)).astype(np.int64)
+        return cls(
+            user_ids.astype(np.int32),
+            offsets,
+            rows[:, 1].astype(np.int32),
+            rows[:, 2].astype(np.uint8),
+        )
+
+    @classmethod
+    def from_model(cls, model, field_name, user_ids=None):
+        return cls.from_rows(preference_rows(model, field_name, user_ids))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__)
+
+    def get(self, user_id):
+        pos = np.searchsorted(self.user_ids, user_id)
+        if pos == len(self.user_ids) or self.user_ids[pos] != user_id:
+            return EMPTY
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        return PreferenceSet(self.items[start:end], self.weights[start:end], self.totals[pos])
+
+    def similarity(self, user_a, user_b):
+        return self.get(user_a).similarity(self.get(user_b))
+
+
+class PreferenceSets(dict):
+    """
+    {dimension: PreferenceSetStore}, what the compute_*_similarity helpers take as `sets`
+    to score pairs from memory instead of the database
+    """
+
+    @classmethod
+    def load(cls, user_ids=None):
+        return cls({
+            name: PreferenceSetStore.from_model(model, field_name, user_ids=user_ids)
+            for name, model, field_name in DIMENSIONS
+        })
+
+    @property
+    def nbytes(self):
+        return sum(store.nbytes for store in self.values())
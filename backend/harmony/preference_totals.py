@@ -0,0 +1,50 @@
+# harmony/preference_totals.py
+from django.db.models import Count, F, Sum
+
+from .models import User, UserPreferenceTotals
+from .matching_engine import DIMENSIONS
+
+
+def apply_delta(dimension, user_id, weight_delta, count_delta):
+    """
+    moves one user's running total and count for a dimension. runs inside the transaction
+    that changed the preference, so the totals commit or roll back with it
+    """
+    total_field, count_field = f'{dimension}_total', f'{dimension}_count'
+    updated = UserPreferenceTotals.objects.filter(user_id=user_id).update(**{
+        total_field: F(total_field) + weight_delta,
+        count_field: F(count_field) + count_delta,
+    })
+    if not updated:
+        refresh_preference_totals(user_id)
+
+
+def refresh_preference_totals(user_id):
+    """
+    recomputes a user's totals from the preference tables. for writes that skip model
+    signals (bulk_create, queryset.update) and for users without a totals row yet
+    """
+    if not User.objects.filter(id=user_id).exists():
+        return
+
+    values = {}
+    for name, model, _ in DIMENSIONS:
+        aggregate = model.objects.filter(user_id=user_id).aggregate(total=Sum('weight'), count=Count('id'))
+        values[f'{name}_total'] = aggregate['total'] or 0
+        values[f'{name}_count'] = aggregate['count']
+    UserPreferenceTotals.objects.update_or_create(user_id=user_id, defaults=values)
+
+
+def totals_for(dimension, user_ids):
+    """
+    returns {user_id: weight total} for one dimension with a single indexed lookup
+    """
+    totals = dict(
+        UserPreferenceTotals.objects.filter(user_id__in=user_ids).values_list('user_id', f'{dimension}_total')
+    )
+    for user_id in set(user_ids) - set(totals):
+        refresh_preference_totals(user_id)
+        totals[user_id] = getattr(
+            UserPreferenceTotals.objects.filter(user_id=user_id).first(), f'{dimension}_total', 0
+        )
+    return totals
@@ -1,12 +1,106 @@
 # harmony/signals.py
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from .models import User, UserGenrePreference, UserArtistPreference, UserSongPreference, UserPreferenceTotals
+from .matching_engine import DIMENSIONS
+from .candidate_index import candidate_index, bump_preference_version
+from .lsh import lsh_index
+from .match_table import schedule_rescore
+from .preference_totals import apply_delta
 
-# automatically create token if first signup 
+PREFERENCE_MODELS = (UserGenrePreference, UserArtistPreference, UserSongPreference)
+
+
+# automatically create token if first signup
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
         Token.objects.create(user=instance)
+
+
+# every user gets an empty preference totals row on signup
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def create_preference_totals(sender, instance=None, created=False, **kwargs):
+    if created:
+        UserPreferenceTotals.objects.get_or_create(user=instance)
+
+
+def dimension_of(model):
+    for name, dimension_model, field_name in DIMENSIONS:
+        if dimension_model is model:
+            return name, field_name
+
+
+# one shared version bump per committed change, which every in-process index follows
+def record_committed_change(name, user_id, item_id, removed):
+    version = bump_preference_version()
+    candidate_index.apply_change(name, user_id, item_id, version, removed=removed)
+    lsh_index.apply_change(user_id, version)
+
+
+# keep the candidate indexes and the persisted match scores in line with the preference
+# tables once the change is committed
+def preference_changed(sender, instance, removed=False, **kwargs):
+    name, field_name = dimension_of(sender)
+    user_id = instance.user_id
+    item_id = getattr(instance, f'{field_name}_id')
+    transaction.on_commit(
+        lambda: record_committed_change(name, user_id, item_id, removed)
+    )
+    schedule_rescore(user_id)
+
+
+def record_committed_bulk_change(user_id, changes):
+    version = bump_preference_version()
+    candidate_index.apply_changes(user_id, changes, version)
+    lsh_index.apply_change(user_id, version)
+
+
+def preferences_bulk_changed(user_id, changes):
+    """
+    what preference_changed does for writes that skip the model signals (bulk_create,
+    queryset.update): changes is a list of (dimension, item_id, removed) of user_id, and
+    they count as a single version bump. the caller refreshes the user's totals
+    """
+    changes = list(changes)
+    transaction.on_commit(lambda: record_committed_bulk_change(user_id, changes))
+    schedule_rescore(user_id)
+
+
+def preference_deleted(sender, instance, **kwargs):
+    preference_changed(sender, instance, removed=True)
+
+
+# running weight totals move in the same transaction as the preference row
+def remember_previous_weight(sender, instance, **kwargs):
+    instance._previous_weight = None
+    if not instance._state.adding:
+        instance._previous_weight = sender.objects.filter(pk=instance.pk).values_list('weight', flat=True).first()
+
+
+def preference_saved_totals(sender, instance, created=False, **kwargs):
+    name, _ = dimension_of(sender)
+    if created:
+        apply_delta(name, instance.user_id, instance.weight, 1)
+    elif instance._previous_weight is not None and instance._previous_weight != instance.weight:
+        apply_delta(name, instance.user_id, instance.weight - instance._previous_weight, 0)
+
+
+def preference_deleted_totals(sender, instance, origin=None, **kwargs):
+    # the user itself is being deleted, its totals row goes with it
+    if isinstance(origin, User) or getattr(origin, 'model', None) is User:
+        return
+    name, _ = dimension_of(sender)
+    apply_delta(name, instance.user_id, -instance.weight, -1)
+
+
+for model in PREFERENCE_MODELS:
+    post_save.connect(preference_changed, sender=model, dispatch_uid=f'index_save_{model.__name__}')
+    post_delete.connect(preference_deleted, sender=model, dispatch_uid=f'index_delete_{model.__name__}')
+    pre_save.connect(remember_previous_weight, sender=model, dispatch_uid=f'totals_pre_save_{model.__name__}')
+    post_save.connect(preference_saved_totals, sender=model, dispatch_uid=f'totals_save_{model.__name__}')
+    post_delete.connect(preference_deleted_totals, sender=model, dispatch_uid=f'totals_delete_{model.__name__}')
@@ -0,0 +1,112 @@
+# harmony/snapshot.py
+# snapshots feed the batch scoring of `manage.py recompute_matches --from-snapshot`. the
+# request path never reads them: any preference change makes one stale, and serving stale
+# scores per request isn't worth the database reads it would save
+from collections import namedtuple
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .matching_engine import MatchingEngine, PreferenceMatrix
+from .candidate_index import get_preference_version
+
+# name of the file holding the directory name of the newest snapshot
+CURRENT = 'CURRENT'
+
+Snapshot = namedtuple('Snapshot', ['name', 'preference_version', 'engine'])
+
+
+def snapshot_dir():
+    return getattr(settings, 'HARMONY_MATCHING_SNAPSHOT_DIR', None)
+
+
+def matrix_arrays(matrix):
+    return {
+        'user_ids': matrix.user_ids,
+        'item_ids': matrix.item_ids,
+        'totals': matrix.totals,
+        'csr_data': matrix.csr.data,
+        'csr_indices': matrix.csr.indices,
+        'csr_indptr': matrix.csr.indptr,
+        'csc_data': matrix.csc.data,
+        'csc_indices': matrix.csc.indices,
+        'csc_indptr': matrix.csc.indptr,
+    }
+
+
+def write_snapshot(directory, engine=None, keep=3):
+    """
+    dumps the csr/csc arrays of the three preference matrices into a new version directory,
+    then points CURRENT at it. readers only ever see complete snapshots. returns its name
+    """
+    # read before loading, so a change made during the dump leaves the snapshot looking stale
+    preference_version = get_preference_version()
+    if engine is None:
+        engine = MatchingEngine.from_db()
+
+    os.makedirs(directory, exist_ok=True)
+    name = f'{time.time_ns():020d}-{preference_version}'
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=directory)
+    for dimension, matrix in engine.matrices.items():
+        for key, array in matrix_arrays(matrix).items():
+            np.save(os.path.join(staging, f'{dimension}.{key}.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(staging, 'meta.json'), 'w') as meta:
+        json.dump({'preference_version': preference_version, 'dimensions': list(engine.matrices)}, meta)
+    os.rename(staging, os.path.join(directory, name))
+
+    pointer = os.path.join(directory, f'.{CURRENT}.{os.getpid()}')
+    with open(pointer, 'w') as current:
+        current.write(name)
+    os.replace(pointer, os.path.join(directory, CURRENT))
+
+    prune_snapshots(directory, keep)
+    return name
+
+
+def prune_snapshots(directory, keep):
+    # workers still mapping an old version keep their pages, unlinking is safe
+    names = sorted(
+        name for name in os.listdir(directory)
+        if not name.startswith('.') and os.path.isdir(os.path.join(directory, name))
+    )
+    for name in names[:-keep] if keep > 0 else []:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def current_snapshot_name(directory):
+    try:
+        with open(os.path.join(directory, CURRENT)) as current:
+            return current.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_snapshot(directory, name):
+    """
+    memory-maps one snapshot read-only, so every process mapping it shares the same pages
+    """
+    path = os.path.join(directory, name)
+    with open(os.path.join(path, 'meta.json')) as meta:
+        meta = json.load(meta)
+
+    matrices = {}
+    for dimension in meta['dimensions']:
+        arrays = {
+            key: np.load(os.path.join(path, f'{dimension}.{key}.npy'), mmap_mode='r')
+            for key in ('user_ids', 'item_ids', 'totals', 'csr_data', 'csr_indices',
+                        'csr_indptr', 'csc_data', 'csc_indices', 'csc_indptr')
+        }
+        matrices[dimension] = PreferenceMatrix.from_arrays(
+            arrays['user_ids'],
+            arrays['item_ids'],
+            arrays['totals'],
+            (arrays['csr_data'], arrays['csr_indices'], arrays['csr_indptr']),
+            (arrays['csc_data'], arrays['csc_indices'], arrays['csc_indptr']),
+        )
+    return Snapshot(name, meta['preference_version'], MatchingEngine(matrices))
+
@@ -0,0 +1,355 @@
+# harmony/spotify.py
+import base64
+from collections import OrderedDict, defaultdict, deque
+from email.utils import parsedate_to_datetime
+import hashlib
+import pickle
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+# every spotify call gives up after these many seconds to connect / to read the answer
+CONNECT_TIMEOUT = getattr(settings, 'HARMONY_SPOTIFY_CONNECT_TIMEOUT', 3.05)
+READ_TIMEOUT = getattr(settings, 'HARMONY_SPOTIFY_READ_TIMEOUT', 10)
+# retries after the first attempt, for timeouts, connection errors, 429 and 5xx
+RETRIES = getattr(settings, 'HARMONY_SPOTIFY_RETRIES', 2)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# backoff between retries is full jitter up to BACKOFF * 2^attempt, capped at MAX_BACKOFF.
+# a Retry-After above MAX_RETRY_AFTER isn't waited for, the response goes back to the caller
+BACKOFF = 0.25
+MAX_BACKOFF = 4.0
+MAX_RETRY_AFTER = 10.0
+# latency samples kept per endpoint for the percentiles
+LATENCY_SAMPLES = 1000
+
+
+def retry_after_seconds(response):
+    """
+    the Retry-After header of a response in seconds (it may be a number or an http date),
+    None when it's missing or unreadable
+    """
+    value = response.headers.get('Retry-After') if response.headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - timezone.now()).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def as_dict(self):
+        samples = np.array(self.latencies) * 1000
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'p50_ms': round(float(np.percentile(samples, 50)), 1) if len(samples) else None,
+            'p95_ms': round(float(np.percentile(samples, 95)), 1) if len(samples) else None,
+            'max_ms': round(float(samples.max()), 1) if len(samples) else None,
+        }
+
+
+class SpotifyClient:
+    """
+    one keep-alive connection pool for every spotify call, with connect/read timeouts,
+    bounded retries with jittered backoff that honour Retry-After, and per endpoint
+    latency stats. only idempotent calls are retried after the request may have been sent
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES, pool_size=20):
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.stats_lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointStats)
+
+    def record(self, endpoint, elapsed, error=False, retry=False):
+        with self.stats_lock:
+            stats = self.endpoints[endpoint]
+            stats.calls += 1
+            stats.errors += error
+            stats.retries += retry
+            stats.latencies.append(elapsed)
+
+    def backoff(self, attempt, response=None):
+        wait = retry_after_seconds(response) if response is not None else None
+        if wait is None:
+            wait = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+        return wait
+
+    def request(self, method, url, endpoint=None, idempotent=None, **kwargs):
+        endpoint = endpoint or url.split('?')[0]
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectTimeout:
+                # nothing reached spotify, safe to retry whatever the method
+                self.record(endpoint, time.perf_counter() - start, error=True, retry=not last)
+                if last:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            except (requests.ConnectionError, requests.Timeout):
+                retry = idempotent and not last
+                self.record(endpoint, time.perf_counter() - start, error=True, retry=retry)
+                if not retry:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+
+            elapsed = time.perf_counter() - start
+            if response.status_code not in RETRY_STATUSES or last or not idempotent:
+                self.record(endpoint, elapsed, error=response.status_code >= 500)
+                return response
+            wait = self.backoff(attempt, response)
+            if wait > MAX_RETRY_AFTER:
+                self.record(endpoint, elapsed, error=True)
+                return response
+            self.record(endpoint, elapsed, error=True, retry=True)
+            time.sleep(wait)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        with self.stats_lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in sorted(self.endpoints.items())}
+
+
+spotify_client = SpotifyClient()
+
+# the app token is refreshed this many seconds before spotify expires it
+TOKEN_EXPIRY_MARGIN = getattr(settings, 'HARMONY_SPOTIFY_TOKEN_MARGIN', 60)
+# how long a refresh may hold the lock, and how long the others wait for it
+TOKEN_LOCK_TIMEOUT = 10
+TOKEN_WAIT_INTERVAL = 0.05
+
+
+class SpotifyTokenError(Exception):
+    pass
+
+
+def request_app_token(client_id, client_secret):
+    """
+    asks spotify for a client credentials token, returns (token, seconds until it expires)
+    """
+    auth_string = f"{client_id}:{client_secret}"
+    auth_base64 = base64.b64encode(auth_string.encode()).decode()
+
+    # asking for a client credentials token twice is harmless, so it's retried like a GET
+    response = spotify_client.post(
+        TOKEN_URL,
+        headers={"Authorization": f"Basic {auth_base64}"},
+        data={"grant_type": "client_credentials"},
+        endpoint='app_token',
+        idempotent=True,
+    )
+
+    if response.status_code != 200:
+        raise SpotifyTokenError("Token retrieval failed:", response.text)
+    data = response.json()
+    return data.get("access_token"), int(data.get("expires_in", 3600))
+
+
+class AppTokenManager:
+    """
+    keeps the app's client credentials token in the django cache until shortly before it
+    expires, so every worker sharing the cache reuses it. when it's missing one caller
+    takes a cache lock and refreshes it while the others wait for the result
+    """
+
+    def __init__(self, margin=TOKEN_EXPIRY_MARGIN, lock_timeout=TOKEN_LOCK_TIMEOUT):
+        self.margin = margin
+        self.lock_timeout = lock_timeout
+        self.counter_lock = threading.Lock()
+        # per process
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.waits = 0
+
+    def count(self, name):
+        with self.counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def token_key(self, client_id):
+        return f'harmony:spotify_token:{client_id}'
+
+    def get_token(self, client_id, client_secret):
+        key = self.token_key(client_id)
+        token = cache.get(key)
+        if token:
+            self.count('hits')
+            return token
+        self.count('misses')
+
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + self.lock_timeout
+        while not cache.add(lock_key, True, timeout=self.lock_timeout):
+            # someone else is refreshing, wait for their token
+            self.count('waits')
+            time.sleep(TOKEN_WAIT_INTERVAL)
+            token = cache.get(key)
+            if token:
+                return token
+            if time.monotonic() > deadline:  # the refresh died with the lock held
+                return self.refresh(key, client_id, client_secret)
+        try:
+            # it may have been refreshed between our miss and taking the lock
+            return cache.get(key) or self.refresh(key, client_id, client_secret)
+        finally:
+            cache.delete(lock_key)
+
+    def refresh(self, key, client_id, client_secret):
+        token, expires_in = request_app_token(client_id, client_secret)
+        self.count('refreshes')
+        cache.set(key, token, timeout=max(expires_in - self.margin, 1))
+        return token
+
+    def invalidate(self, client_id):
+        cache.delete(self.token_key(client_id))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'waits': self.waits,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+app_token_manager = AppTokenManager()
+
+
+# search results are shared for this long, the newest SEARCH_LOCAL_SIZE of them are also
+# kept in process. bigger results aren't cached at all
+SEARCH_TTL = getattr(settings, 'HARMONY_SPOTIFY_SEARCH_TTL', 600)
+SEARCH_LOCAL_SIZE = getattr(settings, 'HARMONY_SPOTIFY_SEARCH_LOCAL_SIZE', 1000)
+SEARCH_MAX_BYTES = 64 * 1024
+
+
+def normalize_query(query):
+    # 'Bohemian  Rhapsody ' and 'bohemian rhapsody' are the same search
+    return ' '.join(query.casefold().split())
+
+
+class SearchCache:
+    """
+    spotify search results by normalized query. the django cache shares them between
+    workers with a ttl; a small in-process lru in front of it answers the hottest queries
+    without a cache round trip. entries remember how long spotify took to produce them,
+    so every hit adds that to the upstream latency saved
+    """
+
+    def __init__(self, ttl=SEARCH_TTL, local_size=SEARCH_LOCAL_SIZE, max_bytes=SEARCH_MAX_BYTES):
+        self.ttl = ttl
+        self.local_size = local_size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.local = OrderedDict()  # key: (expires at, entry), least recently used first
+        # per process
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def key(self, query, limit):
+        digest = hashlib.sha1(normalize_query(query).encode()).hexdigest()
+        return f'harmony:spotify_search:{limit}:{digest}'
+
+    def remember(self, key, expires_at, entry):
+        with self.lock:
+            self.local[key] = (expires_at, entry)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def get(self, query, limit):
+        """
+        the cached result list of a search, None on a miss
+        """
+        key = self.key(query, limit)
+        now = time.time()
+        with self.lock:
+            cached = self.local.get(key)
+            if cached is not None and cached[0] <= now:
+                del self.local[key]
+                cached = None
+            if cached is not None:
+                self.local.move_to_end(key)
+                self.local_hits += 1
+                self.saved_seconds += cached[1]['latency']
+                return cached[1]['results']
+
+        entry = cache.get(key)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        self.remember(key, min(entry['expires_at'], now + self.ttl), entry)
+        with self.lock:
+            self.shared_hits += 1
+            self.saved_seconds += entry['latency']
+        return entry['results']
+
+    def set(self, query, limit, results, latency):
+        entry = {'results': results, 'latency': latency, 'expires_at': time.time() + self.ttl}
+        if len(pickle.dumps(results, pickle.HIGHEST_PROTOCOL)) > self.max_bytes:
+            return
+        key = self.key(query, limit)
+        cache.set(key, entry, timeout=self.ttl)
+        self.remember(key, entry['expires_at'], entry)
+
+    def clear(self):
+        # drops this process' copies, the shared entries expire on their own
+        with self.lock:
+            self.local.clear()
+
+    def stats(self):
+        hits = self.local_hits + self.shared_hits
+        lookups = hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': round(hits / lookups, 3) if lookups else None,
+            'local_entries': len(self.local),
+            'saved_upstream_ms': round(self.saved_seconds * 1000, 1),
+        }
+
+
+search_cache = SearchCache()
@@ -0,0 +1,175 @@
+# harmony/spotify_import.py
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import SpotifyCredentials, SpotifyImportJob
+from .preference_totals import refresh_preference_totals
+from .signals import preferences_bulk_changed
+
+# a job running longer than this is taken to belong to a dead worker and is picked up again
+STALE_AFTER = timedelta(seconds=getattr(settings, 'HARMONY_SPOTIFY_IMPORT_STALE_SECONDS', 600))
+MAX_ATTEMPTS = 3
+
+
+class SpotifyImportError(Exception):
+    pass
+
+
+def ids_by(model, field, rows):
+    """
+    {key: id} for rows = {key: defaults}, creating the missing rows in bulk. rows that
+    exist are left as they are, like get_or_create. at most three queries for any number
+    """
+    if not rows:
+        return {}
+    ids = dict(model.objects.filter(**{f'{field}__in': list(rows)}).values_list(field, 'id'))
+    missing = [key for key in rows if key not in ids]
+    if missing:
+        # a concurrent import may create some of them first, the refetch picks those up
+        model.objects.bulk_create(
+            [model(**{field: key}, **rows[key]) for key in missing], ignore_conflicts=True
+        )
+        ids.update(model.objects.filter(**{f'{field}__in': missing}).values_list(field, 'id'))
+    return ids
+
+
+def link_all(through, left, right, pairs):
+    # many to many links in one insert, existing links are skipped like .add() does
+    through.objects.bulk_create(
+        [through(**{f'{left}_id': a, f'{right}_id': b}) for a, b in dict.fromkeys(pairs)],
+        ignore_conflicts=True,
+    )
+
+
+def upsert_preferences(model, dimension, field_name, user, weights):
+    """
+    update_or_create of every {item_id: weight} in one insert ... on conflict update. the
+    model signals don't run for it, so the totals are refreshed and the indexes told here
+    """
+    if not weights:
+        return
+    model.objects.bulk_create(
+        [model(user=user, weight=weight, **{f'{field_name}_id': item_id}) for item_id, weight in weights.items()],
+        update_conflicts=True, unique_fields=['user', field_name], update_fields=['weight'],
+    )
+    refresh_preference_totals(user.id)
+    preferences_bulk_changed(user.id, [(dimension, item_id, False) for item_id in weights])
+
+
+def enqueue_import(user, time_frame='medium_term'):
+    return SpotifyImportJob.objects.create(user=user, time_frame=time_frame)
+
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'error': job.error,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+    }
+
+
+def notify(job):
+    """
+    pushes the job's status to the user's websocket group, the one chat messages use
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    status = job_status(job)
+    for key in ('created_at', 'finished_at'):
+        status[key] = status[key].isoformat() if status[key] else None
+    async_to_sync(channel_layer.group_send)(
+        f'chat_{job.user_id}',
+        {'type': 'spotify.import', 'job': status}
+    )
+
+
+def fail_exhausted_jobs(stale):
+    """
+    a job whose worker died on its last attempt won't be claimed again, so it's marked
+    failed instead of showing as running forever
+    """
+    exhausted = SpotifyImportJob.objects.filter(
+        status=SpotifyImportJob.RUNNING, started_at__lt=stale, attempts__gte=MAX_ATTEMPTS
+    )
+    for job in exhausted:
+        failed = exhausted.filter(id=job.id).update(
+            status=SpotifyImportJob.FAILED, error='Worker died on the last attempt', finished_at=timezone.now()
+        )
+        if failed:
+            job.refresh_from_db()
+            notify(job)
+
+
+def claim_next_job():
+    """
+    marks the oldest pending (or stale running) job as running and returns it, None when
+    there's nothing to do. the conditional update makes sure two workers never claim the
+    same job
+    """
+    stale = timezone.now() - STALE_AFTER
+    fail_exhausted_jobs(stale)
+    claimable = SpotifyImportJob.objects.filter(
+        Q(status=SpotifyImportJob.PENDING) | Q(status=SpotifyImportJob.RUNNING, started_at__lt=stale),
+        attempts__lt=MAX_ATTEMPTS,
+    )
+    while True:
+        job = claimable.order_by('created_at', 'id').first()
+        if job is None:
+            return None
+        claimed = claimable.filter(id=job.id, status=job.status, attempts=job.attempts).update(
+            status=SpotifyImportJob.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def finish(job, status, error=''):
+    job.status = status
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
+    notify(job)
+
+
+def run_import(job):
+    """
+    fetches the user's top tracks and artists from spotify and saves them as preferences,
+    what spotify_callback used to do inline for a new user
+    """
+    # the spotify helpers live with the views that use them too
+    from .views import (
+        get_spotify_users_fav_songs, get_spotify_user_fav_artists,
+        translate_spotify_songs, translate_spotify_artist_and_genres,
+    )
+
+    notify(job)
+    try:
+        credentials = SpotifyCredentials.objects.get(user_id=job.user_id)
+
+        fav_songs = get_spotify_users_fav_songs(credentials, time_frame=job.time_frame)
+        if fav_songs is None:
+            raise SpotifyImportError('Favorite song response from Spotify')
+        fav_artists = get_spotify_user_fav_artists(credentials, time_frame=job.time_frame)
+        if fav_artists is None:
+            raise SpotifyImportError('Favorite artist response from Spotify')
+
+        translate_spotify_songs(job.user, fav_songs)
+        translate_spotify_artist_and_genres(job.user, fav_artists)
+    except (SpotifyImportError, SpotifyCredentials.DoesNotExist) as error:
+        finish(job, SpotifyImportJob.FAILED, str(error))
+    except Exception as error:
+        # anything else may be transient, the job is retried until MAX_ATTEMPTS
+        status = SpotifyImportJob.FAILED if job.attempts >= MAX_ATTEMPTS else SpotifyImportJob.PENDING
+        finish(job, status, repr(error))
+    else:
+        finish(job, SpotifyImportJob.DONE)
+    return job
@@ -0,0 +1,73 @@
+# harmony/test_utils.py
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+import re
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudget(namedtuple('QueryBudget', ['constant', 'per_item', 'scales_with'])):
+    """
+    the most queries an endpoint may run for a fixture of n items: constant + per_item * n.
+    per_item above 0 is an N+1 we still live with, lower these as endpoints get fixed
+    """
+    __slots__ = ()
+
+    def __call__(self, n):
+        return self.constant + self.per_item * n
+
+    def __str__(self):
+        if not self.per_item:
+            return str(self.constant)
+        per_item = 'n' if self.per_item == 1 else f'{self.per_item}n'
+        return f'{self.constant} + {per_item} (n = {self.scales_with})'
+
+
+# token auth is one of the queries of every authenticated endpoint
+QUERY_BUDGETS = {
+    'matches': QueryBudget(6, 0, 'users in the page'),
+    'next_match': QueryBudget(5, 0, 'queued candidates'),
+    'match_accept_get': QueryBudget(2, 2, 'matches of the user'),
+    'profile': QueryBudget(7, 0, 'favorite songs of the user'),
+    'song_search': QueryBudget(2, 0, 'search results'),
+    'full_matches': QueryBudget(3, 0, 'matches in the page'),
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize_sql(sql):
+    """
+    strips the literals out of a query so the same statement run for different rows
+    counts as one pattern
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(\s*,\s*\?)*\s*\)', '(?)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def query_report(queries, limit=10):
+    patterns = Counter(normalize_sql(query['sql']) for query in queries)
+    return '\n'.join(
+        f'  {count:>4} x {pattern}' for pattern, count in patterns.most_common(limit)
+    )
+
+
+@contextmanager
+def query_budget(endpoint, n, using='default'):
+    """
+    fails with QueryBudgetExceeded, listing the most repeated query patterns, when the
+    block runs more queries than QUERY_BUDGETS[endpoint] allows for n items
+    """
+    budget = QUERY_BUDGETS[endpoint]
+    with CaptureQueriesContext(connections[using]) as captured:
+        yield captured
+    if len(captured) > budget(n):
+        raise QueryBudgetExceeded(
+            f'{endpoint} ran {len(captured)} queries for n={n}, budget is {budget} = {budget(n)}\n'
+            f'{query_report(captured.captured_queries)}'
+        )
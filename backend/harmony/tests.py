@@ -1,17 +1,38 @@
 import pytest
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
 from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from unittest.mock import patch, MagicMock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from io import StringIO
 import json
-from datetime import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 
+import numpy as np
+import requests
+
+from benchmarks.generator import generate, zipf_sampler
+from benchmarks.scenarios import SCENARIOS, measure
+from chat.models import Conversation, Message as ChatMessage
 from .models import (
     User, Genre, Artist, Song, UserSongPreference, UserArtistPreference,
     UserGenrePreference, SpotifyCredentials, Swipe, Match, MatchRejection,
-    Message, MatchWeightSettings
+    Message, MatchWeightSettings, MatchScore, MatchScoreStatus, PairSimilarity,
+    UserPreferenceTotals, DiscoveryQueue, DiscoveryQueueEntry, SpotifyImportJob
 )
 from .views import (
     get_spotify_token, song_search, spotify_login, spotify_callback,
@@ -20,6 +41,23 @@ from .views import (
     match_accept, match_reject, return_accepted_matches, get_full_matches,
     match_weight_settings
 )
+from .checks import check_shared_backends, per_process_backends
+from .candidate_index import candidate_index, get_preference_version, bump_preference_version
+from .discovery_queue import refill_queue, pop_candidate
+from .lsh import lsh_index, MinHashLSH, preference_tokens
+from .matching_engine import MatchComponents, MatchingEngine
+from .matching_utils import (
+    compute_genre_similarity, compute_artist_similarity, compute_song_similarity,
+    compute_weighted_similarity, compute_weighted_similarity_sql,
+    compute_final_match_score, compute_final_match_scores_sql
+)
+from .match_table import refresh_match_table, rescore_user, cached_components, TOP_K
+from .preference_sets import PreferenceSets, PreferenceSetStore
+from .preference_totals import refresh_preference_totals
+from .snapshot import write_snapshot, current_snapshot_name, load_snapshot
+from .spotify import search_cache, AppTokenManager, SearchCache, SpotifyClient, SpotifyTokenError
+from .spotify_import import enqueue_import, claim_next_job, run_import, STALE_AFTER, MAX_ATTEMPTS
+from .test_utils import QueryBudgetExceeded, query_budget
 
 User = get_user_model()
 
@@ -299,6 +337,18 @@ class MatchModelTests(TestCase):
         self.assertEqual(match.genre_match, 80.0)
         self.assertEqual(match.artist_match, 85.0)
         self.assertEqual(match.song_match, 90.0)
+    
+    def test_match_stored_in_canonical_order(self):
+        match = Match.objects.create(user1=self.user2, user2=self.user1)
+        self.assertEqual((match.user1_id, match.user2_id), (self.user1.id, self.user2.id))
+        self.assertTrue(Match.objects.are_matched(self.user2, self.user1))
+        self.assertTrue(Match.objects.are_matched(self.user1.id, self.user2.id))
+        self.assertEqual(match.other_user_id(self.user2), self.user1.id)
+        
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Match.objects.create(user1=self.user1, user2=self.user2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Match.objects.bulk_create([Match(user1=self.user2, user2=self.user1)])
 
 
 class MatchRejectionTests(TestCase):
@@ -461,7 +511,10 @@ class SongViewSetTests(APITestCase):
 class SpotifyUtilityFunctionTests(TestCase):
     """Test Spotify utility functions"""
     
-    @patch('harmony.views.requests.post')
+    def setUp(self):
+        cache.clear()  # the app token is cached between calls
+    
+    @patch('harmony.views.spotify_client.post')
     def test_get_spotify_token_success(self, mock_post):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -471,7 +524,7 @@ class SpotifyUtilityFunctionTests(TestCase):
         token = get_spotify_token('client_id', 'client_secret')
         self.assertEqual(token, 'token123')
     
-    @patch('harmony.views.requests.post')
+    @patch('harmony.views.spotify_client.post')
     def test_get_spotify_token_failure(self, mock_post):
         mock_response = MagicMock()
         mock_response.status_code = 400
@@ -480,7 +533,7 @@ class SpotifyUtilityFunctionTests(TestCase):
         with self.assertRaises(Exception):
             get_spotify_token('client_id', 'client_secret')
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_song_embed_success(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -490,7 +543,7 @@ class SpotifyUtilityFunctionTests(TestCase):
         embed = get_song_embed('http://spotify.com/track/123')
         self.assertEqual(embed['html'], '<iframe>...</iframe>')
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_song_embed_failure(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 404
@@ -508,13 +561,16 @@ class SongSearchTests(APITestCase):
         self.user = User.objects.create_user(username='testuser_search')
         self.token, _ = Token.objects.get_or_create(user=self.user)
         self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        # the search results are cached across tests otherwise
+        cache.clear()
+        search_cache.clear()
     
     def test_song_search_no_query(self):
         response = self.client.get('/api/search/')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
     @patch('harmony.views.get_spotify_token')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_song_search_success(self, mock_get, mock_token):
         mock_token.return_value = 'token123'
         mock_response = MagicMock()
@@ -572,6 +628,72 @@ class MatchesTests(APITestCase):
         response = self.client.get('/api/matches/')
         user_ids = [m['id'] for m in response.data['matches']]
         self.assertNotIn(self.user2.id, user_ids)
+    
+    def test_matches_shows_top_three_songs_and_artists(self):
+        user3 = User.objects.create_user(username='matchuser3')
+        for i, weight in enumerate([2, 9, 5, 9, 1]):
+            song = Song.objects.create(name=f'Top Song {i}', spotify_id=f'top_s{i}')
+            artist = Artist.objects.create(name=f'Top Artist {i}', spotify_id=f'top_a{i}')
+            UserSongPreference.objects.create(user=self.user2, song=song, weight=weight)
+            UserArtistPreference.objects.create(user=self.user2, artist=artist, weight=10 - weight)
+        
+        response = self.client.get('/api/matches/')
+        profiles = {m['id']: m for m in response.data['matches']}
+        self.assertEqual(
+            [(s['name'], s['weight']) for s in profiles[self.user2.id]['fav_songs']],
+            [('Top Song 1', 9), ('Top Song 3', 9), ('Top Song 2', 5)]
+        )
+        self.assertEqual([a['weight'] for a in profiles[self.user2.id]['fav_artists']], [9, 8, 5])
+        self.assertEqual((profiles[user3.id]['fav_songs'], profiles[user3.id]['fav_artists']), ([], []))
+    
+    def test_matches_deck_is_ranked_and_paged(self):
+        others = [User.objects.create_user(username=f'deckuser{i}') for i in range(4)]
+        MatchRejection.objects.create(user1=self.user1, user2=others[3])
+        # a computed table where only two users scored, others[1] best
+        for other, score in ((others[1], 2.5), (others[2], 0.7)):
+            MatchScore.objects.create(user=self.user1, candidate=other, final_score=score)
+        MatchScoreStatus.objects.create(user=self.user1, dirty=False, pairs_cached=True)
+        
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/matches/', params)
+            self.assertLessEqual(response.data['count'], 2)
+            seen.extend((m['id'], m['final_score']) for m in response.data['matches'])
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+        
+        # scored users first, then everyone else unseen by id and unranked, the rejected user never
+        self.assertEqual(seen, [
+            (others[1].id, 2.5), (others[2].id, 0.7), (self.user2.id, None), (others[0].id, None)
+        ])
+    
+    def test_matches_rejects_invalid_paging(self):
+        for params in ({'limit': 0}, {'cursor': '???'}):
+            response = self.client.get('/api/matches/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_matches_exclusion_does_not_grow_with_swipes(self):
+        def deck_queries():
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get('/api/matches/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [query['sql'] for query in captured.captured_queries]
+        
+        Match.objects.create(user1=self.user2, user2=self.user1)
+        deck_queries()  # the first read computes the match table
+        before = deck_queries()
+        for i in range(25):
+            MatchRejection.objects.create(user1=self.user1, user2=User.objects.create_user(username=f'swiped{i}'))
+        after = deck_queries()
+        
+        self.assertEqual([len(sql) for sql in before], [len(sql) for sql in after])
+        self.assertTrue(any('NOT EXISTS' in sql for sql in after))
+        response = self.client.get('/api/matches/')
+        self.assertEqual(response.data['count'], 0)
 
 
 class MatchAcceptTests(APITestCase):
@@ -753,8 +875,8 @@ class SpotifyCallbackTests(APITestCase):
         response = self.client.get('/api/spotify-auth/callback/?error=access_denied')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
-    @patch('harmony.views.requests.post')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.post')
+    @patch('harmony.views.spotify_client.get')
     def test_spotify_callback_no_access_token(self, mock_get, mock_post):
         """Test callback when no access token is returned"""
         mock_post.return_value.json.return_value = {}
@@ -762,8 +884,8 @@ class SpotifyCallbackTests(APITestCase):
         response = self.client.get('/api/spotify-auth/callback/?code=test_code')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
-    @patch('harmony.views.requests.post')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.post')
+    @patch('harmony.views.spotify_client.get')
     def test_spotify_callback_failed_user_profile(self, mock_get, mock_post):
         """Test callback when user profile fetch fails"""
         mock_post.return_value.json.return_value = {'access_token': 'token123'}
@@ -772,8 +894,8 @@ class SpotifyCallbackTests(APITestCase):
         response = self.client.get('/api/spotify-auth/callback/?code=test_code')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
-    @patch('harmony.views.requests.post')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.post')
+    @patch('harmony.views.spotify_client.get')
     def test_spotify_callback_invalid_json(self, mock_get, mock_post):
         """Test callback when profile response is invalid JSON"""
         mock_post.return_value.json.return_value = {'access_token': 'token123'}
@@ -784,8 +906,8 @@ class SpotifyCallbackTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
     @patch('harmony.views.get_spotify_users_fav_songs')
-    @patch('harmony.views.requests.post')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.post')
+    @patch('harmony.views.spotify_client.get')
     def test_spotify_callback_failed_fav_songs(self, mock_get, mock_post, mock_fav_songs):
         """Test callback when fetching favorite songs fails"""
         mock_post.return_value.json.return_value = {'access_token': 'token123'}
@@ -797,8 +919,14 @@ class SpotifyCallbackTests(APITestCase):
         }
         mock_fav_songs.return_value = None
         
+        # the import runs in the background now, the callback redirects right away
         response = self.client.get('/api/spotify-auth/callback/?code=test_code')
-        self.assertEqual(response.status_code, 417)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        mock_fav_songs.assert_not_called()
+        
+        job = run_import(claim_next_job())
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'Favorite song response from Spotify')
 
 
 class SpotifyDataTranslationTests(TestCase):
@@ -840,6 +968,123 @@ class SpotifyDataTranslationTests(TestCase):
         self.assertEqual(song.album, 'Album 1')
         self.assertIn(Artist.objects.get(spotify_id='artist_1'), song.artists.all())
     
+    def test_translate_spotify_songs_fetches_missing_embeds_concurrently(self):
+        Song.objects.create(name='Stored', spotify_id='stored', embed={'html': 'stored'})
+        fav_songs = [
+            {'id': spotify_id, 'name': spotify_id, 'external_urls': {'spotify': f'http://spotify.com/{spotify_id}'}}
+            for spotify_id in ['stored', 'new_1', 'new_2', 'new_3']
+        ]
+        threads = set()
+        
+        def slow_embed(url):
+            threads.add(threading.get_ident())
+            time.sleep(0.05)
+            return {'html': url}
+        
+        with patch('harmony.views.get_song_embed', side_effect=slow_embed) as mock_embed:
+            translate_spotify_songs(self.user, fav_songs)
+        
+        # the stored embed isn't fetched again, the others are fetched on the pool
+        self.assertEqual(sorted(call.args[0] for call in mock_embed.call_args_list),
+                         ['http://spotify.com/new_1', 'http://spotify.com/new_2', 'http://spotify.com/new_3'])
+        self.assertGreater(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(Song.objects.get(spotify_id='stored').embed, {'html': 'stored'})
+        self.assertEqual(Song.objects.get(spotify_id='new_2').embed, {'html': 'http://spotify.com/new_2'})
+        self.assertEqual(UserSongPreference.objects.filter(user=self.user).count(), 4)
+    
+    def test_failed_embed_fetched_again(self):
+        Song.objects.create(name='Legacy', spotify_id='legacy', embed={})
+        fav_songs = [
+            {'id': spotify_id, 'name': spotify_id, 'external_urls': {'spotify': f'http://spotify.com/{spotify_id}'}}
+            for spotify_id in ['legacy', 'flaky']
+        ]
+        
+        with patch('harmony.views.get_song_embed', return_value={}):
+            translate_spotify_songs(self.user, fav_songs)
+        self.assertIsNone(Song.objects.get(spotify_id='flaky').embed)
+        
+        with patch('harmony.views.get_song_embed', return_value={'html': 'fetched'}) as mock_embed:
+            translate_spotify_songs(self.user, fav_songs)
+        self.assertEqual(mock_embed.call_count, 2)
+        self.assertEqual(Song.objects.get(spotify_id='flaky').embed, {'html': 'fetched'})
+        self.assertEqual(Song.objects.get(spotify_id='legacy').embed, {'html': 'fetched'})
+    
+    def test_profile_skips_saving_failed_embeds(self):
+        song = Song.objects.create(name='Flaky', spotify_id='flaky', spotify_url='http://spotify.com/flaky')
+        UserSongPreference.objects.create(user=self.user, song=song, weight=5)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        
+        with patch('harmony.views.get_song_embed', return_value={}), \
+                CaptureQueriesContext(connection) as captured:
+            client.get('/api/users/profile/')
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in captured))
+        self.assertIsNone(Song.objects.get(id=song.id).embed)
+        
+        with patch('harmony.views.get_song_embed', return_value={'html': 'fetched'}):
+            client.get('/api/users/profile/')
+        self.assertEqual(Song.objects.get(id=song.id).embed, {'html': 'fetched'})
+    
+    def fav_songs(self, n, prefix):
+        return [
+            {
+                'id': f'{prefix}_song_{i}', 'name': f'Song {i}',
+                'external_urls': {'spotify': f'http://spotify.com/{prefix}/{i}'},
+                'artists': [{'id': f'{prefix}_artist_{i}', 'name': f'Artist {i}'}, {'id': 'shared_artist', 'name': 'Shared'}],
+            }
+            for i in range(n)
+        ]
+    
+    def fav_artists(self, n, prefix):
+        return [
+            {'id': f'{prefix}_artist_{i}', 'name': f'Artist {i}', 'genres': [f'{prefix} genre {i}', 'shared genre']}
+            for i in range(n)
+        ]
+    
+    @patch('harmony.views.get_song_embed', return_value={'html': '<iframe></iframe>'})
+    def test_translate_runs_constant_queries(self, mock_embed):
+        counts = []
+        for n in (2, 12):
+            user = User.objects.create_user(username=f'bulkuser{n}')
+            with CaptureQueriesContext(connection) as captured:
+                translate_spotify_songs(user, self.fav_songs(n, f'bulk{n}'))
+                translate_spotify_artist_and_genres(user, self.fav_artists(n, f'bulk{n}'))
+            counts.append(len(captured))
+            self.assertEqual(UserSongPreference.objects.filter(user=user).count(), n)
+            self.assertEqual(UserGenrePreference.objects.get(user=user, genre__name='shared genre').weight, min(10, n))
+        self.assertEqual(counts[0], counts[1])
+    
+    @patch('harmony.views.get_song_embed', return_value={'html': 'fetched'})
+    def test_translate_keeps_get_or_create_semantics(self, mock_embed):
+        existing = Artist.objects.create(name='Kept Name', spotify_id='same_artist_0', popularity=50)
+        song = Song.objects.create(name='Kept Song', spotify_id='same_song_1')
+        UserSongPreference.objects.create(user=self.user, song=song, weight=2)
+        
+        fav_songs = self.fav_songs(3, 'same')
+        fav_songs.append(dict(fav_songs[0], name='Renamed'))  # ranked twice, the last ranking wins
+        with self.captureOnCommitCallbacks(execute=True):
+            translate_spotify_songs(self.user, fav_songs)
+            translate_spotify_artist_and_genres(self.user, self.fav_artists(2, 'same'))
+        
+        self.assertEqual(Song.objects.get(spotify_id='same_song_0').name, 'Song 0')
+        self.assertEqual(Song.objects.get(id=song.id).name, 'Kept Song')
+        self.assertEqual(Song.objects.get(id=song.id).embed, {'html': 'fetched'})
+        self.assertEqual(Artist.objects.get(id=existing.id).name, 'Kept Name')
+        self.assertEqual(
+            set(Song.objects.get(spotify_id='same_song_0').artists.values_list('spotify_id', flat=True)),
+            {'same_artist_0', 'shared_artist'}
+        )
+        self.assertEqual(set(existing.genres.values_list('name', flat=True)), {'same genre 0', 'shared genre'})
+        self.assertEqual(
+            dict(UserSongPreference.objects.filter(user=self.user).values_list('song__spotify_id', 'weight')),
+            {'same_song_0': 7, 'same_song_1': 9, 'same_song_2': 8}
+        )
+        totals = UserPreferenceTotals.objects.get(user=self.user)
+        self.assertEqual((totals.song_total, totals.song_count), (24, 3))
+        self.assertEqual((totals.genre_total, totals.genre_count), (4, 3))
+        self.assertIn(song.id, candidate_index.user_items['song'][self.user.id])
+    
     def test_translate_spotify_artist_and_genres(self):
         """Test translating Spotify artists and genres"""
         fav_artists = [
@@ -879,7 +1124,7 @@ class SpotifyDataTranslationTests(TestCase):
 class SpotifyAPIFunctionsTests(TestCase):
     """Test Spotify API helper functions"""
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_spotify_users_fav_songs_success(self, mock_get):
         """Test fetching user's favorite songs from Spotify"""
         user = User.objects.create_user(username='apiuser')
@@ -900,7 +1145,7 @@ class SpotifyAPIFunctionsTests(TestCase):
         self.assertEqual(len(songs), 2)
         self.assertEqual(songs[0]['name'], 'Song 1')
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_spotify_users_fav_songs_failure(self, mock_get):
         """Test fetching favorite songs when API fails"""
         user = User.objects.create_user(username='apiuser2')
@@ -914,7 +1159,7 @@ class SpotifyAPIFunctionsTests(TestCase):
         songs = get_spotify_users_fav_songs(creds)
         self.assertIsNone(songs)
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_spotify_user_fav_artists_success(self, mock_get):
         """Test fetching user's favorite artists from Spotify"""
         user = User.objects.create_user(username='apiuser3')
@@ -935,7 +1180,7 @@ class SpotifyAPIFunctionsTests(TestCase):
         self.assertEqual(len(artists), 2)
         self.assertEqual(artists[0]['name'], 'Artist 1')
     
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_get_spotify_user_fav_artists_failure(self, mock_get):
         """Test fetching favorite artists when API fails"""
         user = User.objects.create_user(username='apiuser4')
@@ -958,9 +1203,12 @@ class SongSearchAdditionalTests(APITestCase):
         self.user = User.objects.create_user(username='searchuser')
         self.token, _ = Token.objects.get_or_create(user=self.user)
         self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        # the search results are cached across tests otherwise
+        cache.clear()
+        search_cache.clear()
     
     @patch('harmony.views.get_spotify_token')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_song_search_no_results(self, mock_get, mock_token):
         """Test song search with no results"""
         mock_token.return_value = 'token123'
@@ -972,7 +1220,7 @@ class SongSearchAdditionalTests(APITestCase):
         self.assertEqual(response.data['count'], 0)
     
     @patch('harmony.views.get_spotify_token')
-    @patch('harmony.views.requests.get')
+    @patch('harmony.views.spotify_client.get')
     def test_song_search_api_error(self, mock_get, mock_token):
         """Test song search when Spotify API returns error"""
         mock_token.return_value = 'token123'
@@ -981,6 +1229,23 @@ class SongSearchAdditionalTests(APITestCase):
         
         response = self.client.get('/api/search/?query=Song')
         self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+    
+    @patch.dict('os.environ', {'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret'})
+    @patch('harmony.views.spotify_client.get')
+    def test_song_search_token_failure(self, mock_get):
+        """Test song search when the app token can't be fetched"""
+        for error in (requests.ConnectTimeout(), SpotifyTokenError('Token retrieval failed:', 'invalid_client')):
+            with patch('harmony.views.get_spotify_token', side_effect=error):
+                response = self.client.get('/api/search/?query=Song')
+            self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        mock_get.assert_not_called()
+    
+    @patch.dict('os.environ', {'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret'})
+    @patch('harmony.views.get_spotify_token', side_effect=SpotifyTokenError('Token retrieval failed:', 'invalid_client'))
+    def test_create_song_token_failure(self, mock_token):
+        """Test adding a new song when the app token can't be fetched"""
+        response = self.client.post('/api/songs/', {'spotify_id': 'unknown_song', 'weight': 5})
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
 
 
 class MatchingFunctionsTests(APITestCase):
@@ -1007,25 +1272,49 @@ class MatchingFunctionsTests(APITestCase):
         ).count()
         self.assertEqual(match_count, 1)
     
+    def test_match_accept_either_side_is_one_match(self):
+        self.client.post('/api/matches/accept/', {'id': self.user2.id})
+        self.client.force_authenticate(self.user2)
+        response = self.client.post('/api/matches/accept/', {'id': self.user1.id})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        self.assertEqual(Match.objects.between(self.user1, self.user2).count(), 1)
+        self.assertEqual(Match.objects.count(), 1)
+        self.assertEqual(Conversation.objects.count(), 1)
+    
+    def test_match_accept_self(self):
+        response = self.client.post('/api/matches/accept/', {'id': self.user1.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Match.objects.exists())
+    
+    def test_match_accept_get_shows_other_users_picture(self):
+        self.user1.profile_image = 'profile_images/one.png'
+        self.user1.save()
+        Match.objects.create(user1=self.user1, user2=self.user2)
+        
+        self.client.force_authenticate(self.user2)
+        response = self.client.get('/api/matches/accept/')
+        self.assertIn('one.png', response.data[0]['profile_image'])
+    
     def test_match_reject_user_not_found(self):
         """Test rejecting a non-existent user"""
         data = {'id': 9999}
         response = self.client.post('/api/matches/reject/', data)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
     
-    @patch('harmony.views.compute_final_match_score')
+    @patch('harmony.match_table.MatchingEngine.component_scores')
     def test_get_full_matches(self, mock_score):
         """Test getting full matches with scores"""
-        mock_score.return_value = 85.5
+        mock_score.return_value = {self.user2.id: MatchComponents(0.5, 0.5, 0.5)}
         
         response = self.client.get('/api/matches/full/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('matches', response.data)
     
-    @patch('harmony.views.compute_final_match_score')
+    @patch('harmony.match_table.MatchingEngine.component_scores')
     def test_get_full_matches_filters_low_scores(self, mock_score):
         """Test that matches below threshold are filtered"""
-        mock_score.return_value = 0.2  # Below 0.3 threshold
+        mock_score.return_value = {self.user2.id: MatchComponents(0.1, 0.05, 0.05)}  # Below 0.3 threshold
         
         response = self.client.get('/api/matches/full/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -1037,4 +1326,1214 @@ class MatchingFunctionsTests(APITestCase):
         Match.objects.create(user1=self.user1, user2=self.user3)
         
         response = self.client.get('/api/matches/accept/')
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class MatchingEngineTests(APITestCase):
+    """Test the vectorized matching engine against the per-pair functions"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.users = [User.objects.create_user(username=f'engineuser{i}') for i in range(5)]
+        self.token, _ = Token.objects.get_or_create(user=self.users[0])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        
+        genres = [Genre.objects.create(name=f'engine genre {i}') for i in range(4)]
+        artists = [Artist.objects.create(name=f'Engine Artist {i}', spotify_id=f'engine_a{i}') for i in range(4)]
+        songs = [Song.objects.create(name=f'Engine Song {i}', spotify_id=f'engine_s{i}') for i in range(4)]
+        
+        # user 4 shares nothing with anyone
+        prefs = {
+            0: ([(0, 9), (1, 4)], [(0, 7), (2, 3)], [(0, 10), (1, 2)]),
+            1: ([(0, 3), (2, 8)], [(0, 7)], [(1, 6), (3, 5)]),
+            2: ([(1, 10)], [(2, 1), (3, 9)], []),
+            3: ([(0, 5), (1, 5), (2, 5)], [], [(0, 1)]),
+            4: ([(3, 6)], [(1, 2)], [(2, 4)]),
+        }
+        for idx, (genre_prefs, artist_prefs, song_prefs) in prefs.items():
+            user = self.users[idx]
+            for item, weight in genre_prefs:
+                UserGenrePreference.objects.create(user=user, genre=genres[item], weight=weight)
+            for item, weight in artist_prefs:
+                UserArtistPreference.objects.create(user=user, artist=artists[item], weight=weight)
+            for item, weight in song_prefs:
+                UserSongPreference.objects.create(user=user, song=songs[item], weight=weight)
+        
+        # the test transaction never commits, so load the candidate index directly
+        candidate_index.build()
+    
+    def test_components_match_pairwise_functions(self):
+        engine = MatchingEngine.from_db()
+        for user in self.users:
+            components = engine.component_scores(user.id)
+            for other in self.users:
+                if other == user:
+                    continue
+                expected = (
+                    compute_genre_similarity(user, other),
+                    compute_artist_similarity(user, other),
+                    compute_song_similarity(user, other),
+                )
+                self.assertEqual(tuple(components.get(other.id, (0.0, 0.0, 0.0))), expected)
+    
+    def test_final_scores_match_compute_final_match_score(self):
+        engine = MatchingEngine.from_db()
+        weights = {'genre_weight': 2.0, 'artist_weight': 0.5, 'song_weight': 1.5}
+        scores = engine.score_user(self.users[0].id, **weights)
+        for other in self.users[1:]:
+            expected = compute_final_match_score(self.users[0], other, **weights)
+            self.assertEqual(scores.get(other.id, 0.0), expected)
+        
+        self.assertNotIn(self.users[4].id, scores)
+        self.assertNotIn(self.users[0].id, scores)
+    
+    def test_sql_path_matches_engine(self):
+        engine = MatchingEngine.from_db()
+        weights = {'genre_weight': 1.5, 'artist_weight': 1.0, 'song_weight': 0.5}
+        for user in self.users:
+            self.assertEqual(
+                compute_final_match_scores_sql(user, **weights),
+                engine.score_user(user.id, **weights)
+            )
+        
+        with self.assertNumQueries(6):  # numerators + totals per dimension
+            compute_final_match_scores_sql(self.users[0])
+    
+    def test_sql_similarity_matches_pairwise_function(self):
+        for model, field_name in [(UserGenrePreference, 'genre'), (UserArtistPreference, 'artist'), (UserSongPreference, 'song')]:
+            sims = compute_weighted_similarity_sql(model, field_name, self.users[0])
+            for other in self.users[1:]:
+                self.assertEqual(
+                    sims.get(other.id, 0.0),
+                    compute_weighted_similarity(model, field_name, self.users[0], other)
+                )
+    
+    def test_user_without_preferences(self):
+        loner = User.objects.create_user(username='engineloner')
+        self.assertEqual(MatchingEngine.from_db().score_user(loner.id), {})
+    
+    def test_get_full_matches_uses_engine_scores(self):
+        response = self.client.get('/api/matches/full/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        expected = []
+        for other in self.users[1:]:
+            score = compute_final_match_score(self.users[0], other)
+            if score > 0.3:
+                expected.append((other.id, score))
+        expected.sort(key=lambda x: (-x[1], x[0]))
+        
+        self.assertEqual(
+            [(m['id'], m['final_score']) for m in response.data['matches']],
+            expected
+        )
+
+        self.assertEqual(response.data['stats']['candidates_scored'], 3)
+        self.assertEqual(response.data['stats']['candidates_pruned'], 1)
+
+    
+    def test_preference_sets_match_the_database_path(self):
+        sets = PreferenceSets.load()
+        expected = {
+            other.id: compute_final_match_score(self.users[0], other, 1.0, 2.0, 0.5)
+            for other in self.users[1:]
+        }
+        with self.assertNumQueries(0):
+            scores = {
+                other.id: compute_final_match_score(self.users[0], other, 1.0, 2.0, 0.5, sets=sets)
+                for other in self.users[1:]
+            }
+            # users without any preference of a dimension, and unknown users
+            self.assertEqual(compute_genre_similarity(self.users[4].id, 999999, sets=sets), 0.0)
+        self.assertEqual(scores, expected)
+    
+    def test_preference_sets_are_compact(self):
+        # 200 users with 50 weighted songs each, against the {item_id: weight} dict form
+        rows = [(user_id, 1000 + (user_id * 7 + n * 13) % 5000, 1 + n % 10) for user_id in range(200) for n in range(50)]
+        store = PreferenceSetStore.from_rows(rows)
+        dicts = {}
+        for user_id, item_id, weight in rows:
+            dicts.setdefault(user_id, {})[item_id] = weight
+        dict_bytes = sum(sys.getsizeof(d) + sum(sys.getsizeof(k) for k in d) for d in dicts.values())
+        
+        self.assertEqual((store.items.dtype.name, store.weights.dtype.name), ('int32', 'uint8'))
+        self.assertGreaterEqual(dict_bytes / store.nbytes, 5)
+        self.assertEqual(store.get(3).total, sum(dicts[3].values()))
+
+class CandidateIndexTests(TestCase):
+    """Test the inverted item -> users candidate index"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='indexuser1')
+        self.user2 = User.objects.create_user(username='indexuser2')
+        self.user3 = User.objects.create_user(username='indexuser3')
+        self.genre = Genre.objects.create(name='index genre')
+        self.artist = Artist.objects.create(name='Index Artist', spotify_id='index_a1')
+        self.song = Song.objects.create(name='Index Song', spotify_id='index_s1')
+        
+        UserGenrePreference.objects.create(user=self.user1, genre=self.genre, weight=5)
+        UserArtistPreference.objects.create(user=self.user2, artist=self.artist, weight=5)
+        candidate_index.build()
+    
+    def test_candidates_share_an_item(self):
+        UserGenrePreference.objects.create(user=self.user2, genre=self.genre, weight=3)
+        candidate_index.build()
+        
+        self.assertEqual(candidate_index.candidates(self.user1.id), {self.user2.id})
+        self.assertEqual(candidate_index.candidates(self.user3.id), set())
+    
+    def test_index_follows_committed_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            pref = UserSongPreference.objects.create(user=self.user1, song=self.song, weight=4)
+            UserSongPreference.objects.create(user=self.user3, song=self.song, weight=9)
+        self.assertEqual(candidate_index.candidates(self.user1.id), {self.user3.id})
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            pref.delete()
+        self.assertEqual(candidate_index.candidates(self.user1.id), set())
+        self.assertEqual(candidate_index.candidates(self.user3.id), set())
+    
+    def test_uncommitted_changes_are_not_indexed(self):
+        UserArtistPreference.objects.create(user=self.user3, artist=self.artist, weight=2)
+        self.assertEqual(candidate_index.candidates(self.user2.id), set())
+    
+    def test_rebuilds_when_another_process_changed_preferences(self):
+        UserArtistPreference.objects.create(user=self.user3, artist=self.artist, weight=2)
+        
+        # simulate a commit made by a different worker
+        bump_preference_version()
+        
+        self.assertEqual(candidate_index.candidates(self.user2.id), {self.user3.id})
+        self.assertEqual(candidate_index.version, get_preference_version())
+
+
+class MatchTableTests(APITestCase):
+    """Test the persisted top-K match table"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(username='tableuser1')
+        self.user2 = User.objects.create_user(username='tableuser2')
+        self.user3 = User.objects.create_user(username='tableuser3')
+        self.token, _ = Token.objects.get_or_create(user=self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        
+        self.genre = Genre.objects.create(name='table genre')
+        self.artist = Artist.objects.create(name='Table Artist', spotify_id='table_a1')
+        self.song = Song.objects.create(name='Table Song', spotify_id='table_s1')
+        
+        UserGenrePreference.objects.create(user=self.user1, genre=self.genre, weight=8)
+        UserGenrePreference.objects.create(user=self.user2, genre=self.genre, weight=6)
+        UserArtistPreference.objects.create(user=self.user1, artist=self.artist, weight=5)
+        UserArtistPreference.objects.create(user=self.user3, artist=self.artist, weight=5)
+        candidate_index.build()
+    
+    def table_of(self, user):
+        return dict(MatchScore.objects.filter(user=user).values_list('candidate_id', 'final_score'))
+    
+    def test_first_read_computes_table(self):
+        response = self.client.get('/api/matches/full/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        self.assertEqual(self.table_of(self.user1), {self.user2.id: 0.857, self.user3.id: 1.0})
+        self.assertFalse(MatchScoreStatus.objects.get(user=self.user1).dirty)
+        self.assertEqual(
+            [(m['id'], m['final_score'], m['genre_match']) for m in response.data['matches']],
+            [(self.user3.id, 1.0, 0.0), (self.user2.id, 0.857, 0.857)]
+        )
+    
+    def test_reads_are_a_single_lookup_once_computed(self):
+        refresh_match_table(self.user1.id)
+        # token auth, status, scores
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/matches/full/')
+        self.assertEqual(len(response.data['matches']), 2)
+    
+    def test_preference_change_rescores_both_directions(self):
+        refresh_match_table(self.user1.id)
+        refresh_match_table(self.user3.id)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            UserSongPreference.objects.create(user=self.user3, song=self.song, weight=4)
+            UserSongPreference.objects.create(user=self.user1, song=self.song, weight=4)
+        
+        self.assertEqual(self.table_of(self.user1)[self.user3.id], 2.0)
+        self.assertEqual(self.table_of(self.user3)[self.user1.id], 2.0)
+        # user2 never read its table, so it is left to compute on first use
+        self.assertFalse(MatchScoreStatus.objects.filter(user=self.user2).exists())
+    
+    def test_removed_overlap_drops_reverse_entry(self):
+        refresh_match_table(self.user2.id)
+        self.assertIn(self.user1.id, self.table_of(self.user2))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            UserGenrePreference.objects.filter(user=self.user1, genre=self.genre).delete()
+        
+        self.assertNotIn(self.user1.id, self.table_of(self.user2))
+        self.assertEqual(self.table_of(self.user1), {self.user3.id: 1.0})
+    
+    def test_table_keeps_top_k(self):
+        refresh_match_table(self.user1.id)
+        self.assertLessEqual(MatchScore.objects.filter(user=self.user1).count(), TOP_K)
+        
+        with patch('harmony.match_table.TOP_K', 1):
+            refresh_match_table(self.user1.id)
+        self.assertEqual(list(self.table_of(self.user1)), [self.user3.id])
+    
+    def test_entering_full_tables_runs_constant_queries(self):
+        counts = []
+        for n in (3, 10):
+            genre = Genre.objects.create(name=f'full table genre {n}')
+            filler = User.objects.create_user(username=f'fulltablefiller{n}')
+            owners = [User.objects.create_user(username=f'fulltableowner{n}_{i}') for i in range(n)]
+            for owner in owners:
+                UserGenrePreference.objects.create(user=owner, genre=genre, weight=5)
+                MatchScore.objects.create(user=owner, candidate=filler, final_score=0.1)
+                MatchScoreStatus.objects.create(user=owner, dirty=False)
+            newcomer = User.objects.create_user(username=f'fulltablenewcomer{n}')
+            UserGenrePreference.objects.create(user=newcomer, genre=genre, weight=5)
+            candidate_index.build()
+            
+            with patch('harmony.match_table.TOP_K', 1), CaptureQueriesContext(connection) as captured:
+                rescore_user(newcomer.id)
+            counts.append(len(captured))
+            for owner in owners:
+                self.assertEqual(list(self.table_of(owner)), [newcomer.id])
+        self.assertEqual(counts[0], counts[1])
+    
+    def test_weight_settings_change_reranks_from_cached_pairs(self):
+        refresh_match_table(self.user1.id)
+        
+        with patch('harmony.match_table.MatchingEngine.from_db', side_effect=AssertionError('rescored')):
+            self.client.post('/api/settings/match-weights/', {'artist_weight': 0.0})
+            response = self.client.get('/api/matches/full/')
+        
+        self.assertFalse(MatchScoreStatus.objects.get(user=self.user1).dirty)
+        self.assertEqual([m['id'] for m in response.data['matches']], [self.user2.id])
+    
+    def test_weight_settings_change_before_first_read(self):
+        self.client.post('/api/settings/match-weights/', {'genre_weight': 2.0})
+        response = self.client.get('/api/matches/full/')
+        self.assertEqual(response.data['matches'][0]['final_score'], 1.714)
+    
+    def test_pair_similarities_are_cached_once_per_pair(self):
+        refresh_match_table(self.user1.id)
+        refresh_match_table(self.user2.id)
+        
+        pair = PairSimilarity.objects.get(user_high=self.user2)
+        self.assertEqual(pair.user_low_id, self.user1.id)
+        self.assertEqual((pair.genre_sim, pair.artist_sim, pair.song_sim), (0.857, 0.0, 0.0))
+        self.assertEqual(PairSimilarity.objects.count(), 2)
+        self.assertEqual(
+            cached_components(self.user1.id),
+            {self.user2.id: MatchComponents(0.857, 0.0, 0.0), self.user3.id: MatchComponents(0.0, 1.0, 0.0)}
+        )
+    
+    def test_dirty_table_is_reranked_not_rescored(self):
+        refresh_match_table(self.user1.id)
+        MatchScoreStatus.objects.filter(user=self.user1).update(dirty=True)
+        MatchScore.objects.filter(user=self.user1).delete()
+        
+        with patch('harmony.match_table.MatchingEngine.from_db', side_effect=AssertionError('rescored')):
+            response = self.client.get('/api/matches/full/')
+        self.assertEqual(len(response.data['matches']), 2)
+
+
+class PreferenceTotalsTests(TestCase):
+    """Test the denormalized per-user preference totals"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='totalsuser')
+        self.other = User.objects.create_user(username='totalsother')
+        self.song1 = Song.objects.create(name='Totals Song 1', spotify_id='totals_s1')
+        self.song2 = Song.objects.create(name='Totals Song 2', spotify_id='totals_s2')
+    
+    def totals(self):
+        return UserPreferenceTotals.objects.get(user=self.user)
+    
+    def test_new_user_has_empty_totals(self):
+        totals = self.totals()
+        self.assertEqual((totals.song_total, totals.song_count, totals.genre_total), (0, 0, 0))
+    
+    def test_totals_follow_create_update_delete(self):
+        pref = UserSongPreference.objects.create(user=self.user, song=self.song1, weight=7)
+        UserSongPreference.objects.create(user=self.user, song=self.song2, weight=2)
+        self.assertEqual((self.totals().song_total, self.totals().song_count), (9, 2))
+        
+        pref.weight = 10
+        pref.save()
+        self.assertEqual((self.totals().song_total, self.totals().song_count), (12, 2))
+        
+        UserSongPreference.objects.filter(user=self.user, song=self.song2).delete()
+        self.assertEqual((self.totals().song_total, self.totals().song_count), (10, 1))
+    
+    def test_totals_roll_back_with_the_preference(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                UserSongPreference.objects.create(user=self.user, song=self.song1, weight=7)
+                raise RuntimeError
+        self.assertEqual(self.totals().song_total, 0)
+    
+    def test_refresh_after_bulk_write(self):
+        UserSongPreference.objects.bulk_create([
+            UserSongPreference(user=self.user, song=self.song1, weight=3),
+            UserSongPreference(user=self.user, song=self.song2, weight=4),
+        ])
+        refresh_preference_totals(self.user.id)
+        self.assertEqual((self.totals().song_total, self.totals().song_count), (7, 2))
+    
+    def test_deleting_user_removes_totals(self):
+        UserSongPreference.objects.create(user=self.user, song=self.song1, weight=7)
+        self.user.delete()
+        self.assertFalse(UserPreferenceTotals.objects.filter(user_id=self.user.id).exists())
+    
+    def test_pairwise_similarity_reads_totals_not_full_lists(self):
+        UserSongPreference.objects.create(user=self.user, song=self.song1, weight=6)
+        UserSongPreference.objects.create(user=self.user, song=self.song2, weight=4)
+        UserSongPreference.objects.create(user=self.other, song=self.song1, weight=8)
+        
+        with self.assertNumQueries(2):  # shared-item aggregate + totals lookup
+            similarity = compute_song_similarity(self.user, self.other)
+        self.assertEqual(similarity, round(2 * 6 / 18, 3))
+
+
+class MinHashLSHTests(TestCase):
+    """Test the approximate minhash/lsh candidate retrieval"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='lshuser1')
+        self.user2 = User.objects.create_user(username='lshuser2')
+        self.user3 = User.objects.create_user(username='lshuser3')
+        self.genres = [Genre.objects.create(name=f'lsh genre {i}') for i in range(6)]
+        self.song = Song.objects.create(name='LSH Song', spotify_id='lsh_s1')
+        
+        # user1 and user2 weigh the same genres, user3 shares nothing with them
+        for genre in self.genres[:3]:
+            UserGenrePreference.objects.create(user=self.user1, genre=genre, weight=6)
+            UserGenrePreference.objects.create(user=self.user2, genre=genre, weight=6)
+        for genre in self.genres[3:]:
+            UserGenrePreference.objects.create(user=self.user3, genre=genre, weight=6)
+        candidate_index.build()
+        lsh_index.build()
+    
+    def test_weighted_tokens(self):
+        self.assertEqual(len(preference_tokens({'genre': {1: 3, 2: 10}, 'song': {1: 1}})), 14)
+        # the same item id in another dimension is a different token
+        self.assertEqual(
+            len(set(preference_tokens({'genre': {1: 1}, 'artist': {1: 1}}).tolist())), 2
+        )
+    
+    def test_similar_users_collide_and_unrelated_do_not(self):
+        index = MinHashLSH(bands=16, rows=4)
+        index.add(1, {'genre': {10: 5, 11: 5}})
+        index.add(2, {'genre': {10: 5, 11: 5}})
+        index.add(3, {'song': {99: 5}})
+        
+        self.assertEqual(index.query(1), {2})
+        self.assertEqual(index.query(3), set())
+        
+        index.remove(2)
+        self.assertEqual(index.query(1), set())
+    
+    def test_approximate_mode_rescores_candidates_exactly(self):
+        with patch('harmony.match_table.MATCHING_MODE', 'approximate'):
+            refresh_match_table(self.user1.id)
+        
+        row = MatchScore.objects.get(user=self.user1)
+        self.assertEqual(row.candidate_id, self.user2.id)
+        self.assertEqual((row.final_score, row.genre_match), (1.0, 1.0))
+        self.assertFalse(MatchScore.objects.filter(user=self.user1, candidate=self.user3).exists())
+    
+    def test_committed_changes_refresh_signatures(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for genre in self.genres[:3]:
+                UserGenrePreference.objects.create(user=self.user3, genre=genre, weight=6)
+            UserGenrePreference.objects.filter(user=self.user3, genre__in=self.genres[3:]).delete()
+        
+        self.assertIn(self.user3.id, lsh_index.candidates(self.user1.id))
+        self.assertEqual(lsh_index.version, get_preference_version())
+
+
+class FullMatchesPaginationTests(APITestCase):
+    """Test limit/cursor paging of the full matches endpoint"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='pageuser')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        
+        # a computed table with a tie on 0.9 and one row under the 0.3 cut-off
+        self.others = [User.objects.create_user(username=f'pageother{i}') for i in range(6)]
+        for other, score in zip(self.others, [0.9, 1.5, 0.9, 0.4, 2.1, 0.2]):
+            MatchScore.objects.create(
+                user=self.user, candidate=other, final_score=score,
+                genre_match=score, artist_match=0.0, song_match=0.0
+            )
+        MatchScoreStatus.objects.create(user=self.user, dirty=False, pairs_cached=True)
+    
+    def test_pages_walk_the_table_in_order(self):
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/matches/full/', params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['matches']), 2)
+            seen.extend(m['id'] for m in response.data['matches'])
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+        
+        o = self.others
+        self.assertEqual(seen, [o[4].id, o[1].id, o[0].id, o[2].id, o[3].id])
+    
+    def test_cursor_is_stable_when_rows_above_it_change(self):
+        response = self.client.get('/api/matches/full/', {'limit': 2})
+        cursor = response.data['next_cursor']
+        
+        # a new best match doesn't shift the next page
+        newcomer = User.objects.create_user(username='pagenewcomer')
+        MatchScore.objects.create(
+            user=self.user, candidate=newcomer, final_score=3.0,
+            genre_match=1.0, artist_match=1.0, song_match=1.0
+        )
+        response = self.client.get('/api/matches/full/', {'limit': 2, 'cursor': cursor})
+        self.assertEqual([m['id'] for m in response.data['matches']], [self.others[0].id, self.others[2].id])
+    
+    def test_page_cost_does_not_depend_on_position(self):
+        response = self.client.get('/api/matches/full/', {'limit': 1})
+        # token auth, status, one page of scores
+        with self.assertNumQueries(3):
+            self.client.get('/api/matches/full/', {'limit': 1, 'cursor': response.data['next_cursor']})
+    
+    def test_invalid_parameters(self):
+        for params in ({'limit': 'ten'}, {'limit': 0}, {'limit': 1000}, {'cursor': 'not-a-cursor'}):
+            response = self.client.get('/api/matches/full/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('error', response.data)
+
+
+class RecomputeMatchesCommandTests(TestCase):
+    """Test the offline recompute_matches command"""
+    
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'recompute{i}') for i in range(4)]
+        self.genre = Genre.objects.create(name='recompute genre')
+        self.song = Song.objects.create(name='Recompute Song', spotify_id='recompute_s1')
+        
+        for user, weight in zip(self.users[:3], [8, 6, 8]):
+            UserGenrePreference.objects.create(user=user, genre=self.genre, weight=weight)
+        UserSongPreference.objects.create(user=self.users[0], song=self.song, weight=5)
+        UserSongPreference.objects.create(user=self.users[2], song=self.song, weight=5)
+        self.match = Match.objects.create(user1=self.users[2], user2=self.users[0])
+        candidate_index.build()
+    
+    def recompute(self, *args):
+        out = StringIO()
+        call_command('recompute_matches', *args, stdout=out)
+        return out.getvalue()
+    
+    def test_matches_the_incremental_tables(self):
+        expected = {}
+        for user in self.users:
+            refresh_match_table(user.id)
+            expected[user.id] = set(MatchScore.objects.filter(user=user).values_list('candidate_id', 'final_score'))
+        MatchScore.objects.all().delete()
+        PairSimilarity.objects.all().delete()
+        
+        output = self.recompute('--workers', '0', '--chunk-size', '2')
+        
+        for user in self.users:
+            self.assertEqual(
+                set(MatchScore.objects.filter(user=user).values_list('candidate_id', 'final_score')),
+                expected[user.id]
+            )
+            self.assertEqual(cached_components(user.id), MatchingEngine.from_db().component_scores(user.id))
+        self.assertIn('3 pairs', output)
+        self.assertIn('pairs/s', output)
+    
+    def test_fills_match_breakdown(self):
+        self.recompute('--workers', '0')
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.genre_match, self.match.song_match), (1.0, 1.0))
+        self.assertEqual(self.match.compatibilty_score, 66.7)
+    
+    def test_shards_split_the_users(self):
+        self.recompute('--workers', '0', '--shard', '1/2')
+        written = set(MatchScoreStatus.objects.values_list('user_id', flat=True))
+        self.assertEqual(written, {user.id for user in self.users if user.id % 2 == 1})
+    
+    def test_process_pool(self):
+        self.recompute('--workers', '2', '--chunk-size', '1')
+        self.assertEqual(MatchScoreStatus.objects.filter(dirty=False, pairs_cached=True).count(), 4)
+        self.assertEqual(MatchScore.objects.filter(user=self.users[3]).count(), 0)
+    
+    def test_invalid_shard(self):
+        for shard in ('2/2', 'one/two', '0/0'):
+            with self.assertRaises(CommandError):
+                self.recompute('--shard', shard)
+
+
+class MatchingSnapshotTests(TestCase):
+    """Test the memory-mapped preference matrix snapshots"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        
+        self.user1 = User.objects.create_user(username='snapshotuser1')
+        self.user2 = User.objects.create_user(username='snapshotuser2')
+        self.genre = Genre.objects.create(name='snapshot genre')
+        self.song = Song.objects.create(name='Snapshot Song', spotify_id='snapshot_s1')
+        UserGenrePreference.objects.create(user=self.user1, genre=self.genre, weight=8)
+        UserGenrePreference.objects.create(user=self.user2, genre=self.genre, weight=6)
+        UserSongPreference.objects.create(user=self.user1, song=self.song, weight=3)
+        candidate_index.build()
+    
+    def test_snapshot_is_mapped_read_only_and_scores_the_same(self):
+        snapshot = load_snapshot(self.tmp.name, write_snapshot(self.tmp.name))
+        
+        self.assertEqual(snapshot.preference_version, get_preference_version())
+        genre = snapshot.engine.matrices['genre']
+        self.assertFalse(genre.csr.data.flags.writeable)
+        self.assertFalse(genre.csc.indices.flags.writeable)
+        self.assertEqual(
+            snapshot.engine.component_scores(self.user1.id),
+            MatchingEngine.from_db().component_scores(self.user1.id)
+        )
+    
+    def test_current_points_at_newest_snapshot(self):
+        self.assertIsNone(current_snapshot_name(self.tmp.name))
+        first = write_snapshot(self.tmp.name)
+        self.assertEqual(current_snapshot_name(self.tmp.name), first)
+        
+        UserSongPreference.objects.create(user=self.user2, song=self.song, weight=3)
+        second = write_snapshot(self.tmp.name)
+        self.assertEqual(current_snapshot_name(self.tmp.name), second)
+        snapshot = load_snapshot(self.tmp.name, second)
+        self.assertEqual(snapshot.engine.component_scores(self.user1.id)[self.user2.id].song, 1.0)
+    
+    def test_old_snapshots_are_pruned(self):
+        names = [write_snapshot(self.tmp.name, keep=2) for _ in range(4)]
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.tmp.name) if name != 'CURRENT'),
+            names[2:]
+        )
+    
+    def test_requests_never_score_from_snapshot(self):
+        write_snapshot(self.tmp.name)
+        with override_settings(HARMONY_MATCHING_SNAPSHOT_DIR=self.tmp.name), \
+                patch('harmony.snapshot.load_snapshot') as load, \
+                patch('harmony.match_table.MatchingEngine.from_db', wraps=MatchingEngine.from_db) as from_db:
+            refresh_match_table(self.user1.id)
+        load.assert_not_called()
+        from_db.assert_called()
+        self.assertEqual(MatchScore.objects.get(user=self.user1).genre_match, 0.857)
+    
+    def test_recompute_from_snapshot(self):
+        with override_settings(HARMONY_MATCHING_SNAPSHOT_DIR=self.tmp.name):
+            call_command('write_matching_snapshot', stdout=StringIO())
+            out = StringIO()
+            call_command('recompute_matches', '--from-snapshot', '--workers', '0', stdout=out)
+        
+        self.assertIn('scoring from snapshot', out.getvalue())
+        self.assertEqual(MatchScore.objects.get(user=self.user2).candidate_id, self.user1.id)
+        self.assertNotIn('preferences changed', out.getvalue())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            UserSongPreference.objects.create(user=self.user2, song=self.song, weight=3)
+        with override_settings(HARMONY_MATCHING_SNAPSHOT_DIR=self.tmp.name):
+            out = StringIO()
+            call_command('recompute_matches', '--from-snapshot', '--workers', '0', stdout=out)
+        self.assertIn('preferences changed since the snapshot was written', out.getvalue())
+
+
+class BenchmarkGeneratorTests(TestCase):
+    """Test the synthetic data generator of the benchmark suite"""
+    
+    def test_generates_consistent_data(self):
+        dataset = generate(40, seed=3, request_users=5)
+        self.assertEqual(len(dataset.user_ids), 40)
+        self.assertEqual(len(dataset.tokens), 5)
+        self.assertTrue(UserSongPreference.objects.filter(user_id=dataset.user_ids[0]).exists())
+        
+        # totals written alongside the bulk inserts match a recount
+        user_id = dataset.user_ids[7]
+        written = UserPreferenceTotals.objects.values().get(user_id=user_id)
+        refresh_preference_totals(user_id)
+        self.assertEqual(UserPreferenceTotals.objects.values().get(user_id=user_id), written)
+    
+    def test_zipf_sampler_is_deterministic_and_skewed(self):
+        first = zipf_sampler(np.random.default_rng(1), 1000)(5000)
+        second = zipf_sampler(np.random.default_rng(1), 1000)(5000)
+        self.assertEqual(first.tolist(), second.tolist())
+        self.assertGreater((first < 10).sum(), (first >= 990).sum() * 10)
+    
+    def test_scenarios_report_percentiles_queries_and_memory(self):
+        dataset = generate(20, seed=1, request_users=2)
+        candidate_index.build()
+        result = measure(SCENARIOS['full_matches_warm'], dataset, repeat=2, memory_runs=1)
+        self.assertEqual(result['samples'], 2)
+        self.assertEqual(result['queries_per_run'], 3)
+        self.assertGreater(result['peak_memory_kb'], 0)
+
+
+class QueryBudgetTests(APITestCase):
+    """Test that endpoints stay within their declared SQL query budgets"""
+    
+    SIZES = (1, 6)
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='budgetuser')
+        self.token, _ = Token.objects.get_or_create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.created = 0
+    
+    def make_users(self, n):
+        users = []
+        for _ in range(n):
+            self.created += 1
+            user = User.objects.create_user(username=f'budgetother{self.created}')
+            song = Song.objects.create(name=f'Budget Song {self.created}', spotify_id=f'budget_s{self.created}')
+            artist = Artist.objects.create(name=f'Budget Artist {self.created}', spotify_id=f'budget_a{self.created}')
+            UserSongPreference.objects.create(user=user, song=song, weight=4)
+            UserArtistPreference.objects.create(user=user, artist=artist, weight=4)
+            users.append(user)
+        return users
+    
+    def test_matches(self):
+        for n in self.SIZES:
+            User.objects.exclude(id=self.user.id).delete()
+            self.make_users(n)
+            candidate_index.build()
+            refresh_match_table(self.user.id)
+            with query_budget('matches', n):
+                response = self.client.get('/api/matches/')
+            self.assertEqual(response.data['count'], n)
+    
+    def test_match_accept_get(self):
+        for n in self.SIZES:
+            Match.objects.all().delete()
+            for other in self.make_users(n):
+                Match.objects.create(user1=self.user, user2=other)
+            with query_budget('match_accept_get', n):
+                response = self.client.get('/api/matches/accept/')
+            self.assertEqual(len(response.data), n)
+    
+    @patch('harmony.views.get_song_embed', return_value={'html': '<iframe></iframe>'})
+    def test_profile(self, mock_embed):
+        genre = Genre.objects.create(name='budget genre')
+        UserGenrePreference.objects.create(user=self.user, genre=genre, weight=3)
+        for n in self.SIZES:
+            UserSongPreference.objects.filter(user=self.user).delete()
+            for i in range(n):
+                song = Song.objects.create(name=f'Budget Profile Song {n}-{i}', spotify_id=f'budget_p{n}_{i}')
+                song.genres.add(genre)
+                UserSongPreference.objects.create(user=self.user, song=song, weight=5)
+            with query_budget('profile', n):
+                response = self.client.get('/api/users/profile/')
+            self.assertEqual(response.data['stats']['total_songs'], n)
+    
+    @patch.dict('os.environ', {'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret'})
+    @patch('harmony.views.get_spotify_token', return_value='token123')
+    @patch('harmony.views.spotify_client.get')
+    def test_song_search(self, mock_get, mock_token):
+        cache.clear()
+        search_cache.clear()
+        for n in (1, 3):  # spotify is asked for 3 tracks at most
+            tracks = []
+            for i in range(n):
+                song = Song.objects.get_or_create(name=f'Budget Search {i}', spotify_id=f'budget_search{i}')[0]
+                UserSongPreference.objects.get_or_create(user=self.user, song=song, defaults={'weight': 6})
+                tracks.append({'id': song.spotify_id, 'name': song.name, 'artists': []})
+            mock_get.return_value = MagicMock(status_code=200)
+            mock_get.return_value.json.return_value = {'tracks': {'items': tracks}}
+            
+            with query_budget('song_search', n):
+                response = self.client.get(f'/api/search/?query=budget{n}')
+            self.assertTrue(all(song['in_favorites'] for song in response.data['songs']))
+    
+    def test_full_matches(self):
+        for n in self.SIZES:
+            MatchScore.objects.all().delete()
+            for other in self.make_users(n):
+                MatchScore.objects.create(user=self.user, candidate=other, final_score=1.0)
+            MatchScoreStatus.objects.update_or_create(user=self.user, defaults={'dirty': False, 'pairs_cached': True})
+            with query_budget('full_matches', n):
+                response = self.client.get('/api/matches/full/')
+            self.assertEqual(len(response.data['matches']), n)
+    
+    def test_next_match(self):
+        for n in self.SIZES:
+            User.objects.exclude(id=self.user.id).delete()
+            self.make_users(n)
+            candidate_index.build()
+            refill_queue(self.user.id)
+            with query_budget('next_match', n):
+                response = self.client.get('/api/matches/next/')
+            self.assertEqual(response.data['remaining'], n)
+    
+    def test_exceeded_budget_lists_query_patterns(self):
+        users = self.make_users(4)
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget('full_matches', 0):
+                for user in users:
+                    list(UserSongPreference.objects.filter(user=user))
+        message = str(raised.exception)
+        self.assertIn('budget is 3', message)
+        self.assertIn('4 x SELECT', message)
+        self.assertIn('"harmony_usersongpreference"."user_id" = ?', message)
+
+
+class DiscoveryQueueTests(APITestCase):
+    """Test the precomputed per-user discovery queue"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user1 = User.objects.create_user(username='queueuser1')
+        self.user2 = User.objects.create_user(username='queueuser2')
+        self.user3 = User.objects.create_user(username='queueuser3')
+        self.user4 = User.objects.create_user(username='queueuser4')
+        self.token, _ = Token.objects.get_or_create(user=self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        
+        genre = Genre.objects.create(name='queue genre')
+        artist = Artist.objects.create(name='Queue Artist', spotify_id='queue_a1')
+        UserGenrePreference.objects.create(user=self.user1, genre=genre, weight=8)
+        UserGenrePreference.objects.create(user=self.user2, genre=genre, weight=6)
+        UserArtistPreference.objects.create(user=self.user1, artist=artist, weight=5)
+        UserArtistPreference.objects.create(user=self.user3, artist=artist, weight=5)
+        candidate_index.build()
+    
+    def queued(self, user):
+        return list(DiscoveryQueueEntry.objects.filter(user=user).values_list('candidate_id', flat=True))
+    
+    def test_refill_queues_ranked_candidates(self):
+        MatchRejection.objects.create(user1=self.user1, user2=self.user4)
+        queue = refill_queue(self.user1.id)
+        
+        # best score first, the rejected user never
+        self.assertEqual(self.queued(self.user1), [self.user3.id, self.user2.id])
+        self.assertEqual(queue.size, 2)
+        self.assertFalse(queue.needs_refill)
+    
+    def test_refill_appends_behind_existing_entries(self):
+        with patch('harmony.discovery_queue.QUEUE_SIZE', 1):
+            refill_queue(self.user1.id)
+        refill_queue(self.user1.id)
+        
+        self.assertEqual(self.queued(self.user1), [self.user3.id, self.user2.id, self.user4.id])
+    
+    def test_pop_below_low_water_requests_refill(self):
+        refill_queue(self.user1.id)
+        with patch('harmony.discovery_queue.LOW_WATER', 3):
+            self.assertTrue(pop_candidate(self.user1.id, self.user3.id))
+            self.assertFalse(pop_candidate(self.user1.id, self.user3.id))
+        
+        queue = DiscoveryQueue.objects.get(user=self.user1)
+        self.assertEqual(queue.size, 2)
+        self.assertTrue(queue.needs_refill)
+    
+    # the test runs worker and client in one process, so the in-memory cache is shared
+    @patch('harmony.management.commands.refill_discovery_queues.per_process_backends', return_value=[])
+    def test_worker_refills_pending_queues(self, mock_backends):
+        DiscoveryQueue.objects.create(user=self.user1)
+        DiscoveryQueue.objects.create(user=self.user2, needs_refill=False)
+        call_command('refill_discovery_queues', '--once', stdout=StringIO())
+        
+        self.assertEqual(len(self.queued(self.user1)), 3)
+        self.assertEqual(self.queued(self.user2), [])
+        self.assertFalse(DiscoveryQueue.objects.filter(needs_refill=True).exists())
+    
+    def test_worker_refuses_per_process_cache(self):
+        with self.assertRaisesMessage(CommandError, 'CACHES must be shared'):
+            call_command('refill_discovery_queues', '--once', stdout=StringIO())
+    
+    def test_next_serves_queue_head(self):
+        response = self.client.get('/api/matches/next/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['match']['id'], self.user3.id)
+        self.assertEqual(response.data['match']['final_score'], 1.0)
+        self.assertEqual(response.data['remaining'], 3)
+    
+    def test_swipes_pop_the_queue(self):
+        refill_queue(self.user1.id)
+        refill_queue(self.user3.id)
+        self.client.post('/api/matches/reject/', {'id': self.user2.id})
+        self.client.post('/api/matches/accept/', {'id': self.user3.id})
+        
+        self.assertEqual(self.queued(self.user1), [self.user4.id])
+        self.assertNotIn(self.user1.id, self.queued(self.user3))
+        response = self.client.get('/api/matches/next/')
+        self.assertEqual(response.data['match']['id'], self.user4.id)
+    
+    def test_next_without_candidates(self):
+        User.objects.exclude(id=self.user1.id).delete()
+        response = self.client.get('/api/matches/next/')
+        self.assertIsNone(response.data['match'])
+        self.assertEqual(response.data['remaining'], 0)
+
+
+class HotQueryIndexTests(TestCase):
+    """Test that the hot lookups are index searches, not table scans, per EXPLAIN QUERY PLAN"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='plainuser1')
+        self.user2 = User.objects.create_user(username='plainuser2')
+    
+    def assertUsesIndex(self, queryset, table, index=None):
+        # index is any part of the plan line naming it, or the columns it searches
+        if connection.vendor != 'sqlite':
+            self.skipTest('plans are asserted against sqlite output')
+        plan = queryset.explain()
+        self.assertNotIn(f'SCAN {table}', plan)
+        self.assertNotIn('USE TEMP B-TREE', plan)
+        self.assertIn(f'SEARCH {table} USING', plan)
+        if index:
+            self.assertIn(index, plan)
+    
+    def test_preferences_by_weight(self):
+        for model, table, index in [
+            (UserSongPreference, 'harmony_usersongpreference', 'songpref_user_weight_idx'),
+            (UserArtistPreference, 'harmony_userartistpreference', 'artistpref_user_weight_idx'),
+            (UserGenrePreference, 'harmony_usergenrepreference', 'genrepref_user_weight_idx'),
+        ]:
+            with self.subTest(model=model.__name__):
+                self.assertUsesIndex(model.objects.filter(user=self.user1).order_by('-weight'), table, index)
+    
+    def test_matches_of_a_user(self):
+        # sqlite backs the unique pair constraint with an autoindex of its own naming
+        self.assertUsesIndex(Match.objects.between(self.user1, self.user2), 'harmony_match', 'user1_id=? AND user2_id=?')
+        self.assertUsesIndex(Match.objects.filter(user1=self.user1), 'harmony_match')
+        self.assertUsesIndex(Match.objects.filter(user2=self.user1), 'harmony_match')
+    
+    def test_rejection_pair(self):
+        self.assertUsesIndex(
+            MatchRejection.objects.filter(user1=self.user1, user2=self.user2),
+            'harmony_matchrejection', 'matchrejection_pair_idx'
+        )
+    
+    def test_conversation_history(self):
+        conversation = Conversation.objects.create(match=Match.objects.create(user1=self.user1, user2=self.user2))
+        self.assertUsesIndex(
+            ChatMessage.objects.filter(conversation=conversation),
+            'chat_message', 'message_conversation_sent_idx'
+        )
+
+
+class SpotifyTokenCacheTests(APITestCase):
+    """Test the shared, cached Spotify app token"""
+    
+    def setUp(self):
+        cache.clear()
+    
+    def token_response(self, token='token123', expires_in=3600):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'access_token': token, 'expires_in': expires_in}
+        return response
+    
+    @patch('harmony.spotify.spotify_client.post')
+    def test_token_reused_until_expiry(self, mock_post):
+        manager = AppTokenManager(margin=60)
+        mock_post.return_value = self.token_response()
+        with patch('harmony.spotify.cache.set', wraps=cache.set) as mock_set:
+            self.assertEqual(manager.get_token('id', 'secret'), 'token123')
+            self.assertEqual(manager.get_token('id', 'secret'), 'token123')
+        
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_set.call_args.kwargs['timeout'], 3540)
+        self.assertEqual(manager.stats()['hits'], 1)
+        self.assertEqual(manager.stats()['misses'], 1)
+        
+        manager.invalidate('id')
+        mock_post.return_value = self.token_response('token456')
+        self.assertEqual(manager.get_token('id', 'secret'), 'token456')
+    
+    @patch('harmony.spotify.spotify_client.post')
+    def test_concurrent_misses_refresh_once(self, mock_post):
+        def slow_token(*args, **kwargs):
+            time.sleep(0.2)
+            return self.token_response()
+        mock_post.side_effect = slow_token
+        
+        manager = AppTokenManager()
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token('id', 'secret'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(tokens, ['token123'] * 5)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(manager.stats()['refreshes'], 1)
+    
+    @patch('harmony.spotify.spotify_client.post')
+    def test_failed_refresh_releases_lock(self, mock_post):
+        manager = AppTokenManager()
+        mock_post.return_value = MagicMock(status_code=500, text='down')
+        with self.assertRaises(SpotifyTokenError):
+            manager.get_token('id', 'secret')
+        
+        mock_post.return_value = self.token_response()
+        self.assertEqual(manager.get_token('id', 'secret'), 'token123')
+        self.assertEqual(manager.stats()['waits'], 0)
+    
+    def test_metrics_are_staff_only(self):
+        user = User.objects.create_user(username='metricsuser')
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.get('/api/metrics/spotify/').status_code, status.HTTP_403_FORBIDDEN)
+        
+        user.is_staff = True
+        user.save()
+        response = self.client.get('/api/metrics/spotify/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('hits', response.data['token'])
+
+
+class SpotifyClientTests(TestCase):
+    """Test the pooled Spotify HTTP client's timeouts, retries and latency stats"""
+    
+    def setUp(self):
+        self.client = SpotifyClient(timeout=(1, 2), retries=2)
+        self.sleep = patch('harmony.spotify.time.sleep').start()
+        self.addCleanup(patch.stopall)
+    
+    def response(self, status_code, headers=None):
+        return MagicMock(status_code=status_code, headers=headers or {})
+    
+    def test_timeouts_and_pooled_session(self):
+        with patch.object(self.client.session, 'request', return_value=self.response(200)) as request:
+            self.client.get('https://api.spotify.com/v1/me', endpoint='me')
+        self.assertEqual(request.call_args.kwargs['timeout'], (1, 2))
+        self.assertEqual(self.client.session.get_adapter('https://api.spotify.com')._pool_maxsize, 20)
+    
+    def test_retries_honour_retry_after(self):
+        responses = [self.response(429, {'Retry-After': '3'}), self.response(503), self.response(200)]
+        with patch.object(self.client.session, 'request', side_effect=responses) as request:
+            response = self.client.get('https://api.spotify.com/v1/search', endpoint='search')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+        waits = [call.args[0] for call in self.sleep.call_args_list]
+        self.assertEqual(waits[0], 3.0)
+        self.assertLessEqual(waits[1], 0.5)  # jittered backoff of the second attempt
+        stats = self.client.stats()['search']
+        self.assertEqual((stats['calls'], stats['retries']), (3, 2))
+        self.assertIsNotNone(stats['p95_ms'])
+    
+    def test_gives_up_after_bounded_retries(self):
+        with patch.object(self.client.session, 'request', side_effect=requests.ReadTimeout) as request:
+            with self.assertRaises(requests.ReadTimeout):
+                self.client.get('https://open.spotify.com/oembed', endpoint='oembed')
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(self.client.stats()['oembed']['errors'], 3)
+    
+    def test_long_retry_after_is_not_waited_for(self):
+        with patch.object(self.client.session, 'request', return_value=self.response(429, {'Retry-After': '120'})) as request:
+            response = self.client.get('https://api.spotify.com/v1/search')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(request.call_count, 1)
+        self.sleep.assert_not_called()
+    
+    def test_posts_are_only_retried_before_sending(self):
+        with patch.object(self.client.session, 'request', return_value=self.response(503)) as request:
+            self.client.post('https://accounts.spotify.com/api/token')
+        self.assertEqual(request.call_count, 1)
+        
+        with patch.object(self.client.session, 'request', side_effect=[requests.ConnectTimeout, self.response(200)]) as request:
+            self.client.post('https://accounts.spotify.com/api/token')
+        self.assertEqual(request.call_count, 2)
+        
+        with patch.object(self.client.session, 'request', side_effect=requests.ReadTimeout) as request:
+            with self.assertRaises(requests.ReadTimeout):
+                self.client.post('https://accounts.spotify.com/api/token')
+        self.assertEqual(request.call_count, 1)
+
+
+class SpotifyImportJobTests(APITestCase):
+    """Test the background Spotify onboarding import"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='importuser')
+        SpotifyCredentials.objects.create(user=self.user, access_token='token123')
+        self.client.force_authenticate(self.user)
+    
+    # the test runs worker and client in one process, so the in-memory backends are shared
+    @patch('harmony.management.commands.run_spotify_imports.per_process_backends', return_value=[])
+    @patch('harmony.views.translate_spotify_artist_and_genres')
+    @patch('harmony.views.translate_spotify_songs')
+    @patch('harmony.views.get_spotify_user_fav_artists', return_value=[{'id': 'a1'}])
+    @patch('harmony.views.get_spotify_users_fav_songs', return_value=[{'id': 's1'}])
+    def test_worker_runs_import_and_notifies(self, mock_songs, mock_artists, mock_translate_songs, mock_translate_artists, mock_backends):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'chat_{self.user.id}', channel)
+        
+        job = enqueue_import(self.user)
+        self.assertEqual(self.client.get('/api/spotify-auth/import-status/').data['job']['status'], 'pending')
+        call_command('run_spotify_imports', '--once', stdout=StringIO())
+        
+        mock_translate_songs.assert_called_once_with(self.user, [{'id': 's1'}])
+        mock_translate_artists.assert_called_once_with(self.user, [{'id': 'a1'}])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('done', 1))
+        self.assertEqual(self.client.get('/api/spotify-auth/import-status/').data['job']['status'], 'done')
+        
+        running = async_to_sync(layer.receive)(channel)
+        done = async_to_sync(layer.receive)(channel)
+        self.assertEqual(running['type'], 'spotify.import')
+        self.assertEqual((running['job']['status'], done['job']['status']), ('running', 'done'))
+    
+    def test_worker_refuses_per_process_backends(self):
+        with self.assertRaisesMessage(CommandError, 'CACHES and CHANNEL_LAYERS must be shared'):
+            call_command('run_spotify_imports', '--once', stdout=StringIO())
+        
+        messages = [message.id for message in check_shared_backends(None)]
+        self.assertEqual(messages, ['harmony.W001', 'harmony.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}):
+            self.assertEqual(per_process_backends(), ['CHANNEL_LAYERS'])
+    
+    def test_job_is_claimed_once(self):
+        job = enqueue_import(self.user)
+        self.assertEqual(claim_next_job().id, job.id)
+        self.assertIsNone(claim_next_job())
+    
+    def test_stale_running_job_is_claimed_again(self):
+        job = SpotifyImportJob.objects.create(
+            user=self.user, status='running', attempts=1,
+            started_at=timezone.now() - STALE_AFTER - timedelta(seconds=1)
+        )
+        self.assertEqual(claim_next_job().attempts, 2)
+        
+        SpotifyImportJob.objects.filter(id=job.id).update(
+            attempts=MAX_ATTEMPTS, started_at=timezone.now() - STALE_AFTER - timedelta(seconds=1)
+        )
+        self.assertIsNone(claim_next_job())
+    
+    def test_stale_job_on_last_attempt_fails(self):
+        job = SpotifyImportJob.objects.create(
+            user=self.user, status='running', attempts=MAX_ATTEMPTS,
+            started_at=timezone.now() - STALE_AFTER - timedelta(seconds=1)
+        )
+        self.assertIsNone(claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(self.client.get('/api/spotify-auth/import-status/').data['job']['status'], 'failed')
+    
+    @patch('harmony.views.get_spotify_users_fav_songs', side_effect=RuntimeError('spotify hiccup'))
+    def test_unexpected_error_is_retried(self, mock_songs):
+        enqueue_import(self.user)
+        job = run_import(claim_next_job())
+        self.assertEqual(job.status, 'pending')
+        self.assertIn('spotify hiccup', job.error)
+    
+    def test_status_without_import(self):
+        response = self.client.get('/api/spotify-auth/import-status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.data['job'])
+
+
+class SpotifySearchCacheTests(APITestCase):
+    """Test the shared cache of Spotify search results"""
+    
+    def setUp(self):
+        cache.clear()
+        search_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='searchcacheuser')
+        self.other = User.objects.create_user(username='searchcacheother')
+        self.song = Song.objects.create(name='Cached Song', spotify_id='cached1')
+        UserSongPreference.objects.create(user=self.other, song=self.song, weight=7)
+    
+    def search_response(self):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'tracks': {'items': [
+            {'id': 'cached1', 'name': 'Cached Song', 'artists': []},
+            {'id': 'cached2', 'name': 'Other Song', 'artists': []},
+        ]}}
+        return response
+    
+    def search(self, user, query):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return self.client.get('/api/search/', {'query': query})
+    
+    @patch.dict('os.environ', {'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret'})
+    @patch('harmony.views.get_spotify_token', return_value='token123')
+    @patch('harmony.views.spotify_client.get')
+    def test_results_shared_with_per_user_overlay(self, mock_get, mock_token):
+        mock_get.return_value = self.search_response()
+        
+        first = self.search(self.user, 'Cached  Song ')
+        second = self.search(self.other, 'cached song')
+        
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_token.call_count, 1)
+        self.assertEqual([song['in_favorites'] for song in first.data['songs']], [False, False])
+        self.assertEqual([song['in_favorites'] for song in second.data['songs']], [True, False])
+        self.assertEqual(second.data['songs'][0]['weight'], 7)
+    
+    @patch.dict('os.environ', {'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret'})
+    @patch('harmony.views.get_spotify_token', return_value='token123')
+    @patch('harmony.views.spotify_client.get')
+    def test_failed_search_not_cached(self, mock_get, mock_token):
+        mock_get.return_value = MagicMock(status_code=503, text='unavailable')
+        self.assertEqual(self.search(self.user, 'song').status_code, status.HTTP_502_BAD_GATEWAY)
+        
+        mock_get.return_value = self.search_response()
+        self.assertEqual(self.search(self.user, 'song').data['count'], 2)
+        self.assertEqual(mock_get.call_count, 2)
+    
+    def test_entries_expire(self):
+        search = SearchCache(ttl=60)
+        with patch('harmony.spotify.time.time', return_value=1000.0):
+            search.set('song', 3, ['result'], 0.2)
+        with patch('harmony.spotify.time.time', return_value=1059.0):
+            self.assertEqual(search.get('song', 3), ['result'])
+        cache.clear()
+        with patch('harmony.spotify.time.time', return_value=1061.0):
+            self.assertIsNone(search.get('song', 3))
+    
+    def test_least_recently_used_evicted(self):
+        search = SearchCache(local_size=2)
+        search.set('a', 3, ['a'], 0.1)
+        search.set('b', 3, ['b'], 0.1)
+        search.get('a', 3)
+        search.set('c', 3, ['c'], 0.1)
+        
+        self.assertEqual(list(search.local), [search.key('a', 3), search.key('c', 3)])
+        # b is still in the shared cache
+        self.assertEqual(search.get('b', 3), ['b'])
+        self.assertEqual(search.stats()['shared_hits'], 1)
+    
+    def test_large_results_not_cached(self):
+        search = SearchCache(max_bytes=100)
+        search.set('big', 3, ['x' * 200], 0.1)
+        self.assertIsNone(search.get('big', 3))
+    
+    def test_stats(self):
+        search = SearchCache()
+        self.assertIsNone(search.stats()['hit_ratio'])
+        search.get('song', 3)
+        search.set('song', 3, ['result'], 0.25)
+        search.get('Song', 3)
+        search.get('song ', 3)
+        search.get('song', 10)
+        
+        stats = search.stats()
+        self.assertEqual((stats['local_hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertEqual(stats['saved_upstream_ms'], 500.0)
+    
+    def test_metrics_endpoint(self):
+        staff = User.objects.create_user(username='searchcachestaff', is_staff=True)
+        token, _ = Token.objects.get_or_create(user=staff)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        response = self.client.get('/api/metrics/spotify/')
+        self.assertIn('hit_ratio', response.data['search'])
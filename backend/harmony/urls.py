@@ -1,7 +1,7 @@
 # harmony/urls.py
 from rest_framework.routers import DefaultRouter
 from django.urls import path, include
-from .views import UserViewSet, song_search, SongViewSet, spotify_callback, spotify_login, matches, match_reject, match_accept, get_full_matches, match_weight_settings 
+from .views import UserViewSet, song_search, SongViewSet, spotify_callback, spotify_login, spotify_import_status, matches, next_match, match_reject, match_accept, get_full_matches, match_weight_settings, spotify_metrics
 from rest_framework.authtoken.views import obtain_auth_token
 
 router = DefaultRouter()
@@ -12,10 +12,13 @@ urlpatterns = [
     path('search/', song_search),
     path('spotify-auth/login/', spotify_login),
     path('spotify-auth/callback/', spotify_callback),
+    path('spotify-auth/import-status/', spotify_import_status),
     path('api-token-auth/', obtain_auth_token, name='api_token_auth'),  # to obtain token
     path('matches/', matches),
+    path('matches/next/', next_match),
     path('matches/reject/', match_reject),
     path('matches/accept/', match_accept),
     path('matches/full/', get_full_matches, name='full_matches'),
     path('settings/match-weights/', match_weight_settings),
+    path('metrics/spotify/', spotify_metrics),
 ]
@@ -1,6 +1,6 @@
 from django.shortcuts import redirect
 from rest_framework import viewsets, permissions, status 
-from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated, IsAdminUser
 from .models import User, Song, Artist, Genre, UserSongPreference, UserArtistPreference, UserGenrePreference, Match, MatchRejection, MatchWeightSettings
 from .serializers import UserSerializer, SongSerializer, MatchWeightSettingsSerializer
 from .permissions import IsSelfOrReadOnly
@@ -8,14 +8,23 @@ from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.http import JsonResponse, HttpResponseRedirect
-import base64
 import requests
 import os 
-from django.db import transaction, models
+import time
+from django.db import transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
 from dotenv import load_dotenv
-from .matching_utils import compute_final_match_score
+from .match_table import (
+    ensure_match_table, rerank_match_table, mark_dirty, page_of_scores, discovery_page,
+    PAGE_SIZE, MAX_PAGE_SIZE
+)
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from chat.models import Conversation
+from .discovery_queue import next_entry, pop_candidate
+from .spotify import app_token_manager, search_cache, spotify_client, SpotifyTokenError
+from .spotify_import import enqueue_import, job_status, ids_by, link_all, upsert_preferences
 class UserViewSet(viewsets.ModelViewSet):
     
     queryset = User.objects.all()
@@ -83,14 +92,20 @@ class UserViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(request.user)
         # Get favorite songs with weights (sorted by weight)
         song_preferences = UserSongPreference.objects.filter(user=user).select_related('song').prefetch_related('song__artists', 'song__genres').order_by('-weight')
+        song_preferences = list(song_preferences)
+        #if songs don't have an embed fetch them all at once and save only those
+        missing_embed = [pref.song for pref in song_preferences if not has_embed(pref.song)]
+        if missing_embed:
+            embeds = fetch_song_embeds(song.spotify_url for song in missing_embed)
+            fetched = [song for song in missing_embed if embeds.get(song.spotify_url) is not None]
+            for song in fetched:
+                song.embed = embeds[song.spotify_url]
+            if fetched:
+                Song.objects.bulk_update(fetched, ['embed'])
+
         favorite_songs = []
         for pref in song_preferences:
             song = pref.song
-            #if song doesn't have an embed search for it 
-            if not song.embed:
-                song.embed = get_song_embed(song.spotify_url)
-            
-            song.save() 
 
             favorite_songs.append({
                 'id': song.id,
@@ -217,13 +232,19 @@ class SongViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_503_SERVICE_UNAVAILABLE
                 )
             
-            token = get_spotify_token(client_id, client_secret)
-            
             # Fetch song details from Spotify
-            response = requests.get(
-                f"https://api.spotify.com/v1/tracks/{spotify_id}",
-                headers={"Authorization": f"Bearer {token}"}
-            )
+            try:
+                token = get_spotify_token(client_id, client_secret)
+                response = spotify_client.get(
+                    f"https://api.spotify.com/v1/tracks/{spotify_id}",
+                    headers={"Authorization": f"Bearer {token}"},
+                    endpoint='track'
+                )
+            except (requests.RequestException, SpotifyTokenError):
+                return Response(
+                    {"error": "Spotify did not answer"},
+                    status=status.HTTP_502_BAD_GATEWAY
+                )
             
             if response.status_code != 200:
                 return Response(
@@ -246,7 +267,7 @@ class SongViewSet(viewsets.ModelViewSet):
             )
             
             embed = get_song_embed(song.spotify_url)
-            song.embed = embed
+            song.embed = embed or None
             song.save() 
             
             # Add artists to the song
@@ -342,24 +363,16 @@ class SongViewSet(viewsets.ModelViewSet):
 
 
 
-#TODO: store the token and refresh every hour instead of making a request everytime
 def get_spotify_token(client_id, client_secret):
-    auth_string = f"{client_id}:{client_secret}"
-    auth_base64 = base64.b64encode(auth_string.encode()).decode()
-
-    response = requests.post(
-        "https://accounts.spotify.com/api/token",
-        headers={"Authorization": f"Basic {auth_base64}"},
-        data={"grant_type": "client_credentials"}
-    )
+    # the app token is shared through the cache until shortly before it expires, see harmony/spotify.py
+    return app_token_manager.get_token(client_id, client_secret)
 
-    if response.status_code == 200:
-        return response.json().get("access_token")
-    else:
-        raise Exception("Token retrieval failed:", response.text)
+# tracks per search, part of the search cache key
+SEARCH_LIMIT = 3
 
 #return list of songs from spotify based on query
 
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def song_search(request):
@@ -373,82 +386,65 @@ def song_search(request):
     if not client_secret or not client_id:
         return Response({"detail": "Client Secret and Client ID not received from environment" }, status= status.HTTP_503_SERVICE_UNAVAILABLE)
     
-    token = get_spotify_token(client_id, client_secret)
+    query = request.GET.get('query', None)
     
-    if(token):
-        query = request.GET.get('query', None)
-        
-        if not query :
-            return Response("Must Input A Song Query", status= status.HTTP_400_BAD_REQUEST)
-        
+    if not query :
+        return Response("Must Input A Song Query", status= status.HTTP_400_BAD_REQUEST)
+    
+    # the results are the same for everyone, only in_favorites and weight are per user
+    songs = search_cache.get(query, SEARCH_LIMIT)
+    if songs is None:
         url = "https://api.spotify.com/v1/search"
         params = {
             'q': query,
             'type': 'track',
-            'limit': 3,
+            'limit': SEARCH_LIMIT,
             # 'market': 'ES',
             # 'offset':0,
         }
-        header = {
-            'Authorization': f'Bearer {token}'
-        }
-        
-        response = requests.get(url, headers=header, params=params)
         
+        try:
+            token = get_spotify_token(client_id, client_secret)
+            header = {
+                'Authorization': f'Bearer {token}'
+            }
+            start = time.perf_counter()
+            response = spotify_client.get(url, headers=header, params=params, endpoint='search')
+        except (requests.RequestException, SpotifyTokenError) as error:
+            return Response(
+                {"error": "Failed to search Spotify", "details": str(error)},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
          
-    if response.status_code != 200:
-        return Response(
-            {"error": "Failed to search Spotify", "details": response.text},
-            status=status.HTTP_502_BAD_GATEWAY
-        )
-    
-    data = response.json()
+        if response.status_code != 200:
+            return Response(
+                {"error": "Failed to search Spotify", "details": response.text},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+        
+        data = response.json()
+        songs = [format_search_track(track) for track in (data.get('tracks') or {}).get('items') or []]
+        search_cache.set(query, SEARCH_LIMIT, songs, time.perf_counter() - start)
     
-    if not data.get('tracks') or not data['tracks'].get('items'):
+    if not songs:
         return Response({
             'count': 0,
             'songs': []
         })
     
-    # Format songs to match your model structure
-    songs = []
-    for track in data['tracks']['items']:
-        # Check if song already exists in database and if user has it
-        user_has_song = False
-        song_weight = 0
-        
-        try:
-            existing_song = Song.objects.get(spotify_id=track['id'])
-            pref = UserSongPreference.objects.filter(
-                user=request.user, 
-                song=existing_song
-            ).first()
-            if pref:
-                user_has_song = True
-                song_weight = pref.weight
-        except Song.DoesNotExist:
-            pass
-        
-        songs.append({
-            'spotify_id': track['id'],
-            'name': track['name'],
-            'album': track.get('album', {}).get('name', ''),
-            'album_image_url': track.get('album', {}).get('images', [{}])[0].get('url', '') if track.get('album', {}).get('images') else '',
-            'spotify_url': track.get('external_urls', {}).get('spotify', ''),
-            'preview_url': track.get('preview_url', ''),
-            'duration_ms': track.get('duration_ms'),
-            'popularity': track.get('popularity', 0),
-            'artists': [
-                {
-                    'spotify_id': artist['id'],
-                    'name': artist['name'],
-                    'spotify_url': artist.get('external_urls', {}).get('spotify', '')
-                }
-                for artist in track.get('artists', [])
-            ],
-            'in_favorites': user_has_song,  # NEW: tells frontend if user already has this song
-            'weight': song_weight  # NEW: the weight if they have it
-        })
+    # Check which of the songs the user already has, in one query
+    weights = dict(UserSongPreference.objects.filter(
+        user=request.user,
+        song__spotify_id__in=[song['spotify_id'] for song in songs]
+    ).values_list('song__spotify_id', 'weight'))
+    songs = [
+        {
+            **song,
+            'in_favorites': song['spotify_id'] in weights,  # NEW: tells frontend if user already has this song
+            'weight': weights.get(song['spotify_id'], 0)  # NEW: the weight if they have it
+        }
+        for song in songs
+    ]
     
     return Response({
         'count': len(songs),
@@ -456,6 +452,28 @@ def song_search(request):
     })
 
 
+def format_search_track(track):
+    # Format songs to match your model structure
+    return {
+        'spotify_id': track['id'],
+        'name': track['name'],
+        'album': track.get('album', {}).get('name', ''),
+        'album_image_url': track.get('album', {}).get('images', [{}])[0].get('url', '') if track.get('album', {}).get('images') else '',
+        'spotify_url': track.get('external_urls', {}).get('spotify', ''),
+        'preview_url': track.get('preview_url', ''),
+        'duration_ms': track.get('duration_ms'),
+        'popularity': track.get('popularity', 0),
+        'artists': [
+            {
+                'spotify_id': artist['id'],
+                'name': artist['name'],
+                'spotify_url': artist.get('external_urls', {}).get('spotify', '')
+            }
+            for artist in track.get('artists', [])
+        ],
+    }
+
+
 
 @api_view(['GET'])
 def spotify_login(request):
@@ -493,8 +511,12 @@ def spotify_callback(request):
         'client_id': os.getenv('CLIENT_ID'),
         'client_secret': os.getenv('CLIENT_SECRET'),
     }
-    token_response = requests.post(token_url, data=payload)
-    token_data = token_response.json()
+    # an authorization code works once, so this post is only retried when it never got out
+    try:
+        token_response = spotify_client.post(token_url, data=payload, endpoint='user_token')
+        token_data = token_response.json()
+    except (requests.RequestException, ValueError):
+        return JsonResponse({"error": "Failed to retrieve Spotify token"}, status=400)
 
     access_token = token_data.get('access_token')
     refresh_token = token_data.get('refresh_token')
@@ -506,10 +528,14 @@ def spotify_callback(request):
         return JsonResponse({"error": "Failed to retrieve Spotify token"}, status=400)
     
     # use access token to get Spotify user's profile info
-    user_profile_response = requests.get(
-        "https://api.spotify.com/v1/me",
-        headers={"Authorization": f"Bearer {access_token}"}
-    )
+    try:
+        user_profile_response = spotify_client.get(
+            "https://api.spotify.com/v1/me",
+            headers={"Authorization": f"Bearer {access_token}"},
+            endpoint='me'
+        )
+    except requests.RequestException as error:
+        return JsonResponse({"error": "Failed to fetch user profile from Spotify", "response": str(error)}, status=400)
     
     if user_profile_response.status_code != 200:
         return JsonResponse({
@@ -553,30 +579,10 @@ def spotify_callback(request):
         }
     )
 
-    #if new user was created initialize their spotify fav songs and stuff 
+    #if new user was created import their spotify fav songs and stuff in the background,
+    #the frontend polls /api/spotify-auth/import-status/ or hears about it over the websocket
     if(created):
-        user_credentials= SpotifyCredentials.objects.get(user=user)
-
-        time_frame = 'medium_term'
-
-        #the fav songs will contain the artists, genres, and songs info 
-        fav_songs = get_spotify_users_fav_songs(user_credentials, time_frame=time_frame); #get fav songs from spotify
-        if fav_songs is None: 
-             return JsonResponse({
-            "error": "Favorite song response from Spotify",
-            "response_text": user_profile_response.text
-        }, status =417) 
-
-        fav_artists  = get_spotify_user_fav_artists(user_credentials, time_frame=time_frame) 
-        if fav_artists is None: 
-             return JsonResponse({
-            "error": "Favorite artist response from Spotify",
-            "response_text": user_profile_response.text
-        }, status =417) 
-        
-        #tranlate the list of objects into the correct models and save for the user 
-        translate_spotify_songs(user, fav_songs)
-        translate_spotify_artist_and_genres(user, fav_artists)
+        enqueue_import(user)
     
     
     # Create DRF token for authentication with your API
@@ -588,117 +594,172 @@ def spotify_callback(request):
     print("Redirect: " ,frontend_redirect)
     return redirect(frontend_redirect)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def spotify_import_status(request):
+    job = request.user.spotify_imports.order_by('-created_at', '-id').first()
+    if job is None:
+        return Response({'job': None})
+    return Response({'job': job_status(job)})
+
+
 #taked in the spotify url of the songs and get the embed in form of json 
 def get_song_embed( url):
-    response = requests.get(
-        f'https://open.spotify.com/oembed?url={url}'
-    )
+    try:
+        response = spotify_client.get(
+            f'https://open.spotify.com/oembed?url={url}', endpoint='oembed'
+        )
+    except requests.RequestException:
+        return {}
 
     if response.status_code != 200:
         return {}
     
     embed =  response.json();
     return embed 
-    
-     
+
+
+# oembed requests in flight at once per import or profile
+EMBED_WORKERS = 8
+
+
+# a song still needs its embed when it has none, or only the {} a failed fetch used to store.
+# the import filters with MISSING_EMBED and the profile with has_embed, they must agree
+MISSING_EMBED = Q(embed__isnull=True) | Q(embed={})
+
+
+def has_embed(song):
+    return bool(song.embed)
+
+
+def fetch_song_embeds(urls):
+    """
+    {url: embed} for every url, fetched concurrently on a bounded thread pool. a failed
+    fetch is None, so it's never stored and the song is tried again next time
+    """
+    urls = list(dict.fromkeys(url for url in urls if url))
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(EMBED_WORKERS, len(urls))) as pool:
+        return {url: embed or None for url, embed in zip(urls, pool.map(get_song_embed, urls))}
+
+
+def spotify_song_url(song_data):
+    return song_data.get('external_urls').get('spotify') if  song_data.get('external_urls') else ''
+
+
+def translate_spotify_songs(user, fav_songs):
+    # the embeds are fetched up front and all at once, skipping songs we already have one
+    # for, so the transaction only holds fast database writes
+    stored = set(
+        Song.objects.filter(spotify_id__in=[song_data['id'] for song_data in fav_songs]).exclude(MISSING_EMBED)
+        .values_list('spotify_id', flat=True)
+    )
+    embeds = fetch_song_embeds(spotify_song_url(song_data) for song_data in fav_songs if song_data['id'] not in stored)
+    save_spotify_songs(user, fav_songs, embeds)
+
 
 @transaction.atomic #if something fails roll back everything
-def translate_spotify_songs(user,fav_songs):
+def save_spotify_songs(user, fav_songs, embeds):
+    # a constant number of queries for the whole list: every table is read once, then the
+    # missing rows, links and preferences are written in bulk (see harmony/spotify_import.py)
+    songs = {}
+    artists = {}
+    song_artists = []
+    weights = {}
     for idx, song_data in enumerate(fav_songs):
         
-        # based on the song's name get the embed for it
-        spotify_url = song_data.get('external_urls').get('spotify') if  song_data.get('external_urls') else ''
-        song_embed = get_song_embed (spotify_url) 
-
-        # get or create the song
-        song, created = Song.objects.get_or_create(
-            spotify_id=song_data['id'],
-            defaults={
-                'name': song_data['name'],
-                'album': song_data.get('album', {}).get('name', ''),
-                'album_image_url': song_data.get('album', {}).get('images', [{}])[0].get('url', '') if song_data.get('album', {}).get('images') else '',
-                'popularity': song_data.get('popularity', 0),
-                'duration_ms': song_data.get('duration_ms'),
-                'preview_url': song_data.get('preview_url', ''),
-                "spotify_url": spotify_url, 
-                'embed' : song_embed
-            }
-        )
+        spotify_url = spotify_song_url(song_data)
+
+        # the first time a song shows up decides how it is created
+        songs.setdefault(song_data['id'], {
+            'name': song_data['name'],
+            'album': song_data.get('album', {}).get('name', ''),
+            'album_image_url': song_data.get('album', {}).get('images', [{}])[0].get('url', '') if song_data.get('album', {}).get('images') else '',
+            'popularity': song_data.get('popularity', 0),
+            'duration_ms': song_data.get('duration_ms'),
+            'preview_url': song_data.get('preview_url', ''),
+            "spotify_url": spotify_url, 
+            'embed' : embeds.get(spotify_url)
+        })
         
         # Link all artists to this song
         for artist_data in song_data.get('artists', []):
-            artist, _ = Artist.objects.get_or_create(
-                spotify_id=artist_data['id'],
-                defaults={ # all lot of the values will get overidden in next api call 
-                    'name': artist_data['name'],
-                    'image_url': '', 
-                    'popularity': 0,
-                }
-            )
-            # add artist to song
-            song.artists.add(artist)
+            artists.setdefault(artist_data['id'], { # all lot of the values will get overidden in next api call 
+                'name': artist_data['name'],
+                'image_url': '', 
+                'popularity': 0,
+            })
+            song_artists.append((song_data['id'], artist_data['id']))
 
-        
-        # Create user preference with weight based on ranking
-        weight = max(1, 10 - idx)  
-        UserSongPreference.objects.update_or_create(
-            user=user,
-            song=song,  # Fixed: was 'artist=song'
-            defaults={'weight': weight}
-        )
+        # user preference with weight based on ranking, the last ranking of a song wins
+        weights[song_data['id']] = max(1, 10 - idx)
+
+    song_ids = ids_by(Song, 'spotify_id', songs)
+    artist_ids = ids_by(Artist, 'spotify_id', artists)
+    link_all(Song.artists.through, 'song', 'artist',
+             [(song_ids[song_id], artist_ids[artist_id]) for song_id, artist_id in song_artists])
+
+    # songs we had without an embed get the one just fetched
+    missing_embed = Song.objects.filter(MISSING_EMBED, id__in=song_ids.values())
+    fill = [
+        Song(id=song_id, embed=songs[spotify_id]['embed'])
+        for spotify_id, song_id in missing_embed.values_list('spotify_id', 'id')
+        if songs[spotify_id]['embed'] is not None
+    ]
+    if fill:
+        Song.objects.bulk_update(fill, ['embed'])
+
+    upsert_preferences(UserSongPreference, 'song', 'song', user,
+                       {song_ids[song_id]: weight for song_id, weight in weights.items()})
 
 @transaction.atomic #if something fails roll back everything
 def translate_spotify_artist_and_genres(user, fav_artists)   :
     
     #the genres that appear the most will have the most weight 
     genre_weights = {}
+    artists = {}
+    artist_genres = []
+    weights = {}
     
     for idx, artist_data in enumerate(fav_artists):
-        # Create or get artist
-        artist, created = Artist.objects.get_or_create(
-            spotify_id=artist_data['id'],
-            defaults={
-                'name': artist_data['name'],
-                'image_url': artist_data.get('images', [{}])[0].get('url', '') if artist_data.get('images') else '',
-                'popularity': artist_data.get('popularity', 0)
-            }
-        )
+        artists.setdefault(artist_data['id'], {
+            'name': artist_data['name'],
+            'image_url': artist_data.get('images', [{}])[0].get('url', '') if artist_data.get('images') else '',
+            'popularity': artist_data.get('popularity', 0)
+        })
 
-        # Create artist preference
-        weight = max(1, 10 - idx)
-        UserArtistPreference.objects.update_or_create(
-            user=user,
-            artist=artist,
-            defaults={'weight': weight}
-        )
+        # artist preference, the last ranking of an artist wins
+        weights[artist_data['id']] = max(1, 10 - idx)
 
         #if the genre hasn't been seen before start w/ one otherwise increment 
         for genre_name in artist_data.get('genres', []):
             genre_weights[genre_name] = genre_weights.get(genre_name, 0) + 1
-            
-            # create and link to artist 
-            genre, _ = Genre.objects.get_or_create(name=genre_name)
-            artist.genres.add(genre)
+            artist_genres.append((artist_data['id'], genre_name))
     
-    # create genre prefernces based on the amount of times they appeared  
-    for genre_name, count in genre_weights.items():
-        genre, _ = Genre.objects.get_or_create(name=genre_name)
-        
-        weight = min(10, count)  # Cap at 10
-        
-        UserGenrePreference.objects.update_or_create(
-            user=user,
-            genre=genre,
-            defaults={'weight': weight}
-        )
+    artist_ids = ids_by(Artist, 'spotify_id', artists)
+    genre_ids = ids_by(Genre, 'name', {genre_name: {} for genre_name in genre_weights})
+    link_all(Artist.genres.through, 'artist', 'genre',
+             [(artist_ids[artist_id], genre_ids[genre_name]) for artist_id, genre_name in artist_genres])
+
+    upsert_preferences(UserArtistPreference, 'artist', 'artist', user,
+                       {artist_ids[artist_id]: weight for artist_id, weight in weights.items()})
+    # create genre prefernces based on the amount of times they appeared, capped at 10
+    upsert_preferences(UserGenrePreference, 'genre', 'genre', user,
+                       {genre_ids[genre_name]: min(10, count) for genre_name, count in genre_weights.items()})
 
 #returns a list of users top songs 
 def get_spotify_users_fav_songs(spotify_credentials, time_frame='medium_term'):
     
-    user_top_songs_response = requests.get(
-        f'https://api.spotify.com/v1/me/top/tracks?offset=0&time_range={time_frame}',
-        headers={"Authorization": f"Bearer {spotify_credentials.access_token}"}
-    )
+    try:
+        user_top_songs_response = spotify_client.get(
+            f'https://api.spotify.com/v1/me/top/tracks?offset=0&time_range={time_frame}',
+            headers={"Authorization": f"Bearer {spotify_credentials.access_token}"},
+            endpoint='top_tracks'
+        )
+    except requests.RequestException as error:
+        print("Error when retrieving user's top songs: ", error)
+        return None
 
     if user_top_songs_response.status_code != 200:
         print("Error when retrieving user's top songs: ", user_top_songs_response.text)
@@ -712,10 +773,15 @@ def get_spotify_users_fav_songs(spotify_credentials, time_frame='medium_term'):
 
 def get_spotify_user_fav_artists(spotify_credentials, time_frame='medium_term'):
     
-    user_top_artist_genres_response = requests.get(
-        f'https://api.spotify.com/v1/me/top/artists?offset=0&time_range={time_frame}',
-        headers={"Authorization": f"Bearer {spotify_credentials.access_token}"}
-    )
+    try:
+        user_top_artist_genres_response = spotify_client.get(
+            f'https://api.spotify.com/v1/me/top/artists?offset=0&time_range={time_frame}',
+            headers={"Authorization": f"Bearer {spotify_credentials.access_token}"},
+            endpoint='top_artists'
+        )
+    except requests.RequestException as error:
+        print("Error when retrieving user's top artists and genres: ", error)
+        return None
 
     if user_top_artist_genres_response.status_code != 200:
         print("Error when retrieving user's top artists and genres: ", user_top_artist_genres_response.text)
@@ -726,41 +792,63 @@ def get_spotify_user_fav_artists(spotify_credentials, time_frame='medium_term'):
 
 
 #TODO update user matching functionality
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def matches(request):
-  
-    #TEMP 
-    # get all users barring this current one , for each build a match with the current user  
-    current_user = request.user
-
-    # Get IDs where current_user is either user1 or user2
-    matched_pairs = Match.objects.filter(
-        models.Q(user1=current_user) | models.Q(user2=current_user)
-    ).values_list('user1', 'user2')
-
-    # Flatten list of (user1, user2) tuples into a single set of IDs
-    matched_user_ids = {uid for pair in matched_pairs for uid in pair}
-
-    # IDs of users already rejected
-    rejected_user_ids = set(
-        MatchRejection.objects.filter(user1=current_user).values_list('user2', flat=True)
+def page_limit(request):
+    """
+    the `limit` query parameter of a paged endpoint as (limit, None), or (None, 400 response)
+    """
+    try:
+        limit = int(request.query_params.get('limit', PAGE_SIZE))
+    except ValueError:
+        return None, Response({"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return None, Response(
+            {"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return limit, None
+
+
+def top_preferences(model, user_ids, *fields, limit=3):
+    """
+    returns {user_id: [values row, ...]} holding the `limit` heaviest preferences of every
+    user in user_ids, ranked with ROW_NUMBER() OVER (PARTITION BY user ORDER BY weight DESC)
+    """
+    rows = model.objects.filter(user_id__in=user_ids).annotate(
+        rank=Window(
+            expression=RowNumber(),
+            partition_by=[F('user_id')],
+            order_by=[F('weight').desc(), F('id').asc()],
+        )
+    ).filter(rank__lte=limit).order_by('user_id', 'rank').values('user_id', 'weight', *fields)
+
+    top = {}
+    for row in rows:
+        top.setdefault(row['user_id'], []).append(row)
+    return top
+
+
+def profile_cards(deck):
+    """
+    the swipe cards of a list of (user, final_score), with every user's top 3 songs and artists
+    """
+    # the page's top 3 songs and artists in one query per table instead of two per user
+    page_ids = [user.id for user, _ in deck]
+    top_songs = top_preferences(
+        UserSongPreference, page_ids,
+        'song__id', 'song__name', 'song__spotify_id', 'song__album_image_url'
+    )
+    top_artists = top_preferences(
+        UserArtistPreference, page_ids,
+        'artist__id', 'artist__name', 'artist__spotify_id', 'artist__image_url'
     )
-
-    # Combine all excluded user IDs + current user
-    excluded_ids = matched_user_ids | rejected_user_ids | {current_user.id}
-
-    # Get all users not yet matched/rejected
-    all_users = User.objects.exclude(id__in=excluded_ids)
-
-    #only show users who haven't already been accepted/rejected 
 
     matches_profiles = []
-    for user in all_users:
+    for user, score in deck:
 
         profile_data = {
             'id': user.id,
             'username': user.username,
+            'final_score': score,
             'email': user.email,
             'location': user.location,
             'age': user.age,
@@ -770,10 +858,7 @@ def matches(request):
         }
 
         
-        favorite_song_prefs = UserSongPreference.objects.filter(user=user).select_related('song').order_by('-weight').values(
-                'song__id', 'song__name', 'song__spotify_id', 
-                'song__album_image_url', 'weight'
-            )[:3]
+        favorite_song_prefs = top_songs.get(user.id, [])
         
         fav_songs = [
             {
@@ -786,12 +871,7 @@ def matches(request):
             for s in favorite_song_prefs
         ]
 
-        favorite_artists_prefs = UserArtistPreference.objects.filter(user=user) \
-            .select_related('artist').order_by('-weight') \
-            .values(
-                'artist__id', 'artist__name', 'artist__spotify_id', 
-                'artist__image_url', 'weight'
-            )[:3]
+        favorite_artists_prefs = top_artists.get(user.id, [])
 
         fav_artists = [
             {
@@ -809,9 +889,51 @@ def matches(request):
 
         matches_profiles.append(profile_data)
 
+    return matches_profiles
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def matches(request):
+  
+    current_user = request.user
+
+    limit, error = page_limit(request)
+    if error:
+        return error
+
+    #only show users who haven't already been accepted/rejected, best compatibility first.
+    #the exclusion runs inside the database instead of shipping every seen id back to it
+    ensure_match_table(current_user.id)
+    try:
+        deck, next_cursor = discovery_page(
+            current_user.id, limit, request.query_params.get('cursor')
+        )
+    except ValueError:
+        return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+    matches_profiles = profile_cards(deck)
+
     return Response({
         'count': len(matches_profiles),
-        'matches':matches_profiles
+        'matches':matches_profiles,
+        'next_cursor': next_cursor
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def next_match(request):
+    # the next card from the precomputed discovery queue, refill_discovery_queues keeps it topped up
+    current_user = request.user
+    entry = next_entry(current_user.id)
+    if entry is None:
+        return Response({'match': None, 'remaining': 0})
+
+    card, = profile_cards([(entry.candidate, entry.final_score)])
+    return Response({
+        'match': card,
+        'remaining': current_user.discovery_queue.size,
     })
 
 
@@ -819,8 +941,7 @@ def matches(request):
 @permission_classes([IsAuthenticated])
 def match_accept(request):
     if request.method =='GET' :
-        matched_users =  Match.objects.filter(models.Q(user1=request.user) |
-        models.Q(user2=request.user))
+        matched_users =  Match.objects.involving(request.user)
     
         matches_data = [
             {
@@ -830,9 +951,11 @@ def match_accept(request):
                 "user2_id": match.user2.id,
                 "user2_username": match.user2.username,
                 "created_at": match.created_at,
-                "profile_image": match.user2.profile_image.url if match.user2.profile_image else None 
+                "profile_image": other.profile_image.url if other.profile_image else None 
             }
-            for match in matched_users 
+            for match in matched_users
+            # pairs are stored lower id first, the picture is the other user's either way
+            for other in [match.user2 if match.user1_id == request.user.id else match.user1]
         ]
 
         return Response(matches_data)
@@ -849,22 +972,25 @@ def match_accept(request):
     except User.DoesNotExist:
         return Response({'error': 'User not found'}, status=404)
 
+    if target_user.id == current_user.id:
+        return Response({'error': 'You cannot match with yourself'}, status=400)
+
     # Use a transaction to ensure both Match and Conversation are created atomically
     with transaction.atomic():
-        # Check if the match already exists (using a query)
-        match_query = Match.objects.filter(
-            models.Q(user1=current_user, user2=target_user) |
-            models.Q(user1=target_user, user2=current_user)
-        )
-
-        if not match_query.exists():
-            # 1. Create the Match object and save it to a variable
-            new_match = Match.objects.create(user1=current_user, user2=target_user)
+        # the pair is stored once in (lower id, higher id) order under a unique constraint,
+        # so two concurrent accepts can't both create it
+        user1_id, user2_id = Match.ordered_pair(current_user, target_user)
+        new_match, created = Match.objects.get_or_create(user1_id=user1_id, user2_id=user2_id)
 
-            # 2. Create the corresponding Conversation object,
+        if created:
+            # Create the corresponding Conversation object,
             #    linking it via the 'match' field as defined in chat/models.py
             Conversation.objects.create(match=new_match) 
 
+        # neither of them should be shown the other again
+        pop_candidate(current_user.id, target_user.id)
+        pop_candidate(target_user.id, current_user.id)
+
     return Response({'message': f'Match created with {target_user.username}'}, status=201)
 
 @api_view(['POST'])
@@ -885,13 +1011,14 @@ def match_reject(request):
     # Prevent duplicates
     if not MatchRejection.objects.filter(user1=current_user, user2=target_user).exists():
         MatchRejection.objects.create(user1=current_user, user2=target_user)
+    pop_candidate(current_user.id, target_user.id)
 
     return Response({'message': f'You rejected {target_user.username}'}, status=201)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def return_accepted_matches(request)    :
-    accepted_users = Match.objects.filter(user1 = request.user)
+    accepted_users = Match.objects.involving(request.user)
     
     return Response({
         'accepted': accepted_users
@@ -901,29 +1028,40 @@ def return_accepted_matches(request)    :
 @permission_classes([IsAuthenticated])
 def get_full_matches(request):
     user = request.user
-    other_users = User.objects.exclude(id=user.id)
-    settings = MatchWeightSettings.objects.get_or_create(user=user)[0]
-
-    matches = []
-
-    for other in other_users:
-        final_score = compute_final_match_score(
-            user,
-            other,
-            genre_weight=settings.genre_weight,
-            artist_weight=settings.artist_weight,
-            song_weight=settings.song_weight,
-        )
 
-        if final_score > 0.3:
-            matches.append({
-                'id': other.id,
-                'username': other.username,
-                'final_score': final_score,
-            })
+    limit, error = page_limit(request)
+    if error:
+        return error
 
-    matches.sort(key=lambda x: x['final_score'], reverse=True)
-    return Response({'matches': matches})
+    # scores are kept current as preferences change, so this is normally a single lookup
+    score_status = ensure_match_table(user.id)
+
+    # the table already holds only the best TOP_K, paging walks it with a keyset cursor
+    try:
+        scores, next_cursor = page_of_scores(user.id, 0.3, limit, request.query_params.get('cursor'))
+    except ValueError:
+        return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+    matches = [
+        {
+            'id': score.candidate_id,
+            'username': score.candidate.username,
+            'final_score': score.final_score,
+            'genre_match': score.genre_match,
+            'artist_match': score.artist_match,
+            'song_match': score.song_match,
+        }
+        for score in scores
+    ]
+
+    return Response({
+        'matches': matches,
+        'next_cursor': next_cursor,
+        'stats': {
+            'candidates_scored': score_status.candidates_scored,
+            'candidates_pruned': score_status.candidates_pruned,
+        }
+    })
 
 
 @api_view(['GET', 'POST'])
@@ -946,8 +1084,22 @@ def match_weight_settings(request):
         settings.artist_weight = request.data.get('artist_weight', settings.artist_weight)
         settings.song_weight = request.data.get('song_weight', settings.song_weight)
         settings.save() 
+        # re-rank from the cached per-pair similarities instead of rescoring anyone
+        if not rerank_match_table(user.id):
+            mark_dirty(user.id)
         return Response({
             "genre_weight": settings.genre_weight,
             "artist_weight": settings.artist_weight,
             "song_weight": settings.song_weight,
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+        }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def spotify_metrics(request):
+    # counters of this worker process, staff only
+    return Response({
+        'token': app_token_manager.stats(),
+        'http': spotify_client.stats(),
+        'search': search_cache.stats(),
+    })